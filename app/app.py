@@ -12,6 +12,7 @@ from config import define_flags
 from src.downloader import Downloader
 from src.processpipeliner import ProcessPipeliner
 from loguru import logger
+from src.tracing import configure_tracing
 from src.utils import setup_logging
 
 FLAGS = flags.FLAGS
@@ -24,8 +25,13 @@ def main(argv):
     setup_logging(terminal_loglevel=FLAGS.logging_verbosity, root_logger_loglevel='info', logfile_dir=logfile_dir,
                   enqueue=True)
 
-    # Configure GDAL
-    gdal.SetCacheMax(16000000000)
+    # Record the timing, I/O and memory usage of the processing stages to a trace file (see trace_report.py)
+    if FLAGS.trace:
+        t = datetime.datetime.now(datetime.timezone.utc)
+        configure_tracing(logfile_dir / f'trace-{t:%Y%m%d-%H%M%S}-UTC.jsonl')
+
+    # Configure GDAL (the cache size is per process, so keep it well below the memory estimates of the processing tasks)
+    gdal.SetCacheMax(int(FLAGS.gdal_cache_max_gb * 1e9))
 
     # Create absolute paths (either use full path provided as argument or use data dir in the project folder)
     data_dir = Path(FLAGS.data_directory) if os.path.isabs(FLAGS.data_directory) else Path.cwd() / FLAGS.data_directory
@@ -33,8 +39,18 @@ def main(argv):
     # Ensure filename on geojson file
     geojson_path = FLAGS.geojson if FLAGS.geojson.endswith('.geojson') else FLAGS.geojson + '.geojson'
 
+    # Load the geojson file (check whether the filename was included in the provided name). It is also used to subset
+    # the Sentinel-1 products when processing, so it is loaded for previous orders as well.
+    if 'denmark_without_bornholm' in str(geojson_path):
+        # Load the default geojson (denmark_without_bornholm), which is included in the project code
+        footprint = geojson_to_wkt(read_geojson(Path('data') / 'geojson' / 'denmark_without_bornholm.geojson'))
+    else:
+        # Load the provided geojson file from the data directory
+        footprint = geojson_to_wkt(read_geojson(data_dir / 'geojson' / geojson_path))  # Load from data directory
+
     # If no order_id from previous order is provided, then download the data requested for this order
     order_id = FLAGS.order_id
+    downloader = None
     if order_id == 'Empty':
         order_id = 'order_' + datetime.datetime.today().strftime('%Y%m%d-%H%M%S')
 
@@ -45,14 +61,6 @@ def main(argv):
         downloader = Downloader(username=FLAGS.username, password=FLAGS.password, satellite=FLAGS.satellite,
                                 order_id=order_id, directory=data_dir)
 
-        # Load the geojson file (check whether the filename was included in the provided name)
-        if 'denmark_without_bornholm' in str(geojson_path):
-            # Load the default geojson (denmark_without_bornholm), which is included in the project code
-            footprint = geojson_to_wkt(read_geojson(Path('data') / 'geojson' / 'denmark_without_bornholm.geojson'))
-        else:
-            # Load the provided geojson file from the data directory
-            footprint = geojson_to_wkt(read_geojson(data_dir / 'geojson' / geojson_path))  # Load from data directory
-
         # Query the data (multiple footprints can be used, but it is recommended to stick to a single footprint)
         downloader.query(footprint, FLAGS.startdate, FLAGS.enddate)
 
@@ -65,7 +73,8 @@ def main(argv):
         downloader.save_queried_products()  # Save a geojson containing all products to be downloaded
         logger.info("")
 
-        if FLAGS.download:
+        # When streaming, the products are downloaded by the process pipeliner while it processes them
+        if FLAGS.download and not (FLAGS.stream_processing and FLAGS.process_tiles):
             logger.info("####################")
             logger.info("# Downloading data #")
             logger.info("####################")
@@ -80,8 +89,11 @@ def main(argv):
         logger.info("###################")
         logger.info("# Processing data #")
         logger.info("###################")
-        processpipeliner = ProcessPipeliner(products_df=products_df, directory=data_dir)
-        processpipeliner.process_products()
+        processpipeliner = ProcessPipeliner(products_df=products_df, directory=data_dir, footprint=footprint)
+        if FLAGS.download and FLAGS.stream_processing and downloader is not None:
+            processpipeliner.process_products(downloader=downloader)
+        else:
+            processpipeliner.process_products()
 
 
         # preprocessor = PreProcessor(products=products_df, directory=data_dir, overwrite_products=FLAGS.overwrite,
@@ -0,0 +1,59 @@
+import json
+import sys
+from pathlib import Path
+
+from absl import app, flags
+from loguru import logger
+
+from config import define_flags
+from src.benchmarks import RasterBenchmarks, compare_to_baseline, save_results
+from src.utils import setup_logging
+
+FLAGS = flags.FLAGS
+
+
+def define_benchmark_flags():
+    flags.DEFINE_string('benchmark_directory', '/tmp/satproc_benchmarks', 'Directory for the synthetic rasters and the '
+                                                                          'outputs of the benchmarks')
+    flags.DEFINE_float('benchmark_scale', 1.0, 'Width and height of the synthetic rasters relative to real products '
+                                               '(e.g. 0.25 for quick runs)')
+    flags.DEFINE_integer('benchmark_repeats', 3, 'Number of runs of each benchmark (the fastest run is reported)')
+    flags.DEFINE_string('benchmark_filter', None, 'Only run the benchmarks matching this regular expression')
+    flags.DEFINE_string('benchmark_output', None, 'Json file to save the results to (default: results-<time>.json in '
+                                                  'the benchmark directory)')
+    flags.DEFINE_string('benchmark_baseline', None, 'Json file with results to compare against (e.g. from master)')
+    flags.DEFINE_float('benchmark_tolerance', 0.1, 'Relative increase in wall time which is reported as a regression')
+
+
+def main(argv):
+    setup_logging(terminal_loglevel=FLAGS.logging_verbosity, root_logger_loglevel='error',
+                  logfile_dir=Path(FLAGS.benchmark_directory) / 'logs', enqueue=False)
+
+    benchmarks = RasterBenchmarks(FLAGS.benchmark_directory, scale=FLAGS.benchmark_scale,
+                                  repeats=FLAGS.benchmark_repeats)
+    results = benchmarks.run(pattern=FLAGS.benchmark_filter)
+
+    output_path = FLAGS.benchmark_output
+    if output_path is None:
+        output_path = Path(FLAGS.benchmark_directory) / f"results-{results['metadata']['time']}.json"
+    save_results(results, output_path)
+    logger.info(f"Benchmark results saved to: {output_path}")
+
+    if FLAGS.benchmark_baseline is not None:
+        with open(FLAGS.benchmark_baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        comparisons = compare_to_baseline(results, baseline, tolerance=FLAGS.benchmark_tolerance)
+        print(f"{'Benchmark':<24}{'Wall time [s]':>16}{'Baseline [s]':>16}{'Ratio':>8}")
+        for comparison in comparisons:
+            # The ratio is None when the baseline wall time is 0
+            ratio = 'n/a' if comparison['ratio'] is None else f"{comparison['ratio']:.2f}"
+            print(f"{comparison['name']:<24}{comparison['wall_time']:>16.2f}{comparison['baseline_wall_time']:>16.2f}"
+                  f"{ratio:>8}{'  REGRESSION' if comparison['regression'] else ''}")
+        if any(comparison['regression'] for comparison in comparisons):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    define_flags()
+    define_benchmark_flags()
+    app.run(main)
@@ -13,10 +13,18 @@ def define_flags():
     flags.DEFINE_bool('download', True, 'Download the files')
     flags.DEFINE_bool('check_downloads', False, 'Check all downloads to ensure none are corrupted')
     flags.DEFINE_bool('process_tiles', True, 'Process the downloaded files')
+    flags.DEFINE_bool('stream_processing', False, 'Process each product as soon as it has been downloaded instead of '
+                                                  'waiting for the entire order to be downloaded')
     flags.DEFINE_bool('compress', True, 'Compress pre- and post-processed geotiff files')
+    flags.DEFINE_enum('compact_storage', 'none', ['none', 'int16', 'lerc'],
+                      'Storage of the spectral indices and Sentinel-1 backscatter: as calculated (none), as 16-bit '
+                      'integers scaled by 0.01 with the scale in the metadata (int16), or as floats with lossy LERC '
+                      'compression with a maximum error of 0.005 (lerc)')
     flags.DEFINE_bool('move_to_output_directory', False, 'Move output to output directory')
     flags.DEFINE_string('output_directory', '/workspace/output_dir', 'Choose a different output directory')
     flags.DEFINE_string('logging_verbosity', 'info', 'Logging verbosity (debug|info|warning|error|fatal).')
+    flags.DEFINE_bool('trace', False, 'Record the timing, I/O and memory usage of the processing stages to a trace '
+                                      'file in the logs folder (summarize it with trace_report.py)')
 
     ###############
     # Query flags #
@@ -31,26 +39,74 @@ def define_flags():
     # Sentinel-2
     flags.DEFINE_multi_integer('s2_relative_orbit', [8, 108], 'Relative orbit number (0 => all relative orbits)')
     flags.DEFINE_integer('s2_max_cloudcoverage', 100, 'The maximum allowed cloud coverage')
-    # Sentinel-3
-    # Sentinel-5p
-
     ###################
     # Processor flags #
     ###################
     # General
     flags.DEFINE_bool('overwrite', True, 'Overwrite existing products')
     flags.DEFINE_bool('compress_gtiff', True, 'Compress GTiff files')
+    flags.DEFINE_float('memory_budget_gb', 0, 'Total RAM the processes may use; tasks are only started when their '
+                                              'estimated memory usage fits (0 => 90% of the physical memory)')
+    flags.DEFINE_float('gdal_cache_max_gb', 4, 'Maximum size of the GDAL block cache of each process')
+    flags.DEFINE_bool('selective_unzip', True, 'Only unzip the files of the products which are used in the processing')
+    flags.DEFINE_bool('read_from_zip', False, 'Read the Sentinel-2 and -5p products directly from the downloaded '
+                                              'files (GDAL /vsizip/) instead of unzipping/copying them. Sentinel-3 '
+                                              'products are not extracted, so they are not processed')
+    flags.DEFINE_bool('resume', True, 'Skip processing stages recorded as completed with the same inputs in the '
+                                      'processing state database (orders folder), also if overwrite is set')
+    flags.DEFINE_string('cache_directory', '', 'Directory of the cache of the outputs of the processing stages, which '
+                                               'are reused when a stage is run with the same inputs, parameters and '
+                                               'code (should be on the same file system as the data directory, so the '
+                                               'outputs are hardlinked; empty => no cache)')
+    flags.DEFINE_float('cache_max_gb', 500, 'Maximum size of the cache; the least recently used outputs are evicted '
+                                            '(0 => no limit)')
+    flags.DEFINE_bool('coreg_align_grids', False, 'Keep co-registered images on their pixel grid; shifts within '
+                                                  'coreg_subpixel_tolerance of whole pixels are rounded, and other '
+                                                  'shifts are resampled (otherwise the shifts are applied to the '
+                                                  'geotransform without resampling)')
+    flags.DEFINE_float('coreg_subpixel_tolerance', 0.1, 'Maximum distance [pixels] from whole pixels for which a shift '
+                                                        'is rounded instead of resampled (with coreg_align_grids)')
+    flags.DEFINE_bool('coreg_coarse_to_fine', False, 'Estimate the co-registration shifts coarse to fine; first on the '
+                                                     'images downsampled by coreg_coarse_factor, and then refined in a '
+                                                     'small full resolution window (coreg_fine_window)')
+    flags.DEFINE_integer('coreg_coarse_factor', 8, 'Downsampling factor of the coarse co-registration stage')
+    flags.DEFINE_integer('coreg_fine_window', 512, 'Size of the window of the fine co-registration stage [pixels]')
     # Sentinel-1
     flags.DEFINE_integer('s1_num_proc', 2,
-                         'Number of parallel processes for Sentinel-1 processing (approx. 20 GB RAM per process)')
+                         'Maximum number of parallel processes for Sentinel-1 processing (limited by the memory budget)')
+    flags.DEFINE_float('s1_tile_memory_gb', 20, 'Estimated RAM used for processing a Sentinel-1 tile (refined with '
+                                                'the usage observed in earlier runs)')
+    flags.DEFINE_float('s1_combine_memory_gb', 8, 'Estimated RAM used for combining (and co-registering) the '
+                                                  'Sentinel-1 tiles of a date and absolute orbit')
+    flags.DEFINE_bool('s1_fused_graph', True, 'Preprocess the Sentinel-1 products and create the band geotiffs in a single '
+                                              'SNAP graph, without writing an intermediate BEAM-DIMAP product')
+    flags.DEFINE_bool('s1_subset_to_aoi', True, 'Subset the Sentinel-1 products to the bounding box of the geojson before '
+                                                'calibration and terrain correction (requires s1_fused_graph)')
+    flags.DEFINE_float('gpt_timeout_minutes', 180, 'Maximum run time of a SNAP graph before gpt is killed (0 => no limit)')
+    flags.DEFINE_float('gpt_stall_timeout_minutes', 30, 'Maximum time without output from gpt before it is considered '
+                                                        'stuck and killed (0 => no limit)')
+    flags.DEFINE_float('gpt_max_memory_gb', 0, 'Maximum RAM used by gpt before it is killed (0 => no limit)')
+    flags.DEFINE_integer('gpt_retries', 1, 'Number of times a SNAP graph is retried after gpt has been killed due to '
+                                           'a time limit')
     flags.DEFINE_bool('s1_del_intermediate', False, 'Delete the intermediate Sentinel-1 processing data')
     flags.DEFINE_string('s1_output_crs', 'EPSG:32632', 'Coordinate reference system for the output combined geotiff')
     flags.DEFINE_bool('s1_coregister', False, 'Co-register the Sentinel-1 image (NOTE: Currently only works on the final combined geotiff (ie. from the .vrt file))')
     # Sentinel-2
     flags.DEFINE_integer('s2_num_proc', 6,
-                         'Number of parallel processes for Sentinel-1 processing (approx. 8 GB RAM per process)')
+                         'Maximum number of parallel processes for Sentinel-2 processing (limited by the memory budget)')
+    flags.DEFINE_float('s2_tile_memory_gb', 8, 'Estimated RAM used for processing a Sentinel-2 tile (refined with '
+                                               'the usage observed in earlier runs)')
+    flags.DEFINE_multi_string('s2_bands', ['B03', 'B04', 'B08', 'TCI'], 'Sentinel-2 bands to unzip and process '
+                                                                        '(used with selective_unzip)')
+    flags.DEFINE_multi_string('s2_resolutions', ['10m'], 'Resolutions of the Sentinel-2 bands to unzip and process '
+                                                         '(used with selective_unzip)')
     flags.DEFINE_bool('delete_jp2_files', True, 'Delete jp2 files after they have been converted to GTiff')
-    flags.DEFINE_bool('s2_ndvi', True, 'Calculate NDVI index of Sentinel-2 data')
+    flags.DEFINE_bool('s2_ndvi', True, 'Calculate the spectral indices (s2_indices) of Sentinel-2 data')
+    flags.DEFINE_multi_string('s2_indices', ['NDVI', 'GNDVI'], 'Spectral indices of Sentinel-2 data to calculate '
+                                                               '(NDVI, GNDVI, NDWI, NDMI, EVI and/or SAVI)')
+    flags.DEFINE_integer('band_math_threads', 0, 'Number of threads used by each process for calculating indices '
+                                                 'window by window (0 => the number of cpus)')
     # Sentinel-3
+    flags.DEFINE_float('s3_memory_gb', 2, 'Estimated RAM used for processing a Sentinel-3 product')
     # Sentinel-5p
-
+    flags.DEFINE_float('s5p_memory_gb', 2, 'Estimated RAM used for processing a Sentinel-5p product')
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from loguru import logger
+
+# Version of the code which creates the artifacts (see get_code_version())
+_code_version = None
+
+
+def get_code_version():
+    """
+    :return: Hash of the source code of the processing (the .py files of the src package), so artifacts created by
+             another version of the code are not reused
+    """
+    global _code_version
+    if _code_version is None:
+        digest = hashlib.sha1()
+        for path in sorted(Path(__file__).parent.rglob('*.py')):
+            digest.update(path.relative_to(Path(__file__).parent).as_posix().encode())
+            digest.update(path.read_bytes())
+        _code_version = digest.hexdigest()
+    return _code_version
+
+
+def link_or_copy(src, dst):
+    """
+    Hardlinks a file (or copies it with its modification time, if the paths are on different file systems).
+    """
+    try:
+        os.link(str(src), str(dst))
+    except OSError:
+        shutil.copy2(str(src), str(dst))
+
+
+class ArtifactCache(object):
+    """
+    Cache of the output files of the processing stages (ie. derived artifacts such as geotiffs and vrt files), shared by
+    all orders. Each artifact is keyed by the product (or group), the stage, the fingerprint of its inputs and
+    parameters (see src.processingstate.fingerprint()), and the version of the code, so a stage is only recomputed if
+    one of these has changed. The files are stored as hardlinks to the outputs, and are hardlinked back to the output
+    paths when they are reused, so the cache does not copy any data (unless it is on another file system). The least
+    recently used artifacts are evicted when the cache exceeds its maximum size.
+
+    Like ProcessingState, the index of the cache is opened for each query, so the object can be pickled and used from
+    the processes in a multiprocessing pool.
+    """
+    def __init__(self, directory, max_size=None):
+        """
+        :param directory: Directory of the cache
+        :param max_size: Maximum total size of the cached files [bytes] (None => no limit)
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+        if not self.directory.exists():  # Create directory if it does not exist
+            os.makedirs(self.directory)
+
+        with self.__connect() as connection:
+            # WAL allows the processes to read while another process is writing
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS artifacts ('
+                               'key TEXT PRIMARY KEY, '
+                               'stage TEXT NOT NULL, '
+                               'files TEXT NOT NULL, '
+                               'size INTEGER NOT NULL, '
+                               'created REAL NOT NULL, '
+                               'last_used REAL NOT NULL)')
+
+    @contextmanager
+    def __connect(self):
+        connection = sqlite3.connect(str(self.directory / 'cache.sqlite'), timeout=600)
+        try:
+            with connection:  # Commits the transaction (or rolls it back on exceptions)
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def get_key(key, stage, stage_fingerprint):
+        """
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param stage_fingerprint: Fingerprint of the inputs and parameters of the stage
+        :return: Key of the artifacts of the stage
+        """
+        return hashlib.sha1(json.dumps([key, stage, stage_fingerprint, get_code_version()]).encode()).hexdigest()
+
+    def fetch(self, key, stage, stage_fingerprint):
+        """
+        Restores the cached outputs of a stage (if any) to their output paths.
+
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param stage_fingerprint: Fingerprint of the inputs and parameters of the stage
+        :return: List with the paths to the restored outputs (None if the outputs are not in the cache)
+        """
+        artifact_key = self.get_key(key, stage, stage_fingerprint)
+        with self.__connect() as connection:
+            row = connection.execute('SELECT files FROM artifacts WHERE key = ?', (artifact_key,)).fetchone()
+        if row is None:
+            return None
+
+        outputs = []
+        try:
+            for name, output in json.loads(row[0]):
+                output = Path(output)
+                if not output.parent.exists():  # Create directory if it does not exist
+                    os.makedirs(output.parent)
+                # Link to a temp file first, so an existing output is replaced in a single rename
+                output_tmp = output.with_name(f'.{output.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp')
+                link_or_copy(self.directory / artifact_key / name, output_tmp)
+                os.replace(output_tmp, output)
+                outputs.append(output)
+        except OSError as e:  # E.g. the artifact has been evicted by another process
+            logger.warning(f"Could not restore the outputs of stage '{stage}' from the cache: {e!r}")
+            return None
+
+        with self.__connect() as connection:
+            connection.execute('UPDATE artifacts SET last_used = ? WHERE key = ?', (time.time(), artifact_key))
+        return outputs
+
+    def store(self, key, stage, stage_fingerprint, outputs):
+        """
+        Stores the outputs of a stage in the cache. Only outputs which are files are cached, so stages with directories
+        as outputs (e.g. unzipped products) are not stored.
+
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param stage_fingerprint: Fingerprint of the inputs and parameters of the stage
+        :param outputs: Paths to the output files of the stage
+        """
+        outputs = [Path(output) for output in outputs]
+        if not outputs or not all(output.is_file() for output in outputs):
+            logger.debug(f"Outputs of stage '{stage}' are not cached, as they are not all files: {outputs}")
+            return
+
+        artifact_key = self.get_key(key, stage, stage_fingerprint)
+        entry_path = self.directory / artifact_key
+        if entry_path.exists():  # Already stored (e.g. by another order)
+            return
+        entry_tmp = self.directory / f'.{artifact_key}.{os.getpid()}.tmp'
+        os.makedirs(entry_tmp)
+        files = []
+        for i, output in enumerate(outputs):
+            name = f'{i}_{output.name}'  # The outputs of a stage can have the same file name in different folders
+            link_or_copy(output, entry_tmp / name)
+            files.append([name, str(output)])
+        try:
+            os.rename(entry_tmp, entry_path)
+        except OSError:  # Stored by another process in the meantime
+            shutil.rmtree(entry_tmp, ignore_errors=True)
+            return
+
+        now = time.time()
+        size = sum(output.stat().st_size for output in outputs)
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO artifacts (key, stage, files, size, created, last_used) '
+                               'VALUES (?, ?, ?, ?, ?, ?)', (artifact_key, stage, json.dumps(files), size, now, now))
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used artifacts until the total size of the cache is below its maximum size.
+        """
+        if self.max_size is None:
+            return
+        with self.__connect() as connection:
+            total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM artifacts').fetchone()[0]
+            if total_size <= self.max_size:
+                return
+            rows = connection.execute('SELECT key, size FROM artifacts ORDER BY last_used').fetchall()
+            evicted_keys = []
+            for key, size in rows:
+                if total_size <= self.max_size:
+                    break
+                evicted_keys.append(key)
+                total_size -= size
+            connection.executemany('DELETE FROM artifacts WHERE key = ?', [(key,) for key in evicted_keys])
+
+        for key in evicted_keys:
+            shutil.rmtree(self.directory / key, ignore_errors=True)
+        logger.debug(f"Evicted {len(evicted_keys)} artifact(s) from the cache")
+
+    @staticmethod
+    def unlink_outputs(outputs):
+        """
+        Removes the existing outputs of a stage which are hardlinked to the cache, so a stage which writes to its
+        outputs in place does not modify the cached files.
+
+        :param outputs: Paths to the outputs of the stage
+        """
+        for output in outputs:
+            output = Path(output)
+            if output.is_file() and output.stat().st_nlink > 1:
+                os.remove(output)
@@ -0,0 +1,148 @@
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+# Minimum number of pixels in a window. Windows are aligned with the internal blocks of the first source raster, but
+# blocks smaller than this (e.g. the single-row strips of untiled geotiffs) are combined, so the overhead per window
+# stays small compared to the computation
+MIN_WINDOW_PIXELS = 512 * 512
+
+# Storage of continuous values (e.g. spectral indices and backscatter in dB) in the output geotiffs. Scaled values are
+# stored as round(value / scale) with the scale in the metadata of the bands, and LERC compression stores the values
+# with an absolute error of at most max_z_error.
+ValueStorage = namedtuple('ValueStorage', ['dtype', 'scale', 'nodata', 'compression', 'max_z_error'])
+STORAGE_MODES = ['none', 'int16', 'lerc']
+INT16_NODATA = -32768
+
+
+def get_value_storage(mode, precision):
+    """
+    :param mode: 'none' (the values are stored as they are calculated), 'int16' (scaled 16-bit integers) or 'lerc'
+                 (32-bit floats with lossy LERC compression)
+    :param precision: Precision of the values which must be kept (e.g. 0.01 for indices rounded to 2 decimals)
+    :return: ValueStorage (None for mode 'none')
+    """
+    if mode == 'int16':
+        return ValueStorage('int16', precision, INT16_NODATA, 'DEFLATE', None)
+    if mode == 'lerc':
+        return ValueStorage('float32', None, float('nan'), 'LERC_DEFLATE', precision / 2)
+    if mode == 'none':
+        return None
+    raise ValueError(f"Unknown storage mode: {mode} (available: {STORAGE_MODES})")
+
+
+def encode_values(values, storage, out=None):
+    """
+    Converts values to the data type of a storage, where NaN values are stored as the nodata value, and scaled values
+    outside the range of the data type are clipped.
+
+    :param values: Float array with the values (NaN => nodata)
+    :param storage: ValueStorage
+    :param out: Array with the data type of the storage which the result is written into (None => a new array)
+    :return: The encoded values
+    """
+    if out is None:
+        out = np.empty(values.shape, dtype=storage.dtype)
+    if storage.scale is None:
+        out[...] = values
+        return out
+
+    nodata_mask = np.isnan(values)
+    info = np.iinfo(storage.dtype)
+    scaled = np.rint(values / storage.scale)
+    # The lowest value of the data type is reserved for nodata
+    np.clip(scaled, info.min + 1, info.max, out=scaled)
+    scaled[nodata_mask] = storage.nodata
+    out[...] = scaled
+    return out
+
+
+def get_windows(dataset, min_pixels=MIN_WINDOW_PIXELS):
+    """
+    :param dataset: Opened rasterio dataset
+    :param min_pixels: Minimum number of pixels in a window (see MIN_WINDOW_PIXELS)
+    :return: List with the windows covering the raster, aligned with its internal blocks
+    """
+    block_height, block_width = dataset.block_shapes[0]
+    if block_height * block_width >= min_pixels:
+        return [window for _, window in dataset.block_windows(1)]
+
+    # Combine rows of blocks into strips which span the entire width of the raster
+    rows = max(1, int(np.ceil(min_pixels / dataset.width / block_height))) * block_height
+    return [Window(0, row_off, dataset.width, min(rows, dataset.height - row_off))
+            for row_off in range(0, dataset.height, rows)]
+
+
+def calculate_band_math(src_paths, dst_paths, func, dtype='float32', num_threads=0, profile=None, storage=None):
+    """
+    Calculates rasters from the first band of other rasters (e.g. vegetation indices from the Sentinel-2 bands) window
+    by window, such that only a few windows are in memory at a time instead of the entire rasters. The windows are
+    processed by a pool of threads (numpy and GDAL release the GIL), where each thread has its own dataset handles and
+    preallocated buffers.
+
+    :param src_paths: Paths to the source rasters (must have the same size)
+    :param dst_paths: Paths to the output rasters
+    :param func: Function called for each window with a list of the source arrays and a list of the output arrays (both
+                 with the given dtype), which must write the results into the output arrays. The source arrays may be
+                 used as temporary buffers.
+    :param dtype: Data type of the computations and the outputs
+    :param num_threads: Number of threads (0 => the number of cpus)
+    :param profile: Updates to the profile of the outputs (by default it is the profile of the first source)
+    :param storage: ValueStorage of the outputs, which the results are encoded to (None => stored with the given dtype)
+    """
+    src_paths = [str(path) for path in src_paths]
+    with rasterio.open(src_paths[0]) as src:
+        dst_profile = src.profile
+        windows = get_windows(src)
+    # The outputs are written uncompressed with internal tiles (they are converted to COGs afterwards)
+    dst_profile.pop('compress', None)
+    dst_profile.update(dtype=dtype, count=1, tiled=True, blockxsize=512, blockysize=512)
+    if storage is not None:
+        dst_profile.update(dtype=storage.dtype, nodata=storage.nodata)
+    dst_profile.update(profile or {})
+
+    max_pixels = max(window.height * window.width for window in windows)
+    local = threading.local()
+    handles = []  # All dataset handles of the threads (closed when done)
+    handles_lock = threading.Lock()
+    write_lock = threading.Lock()  # A rasterio dataset may only be used by one thread at a time
+
+    def process_window(window):
+        if not hasattr(local, 'sources'):
+            local.sources = [rasterio.open(path) for path in src_paths]
+            local.buffers = [np.empty(max_pixels, dtype=dtype) for _ in range(len(src_paths) + len(dst_paths))]
+            if storage is not None:
+                local.encoded = np.empty(max_pixels, dtype=storage.dtype)
+            with handles_lock:
+                handles.extend(local.sources)
+        # Views of the flat buffers are contiguous for any window shape
+        shape = (int(window.height), int(window.width))
+        arrays = [buffer[:shape[0] * shape[1]].reshape(shape) for buffer in local.buffers]
+        src_arrays, dst_arrays = arrays[:len(src_paths)], arrays[len(src_paths):]
+        for source, array in zip(local.sources, src_arrays):
+            source.read(1, window=window, out=array, out_dtype=dtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            func(src_arrays, dst_arrays)
+        for dst, array in zip(dst_datasets, dst_arrays):
+            if storage is not None:
+                array = encode_values(array, storage, out=local.encoded[:shape[0] * shape[1]].reshape(shape))
+            with write_lock:
+                dst.write(array, 1, window=window)
+
+    dst_datasets = [rasterio.open(str(path), 'w', **dst_profile) for path in dst_paths]
+    if storage is not None and storage.scale is not None:
+        for dst in dst_datasets:
+            dst.scales = (storage.scale,)
+            dst.offsets = (0,)
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+            # list() raises the first error of the windows (if any)
+            list(executor.map(process_window, windows))
+    finally:
+        for dataset in dst_datasets + handles:
+            dataset.close()
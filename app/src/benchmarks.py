@@ -0,0 +1,291 @@
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+from loguru import logger
+from osgeo import gdal
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from src.sentinelprocessors.base import BaseProcessor
+from src.sentinelprocessors.s1processor import S1Processor
+from src.sentinelprocessors.s2processor import S2Processor
+from src.tracing import measure_peak_memory
+
+# Size of a Sentinel-2 tile at 10 m resolution
+S2_TILE_SIZE = 10980
+# Approximate size of a terrain corrected Sentinel-1 IW GRD product at 10 m resolution (width, height)
+S1_PRODUCT_SIZE = (25000, 17000)
+# Number of rows written at a time when creating the synthetic rasters
+STRIP_HEIGHT = 1024
+
+
+def create_synthetic_raster(path, width, height, count=1, dtype='uint16', crs='EPSG:32632', origin=(600000, 6300000),
+                            value_range=(0, 10000), nodata=None, seed=0):
+    """
+    Creates a raster with smooth, field-like structures plus noise, so compression and resampling behave roughly like
+    on real products (uniform random data does not compress, and constant data compresses unrealistically well). The
+    raster is written in strips, so rasters larger than the memory can be created.
+
+    :param path: Path to the raster (a tiled and DEFLATE compressed geotiff)
+    :param width: Width of the raster [pixels]
+    :param height: Height of the raster [pixels]
+    :param count: Number of bands
+    :param dtype: Data type of the raster (e.g. 'uint16', 'uint8' or 'float32')
+    :param crs: Coordinate reference system of the raster
+    :param origin: Upper left corner of the raster in the crs (the resolution is 10 m)
+    :param value_range: Range of the values (min, max)
+    :param nodata: Nodata value of the raster
+    :param seed: Seed of the random generator
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    profile = {'driver': 'GTiff', 'width': width, 'height': height, 'count': count, 'dtype': dtype,
+               'crs': CRS.from_string(crs), 'transform': from_origin(origin[0], origin[1], 10, 10), 'nodata': nodata,
+               'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'DEFLATE', 'BIGTIFF': 'YES'}
+    random = np.random.RandomState(seed)
+    low, high = value_range
+    x = np.arange(width, dtype=np.float32)
+    with rasterio.open(str(path), 'w', **profile) as dst:
+        for row in range(0, height, STRIP_HEIGHT):
+            rows = min(STRIP_HEIGHT, height - row)
+            y = np.arange(row, row + rows, dtype=np.float32)[:, np.newaxis]
+            for band in range(1, count + 1):
+                fields = (np.sin(x / (150 + 20 * band)) * np.cos(y / (110 + 30 * band)) + 1) / 2
+                noise = random.normal(0, 0.05, size=(rows, width)).astype(np.float32)
+                data = low + np.clip(fields + noise, 0, 1) * (high - low)
+                dst.write(data.astype(dtype), band, window=Window(0, row, width, rows))
+
+
+class RasterBenchmarks(object):
+    """
+    Micro-benchmarks of the raster primitives of the processors (reprojection, cog, vrt, thumbnails, spectral indices
+    and the Sentinel-1 RGB geotiff) on synthetic rasters with the sizes of real products. The synthetic rasters are
+    created once in the benchmark directory and reused in later runs.
+    """
+    def __init__(self, directory, scale=1.0, repeats=1):
+        """
+        :param directory: Directory for the synthetic rasters and the outputs of the benchmarks
+        :param scale: Scale of the width and height of the rasters relative to the real products (e.g. 0.25 for quick
+                      runs)
+        :param repeats: Number of times each benchmark is run (the fastest run is reported)
+        """
+        self.directory = Path(directory)
+        self.scale = scale
+        self.repeats = repeats
+        self.s2_tile_size = max(1, int(S2_TILE_SIZE * scale))
+        self.s1_product_size = tuple(max(1, int(size * scale)) for size in S1_PRODUCT_SIZE)
+        self.input_directory = self.directory / 'inputs' / f'scale_{scale:g}'
+        self.work_directory = self.directory / 'work'
+
+        products_df = pd.DataFrame(columns=['title', 'platformname', 'group'])
+        self.s1processor = S1Processor(products_df, self.work_directory)
+        self.s2processor = S2Processor(products_df, self.work_directory)
+        for processor in [self.s1processor, self.s2processor]:
+            processor.overwrite_products = True  # The outputs of the previous run are always recreated
+            processor.resume = False
+
+        self.benchmarks = OrderedDict([
+            ('reproject_image', (self.__setup_reproject_image, self.__run_reproject_image)),
+            ('reproject_to_cog', (self.__setup_reproject_image, self.__run_reproject_to_cog)),
+            ('reproject_to_cog_identity', (self.__setup_reproject_to_cog_identity, self.__run_reproject_to_cog)),
+            ('create_cog_none', (self.__setup_create_cog, lambda path: BaseProcessor.create_cog(path))),
+            ('create_cog_deflate', (self.__setup_create_cog,
+                                    lambda path: BaseProcessor.create_cog(path, compression='DEFLATE'))),
+            ('create_cog_jpeg', (self.__setup_create_cog,
+                                 lambda path: BaseProcessor.create_cog(path, compression='JPEG'))),
+            ('create_vrt', (self.__setup_create_vrt, self.__run_create_vrt)),
+            ('vrt_to_geotiff', (self.__setup_vrt_to_geotiff, self.__run_vrt_to_geotiff)),
+            ('create_thumbnail', (self.__setup_vrt_to_geotiff, self.__run_create_thumbnail)),
+            ('s2_ndvi', (self.__setup_s2_product,
+                         lambda product: self.s2processor.__calculate_indices__(product, ['NDVI']))),
+            ('s2_gndvi', (self.__setup_s2_product,
+                          lambda product: self.s2processor.__calculate_indices__(product, ['GNDVI']))),
+            ('s2_indices', (self.__setup_s2_product,
+                            lambda product: self.s2processor.__calculate_indices__(
+                                product, ['NDVI', 'GNDVI', 'NDWI', 'EVI', 'SAVI']))),
+            ('s1_to_geotiff_rgb', (self.__setup_s1_bands, self.__run_s1_to_geotiff_rgb)),
+        ])
+
+    def run(self, pattern=None):
+        """
+        Runs the benchmarks.
+
+        :param pattern: Regular expression; only the benchmarks with a matching name are run (None => all)
+        :return: Dict with the metadata of the run and the results of each benchmark (wall time [s], CPU time [s] and
+                 peak memory usage [bytes] of the fastest run, along with all runs)
+        """
+        results = OrderedDict()
+        for name, (setup, benchmark) in self.benchmarks.items():
+            if pattern is not None and re.search(pattern, name) is None:
+                continue
+            logger.info(f"Running benchmark: {name}")
+            runs = []
+            for _ in range(self.repeats):
+                args = setup()  # The setup (e.g. copying the input) is not part of the measurement
+                runs.append(self.__measure(benchmark, args))
+            fastest_run = min(runs, key=lambda run: run['wall_time'])
+            results[name] = OrderedDict(list(fastest_run.items()) + [('runs', runs)])
+            logger.info(f"{name}: {fastest_run['wall_time']:.2f} s wall time, {fastest_run['cpu_time']:.2f} s CPU "
+                        f"time, {(fastest_run['peak_memory'] or 0) / 1e9:.2f} GB peak memory")
+
+        metadata = OrderedDict([('time', time.strftime('%Y-%m-%dT%H:%M:%S')), ('scale', self.scale),
+                                ('repeats', self.repeats), ('gdal_version', gdal.__version__),
+                                ('rasterio_version', rasterio.__version__), ('python_version', platform.python_version()),
+                                ('machine', platform.node()), ('cpu_count', os.cpu_count())])
+
+        return OrderedDict([('metadata', metadata), ('benchmarks', results)])
+
+    @staticmethod
+    def __measure(benchmark, args):
+        usage_before = _cpu_time()
+        started = time.perf_counter()
+        with measure_peak_memory() as measurement:
+            benchmark(args)
+        wall_time = time.perf_counter() - started
+
+        return OrderedDict([('wall_time', wall_time), ('cpu_time', _cpu_time() - usage_before),
+                            ('peak_memory', measurement.peak_memory)])
+
+    def __input(self, name, **kwargs):
+        # Create the synthetic raster the first time it is used
+        path = self.input_directory / name
+        if not path.exists():
+            logger.info(f"Creating synthetic raster: {path}")
+            create_synthetic_raster(path, **kwargs)
+        return path
+
+    def __work_path(self, name):
+        path = self.work_directory / name
+        if path.is_dir():
+            shutil.rmtree(str(path))
+        elif path.exists():
+            path.unlink()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def __s2_tci(self, name='TCI.tif', origin=(600000, 6300000)):
+        return self.__input(name, width=self.s2_tile_size, height=self.s2_tile_size, count=3, dtype='uint8',
+                            origin=origin, value_range=(1, 255), nodata=0)
+
+    def __setup_reproject_image(self):
+        # Sentinel-2 tiles in UTM zone 33 are reprojected to UTM zone 32 (the default output crs)
+        src = self.__input('B04_32633.tif', width=self.s2_tile_size, height=self.s2_tile_size, crs='EPSG:32633',
+                           origin=(300000, 6300000))
+        return src, self.__work_path('reprojected.tif')
+
+    def __run_reproject_image(self, args):
+        src, dst = args
+        self.s2processor.reproject_image(src, dst)
+
+    def __setup_reproject_to_cog_identity(self):
+        # Sentinel-2 tiles in UTM zone 32 are already in the output crs, so they are not reprojected
+        src = self.__input('B04_32632.tif', width=self.s2_tile_size, height=self.s2_tile_size, crs='EPSG:32632',
+                           origin=(600000, 6300000))
+        return src, self.__work_path('reprojected.tif')
+
+    def __run_reproject_to_cog(self, args):
+        src, dst = args
+        self.s2processor.reproject_to_cog(src, dst, compression='DEFLATE')
+
+    def __setup_create_cog(self):
+        # create_cog replaces the file, so it is run on a copy of the input
+        img = self.__work_path('cog.tif')
+        shutil.copy(str(self.__s2_tci()), str(img))
+        return img
+
+    def __setup_create_vrt(self):
+        # 2x2 adjacent Sentinel-2 tiles (the tiles of a date are combined with a vrt)
+        tile_extent = self.s2_tile_size * 10
+        tile_paths = [str(self.__s2_tci(f'TCI_{row}_{col}.tif',
+                                        origin=(600000 + col * tile_extent, 6300000 - row * tile_extent)))
+                      for row in range(2) for col in range(2)]
+        return tile_paths, self.__work_path('combined.vrt')
+
+    def __run_create_vrt(self, args):
+        tile_paths, vrt_path = args
+        self.s2processor.create_vrt(tile_paths, vrt_path)
+
+    def __setup_vrt_to_geotiff(self):
+        tile_paths, vrt_path = self.__setup_create_vrt()
+        self.__run_create_vrt((tile_paths, vrt_path))
+        return vrt_path
+
+    def __run_vrt_to_geotiff(self, vrt_path):
+        self.s2processor.vrt_to_geotiff(vrt_path, self.__work_path('combined.tif'))
+
+    def __run_create_thumbnail(self, vrt_path):
+        BaseProcessor.create_thumbnail(vrt_path, self.__work_path('combined.png'))
+
+    def __setup_s2_product(self):
+        # The processors find the bands in the 10 m resolution folder of the product by their suffixes
+        res_10m_path = self.__work_path('S2_product') / 'R10m'
+        res_10m_path.mkdir(parents=True)
+        for band, seed in [('B02', 2), ('B03', 3), ('B04', 4), ('B08', 8)]:
+            src = self.__input(f'{band}.tif', width=self.s2_tile_size, height=self.s2_tile_size, seed=seed)
+            shutil.copy(str(src), str(res_10m_path / f'T32UNG_20190803T103031_{band}_10m.tiff'))
+        return pd.DataFrame({'title': ['S2A_MSIL2A_20190803T103031_N0213_R108_T32UNG_20190803T134337'],
+                             'res_10m_path': [res_10m_path]})
+
+    def __setup_s1_bands(self):
+        width, height = self.s1_product_size
+        band_paths = [self.__input(f'S1_{band}.tif', width=width, height=height, dtype='float32',
+                                   value_range=value_range, nodata=-32768, seed=seed)
+                      for band, value_range, seed in [('VH', (-30, -10), 1), ('VV', (-25, 0), 2),
+                                                      ('VV-VH', (0, 15), 3)]]
+        return band_paths, self.__work_path('S1_product.SAFE')
+
+    def __run_s1_to_geotiff_rgb(self, args):
+        (vh_path, vv_path, vv_vh_path), product_path = args
+        self.s1processor.to_geotiff_rgb(vh_path, vv_path, vv_vh_path, product_path, dtype=rasterio.int16)
+
+
+def _cpu_time():
+    # CPU time of this process (incl. the GDAL worker threads) and its terminated child processes [s]
+    usage = [resource.getrusage(who) for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def save_results(results, path):
+    """
+    :param results: Results from RasterBenchmarks.run()
+    :param path: Path to the json file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('w') as results_file:
+        json.dump(results, results_file, indent=2)
+
+
+def compare_to_baseline(results, baseline, tolerance=0.1):
+    """
+    Compares the wall time of the benchmarks to a baseline (e.g. the results of the master branch).
+
+    :param results: Results from RasterBenchmarks.run()
+    :param baseline: Results from an earlier run (e.g. loaded from a json file saved with save_results())
+    :param tolerance: Relative increase in wall time that is not considered a regression (e.g. 0.1 => 10%)
+    :return: List of dicts with the comparison of each benchmark which is in both the results and the baseline
+    """
+    comparisons = []
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        baseline_result = baseline['benchmarks'][name]
+        ratio = result['wall_time'] / baseline_result['wall_time'] if baseline_result['wall_time'] > 0 else None
+        comparisons.append(OrderedDict([('name', name), ('wall_time', result['wall_time']),
+                                        ('baseline_wall_time', baseline_result['wall_time']), ('ratio', ratio),
+                                        ('peak_memory', result['peak_memory']),
+                                        ('baseline_peak_memory', baseline_result['peak_memory']),
+                                        ('regression', ratio is not None and ratio > 1 + tolerance)]))
+
+    return comparisons
@@ -1,9 +1,11 @@
 import os
 import shutil
+import time
+import requests
 import tenacity
 
 from collections import OrderedDict
-from sentinelsat import SentinelAPI
+from sentinelsat import InvalidChecksumError, SentinelAPI, SentinelAPIError
 from pathlib import Path
 from absl import flags
 from loguru import logger
@@ -173,8 +175,8 @@ class Downloader(object):
 
         # The Sentinel-5p data has wrongly been given the filetype .zip, but it should be .nc, so make a copy with
         # .nc extension. A copy is made instead of renaming so sentinelsat doesn't re-download the file every time
-        # it is run.
-        s5p_downloaded_files = zipfiles_directory.glob('S5P*.zip')
+        # it is run (not needed when reading from the zip files, as the processor then reads the downloaded files).
+        s5p_downloaded_files = zipfiles_directory.glob('S5P*.zip') if not FLAGS.read_from_zip else []
         logger.debug("Renaming downloaded Sentinel-5p files from .zip to .nc (due to bug in SentinelSat)")
         for file in s5p_downloaded_files:
             if not file.with_suffix('.nc').exists():
@@ -188,6 +190,61 @@ class Downloader(object):
                 logger.info("Found corrupted downloads - will retry")
                 raise AssertionError()
 
+    def stream_zipfiles(self, on_downloaded, on_failed, max_attempts=200, retry_wait=1810):
+        """
+        Downloads the products one at a time, so each product can be processed as soon as it has been downloaded
+        instead of waiting for the entire order to be downloaded.
+
+        The products are downloaded in the order of their sensing time, such that all products from a date (which are
+        combined during processing) are downloaded close to each other. Products that cannot be downloaded (e.g. LTA
+        products, where the download triggers the retrieval from the long term archive) are retried every 30 min.
+
+        :param on_downloaded: Called with the product title when a product has been downloaded and verified
+        :param on_failed: Called with the product title and the error when a product could not be downloaded
+        :param max_attempts: Maximum number of download attempts for each product
+        :param retry_wait: Time to wait between the attempts [s]
+        """
+        zipfiles_directory = self.directory / 'zipfiles'
+        if not zipfiles_directory.exists():  # Create directory if it does not exist
+            os.makedirs(zipfiles_directory)
+
+        products_df = self.queried_products_as_df().sort_values('beginposition')
+        remaining_products = list(zip(products_df['uuid'].values, products_df['title'].values,
+                                      products_df['platformname'].values))
+        errors = {}
+        for attempt in range(max_attempts):
+            failed_products = []
+            for uuid, title, platformname in remaining_products:
+                api = self.api_s5p if platformname == 'Sentinel-5 Precursor' else self.api
+                try:
+                    # Already downloaded products are not downloaded again, and the checksum is verified by sentinelsat
+                    api.download(uuid, directory_path=zipfiles_directory, checksum=True)
+                except (SentinelAPIError, InvalidChecksumError, requests.ConnectionError, requests.Timeout) as e:
+                    # A corrupted download or lost connection only fails the product, which is retried in the next attempt
+                    logger.info(f"Could not download {title} (attempt {attempt + 1} of {max_attempts}): {e!r}")
+                    failed_products.append((uuid, title, platformname))
+                    errors[title] = e
+                    continue
+
+                # The Sentinel-5p data has wrongly been given the filetype .zip, but it should be .nc (see
+                # download_zipfiles())
+                if platformname == 'Sentinel-5 Precursor' and not FLAGS.read_from_zip:
+                    zip_path = (zipfiles_directory / title).with_suffix('.zip')
+                    if not zip_path.with_suffix('.nc').exists():
+                        shutil.copy(str(zip_path), str(zip_path.with_suffix('.nc')))
+                logger.info(f"Product has been downloaded: {title}")
+                on_downloaded(title)
+
+            remaining_products = failed_products
+            if not remaining_products:
+                break
+            if attempt < max_attempts - 1:
+                logger.info(f"Retrying download of {len(remaining_products)} product(s) in {retry_wait} seconds")
+                time.sleep(retry_wait)
+
+        for uuid, title, platformname in remaining_products:
+            on_failed(title, errors.get(title))
+
     def queried_products_as_geojson(self):
         return self.api.to_geojson(self.products)
 
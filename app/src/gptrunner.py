@@ -0,0 +1,189 @@
+import os
+import queue
+import re
+import shlex
+import signal
+import subprocess
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+# gpt prints the progress of a graph on a single line, e.g. '....10%....20%....30%...', so the output is read in chunks
+PROGRESS_PATTERN = re.compile(r'(\d{1,3})%')
+# Number of output lines kept to be included in the errors
+OUTPUT_TAIL_LINES = 50
+# Interval between checks of the time and memory limits [s]
+POLL_INTERVAL = 1
+
+
+class GptError(RuntimeError):
+    """
+    Raised when gpt exits with a non-zero exit code (or is killed by GptRunner).
+    """
+    def __init__(self, message, returncode=None, output_tail=''):
+        super().__init__(message)
+        self.message = message
+        self.returncode = returncode
+        self.output_tail = output_tail
+
+    def __reduce__(self):
+        # Keep all attributes when the error is passed from a pool process to the scheduler
+        return self.__class__, (self.message, self.returncode, self.output_tail)
+
+    def __str__(self):
+        if not self.output_tail:
+            return self.message
+        return f"{self.message}\nLast output from gpt:\n{self.output_tail}"
+
+
+class GptTimeoutError(GptError):
+    """
+    Raised when gpt exceeds its wall-clock limit, or has not printed anything for longer than its stall limit.
+    """
+
+
+class GptMemoryError(GptError):
+    """
+    Raised when the memory usage of gpt (incl. its child processes) exceeds its memory limit.
+    """
+
+
+class GptRunner(object):
+    """
+    Runs gpt (ESA SNAP graph processing tool) commands. The output is streamed to the log while gpt is running, its
+    progress percentages are reported to a callback, and gpt is killed if it exceeds the limits of the run, so a hung
+    or runaway JVM does not hold on to a processing slot.
+
+    Runs that are killed due to the wall-clock or stall limit are retried, whereas runs exceeding the memory limit or
+    exiting with a non-zero exit code raise an error right away (they are expected to fail the same way again).
+    """
+    def __init__(self, timeout=None, stall_timeout=None, max_memory=None, retries=0, on_progress=None):
+        """
+        :param timeout: Maximum wall-clock time of a run [s] (None => no limit)
+        :param stall_timeout: Maximum time without any output from gpt [s] (None => no limit)
+        :param max_memory: Maximum resident memory of gpt and its child processes [bytes] (None => no limit)
+        :param retries: Number of times a run is retried after it has been killed due to a time limit
+        :param on_progress: Function called with the name of the run and the progress [%] when gpt reports progress
+        """
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.max_memory = max_memory
+        self.retries = retries
+        self.on_progress = on_progress
+
+    def run(self, cmd, name=''):
+        """
+        Runs a gpt command, retrying it if it is killed due to a time limit.
+
+        :param cmd: The gpt command (e.g. 'gpt graph.xml -Pinput=...')
+        :param name: Name of the run used in the log and progress events (e.g. the product title)
+        :raises GptError: If gpt exits with a non-zero exit code (GptTimeoutError/GptMemoryError if it was killed)
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                return self.__run_once(cmd, name)
+            except GptTimeoutError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Retrying gpt run ({attempt + 1}/{self.retries}) for {name}: {e.message}")
+
+    def __run_once(self, cmd, name):
+        # Start gpt in its own process group, so the JVM started by the gpt launcher is killed along with it
+        process = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   start_new_session=True)
+        chunks = queue.Queue()
+        reader = threading.Thread(target=self.__read_output, args=(process.stdout, chunks), daemon=True)
+        reader.start()
+
+        output_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        line = ''
+        progress = None
+        started = last_output = time.time()
+        error = None
+        while True:
+            try:
+                chunk = chunks.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                chunk = ''
+            if chunk is None:  # End of output (gpt has exited)
+                break
+            now = time.time()
+            if chunk:
+                last_output = now
+                line += chunk
+                for percent in PROGRESS_PATTERN.findall(chunk):
+                    progress = int(percent)
+                    self.__report_progress(name, progress)
+                *lines, line = line.split('\n')
+                for output_line in lines:
+                    if output_line.strip():
+                        logger.debug(output_line.strip())
+                        output_tail.append(output_line.rstrip())
+
+            if self.timeout is not None and now - started > self.timeout:
+                error = GptTimeoutError(f"gpt exceeded the time limit of {self.timeout:.0f} s for {name} "
+                                        f"(progress: {progress}%)")
+            elif self.stall_timeout is not None and now - last_output > self.stall_timeout:
+                error = GptTimeoutError(f"gpt has not printed anything for {now - last_output:.0f} s for {name} "
+                                        f"(progress: {progress}%)")
+            elif self.max_memory is not None:
+                memory = get_process_tree_memory(process.pid)
+                if memory > self.max_memory:
+                    error = GptMemoryError(f"gpt used {memory / 1e9:.1f} GB, which exceeds the memory limit of "
+                                           f"{self.max_memory / 1e9:.1f} GB for {name}")
+            if error is not None:
+                self.__kill(process)
+                break
+
+        returncode = process.wait()
+        reader.join(timeout=POLL_INTERVAL)
+        if line.strip():
+            output_tail.append(line.rstrip())
+        if error is not None:
+            error.returncode, error.output_tail = returncode, '\n'.join(output_tail)
+            raise error
+        if returncode != 0:
+            raise GptError(f"gpt exited with exit code {returncode} for {name}", returncode=returncode,
+                           output_tail='\n'.join(output_tail))
+
+    @staticmethod
+    def __read_output(stream, chunks):
+        # read1() returns the output as soon as it is available instead of waiting for complete lines
+        for chunk in iter(lambda: stream.read1(4096), b''):
+            chunks.put(chunk.decode(errors='replace'))
+        chunks.put(None)
+
+    def __report_progress(self, name, progress):
+        logger.debug(f"gpt progress for {name}: {progress}%")
+        if self.on_progress is not None:
+            self.on_progress(name, progress)
+
+    @staticmethod
+    def __kill(process):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:  # Has already exited
+            pass
+
+
+def get_process_tree_memory(pid):
+    """
+    :param pid: Process id
+    :return: Resident memory of the process and all of its descendants [bytes]
+    """
+    memory = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/status') as status:
+                memory += [int(line.split()[1]) for line in status if line.startswith('VmRSS')][0] * 1024
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as children:
+                    pids.extend(int(child) for child in children.read().split())
+        except (OSError, IndexError):  # The process has exited (or is a zombie without VmRSS)
+            continue
+
+    return memory
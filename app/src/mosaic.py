@@ -0,0 +1,95 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window, from_bounds
+
+# Size of the windows of the mosaic [pixels] (a multiple of the 512 pixel blocks of the geotiffs)
+WINDOW_SIZE = 2048
+
+
+def get_source_windows(vrt):
+    """
+    :param vrt: Opened rasterio dataset of a vrt file
+    :return: List with the window of each source file of the vrt in the grid of the vrt
+    """
+    source_windows = []
+    for path in vrt.files[1:]:  # The first file is the vrt file itself
+        with rasterio.open(path) as src:
+            window = from_bounds(*src.bounds, transform=vrt.transform)
+        source_windows.append(window.round_offsets().round_lengths())
+    return source_windows
+
+
+def get_mosaic_windows(vrt, window_size=WINDOW_SIZE):
+    """
+    :param vrt: Opened rasterio dataset of a vrt file
+    :param window_size: Size of the windows [pixels]
+    :return: List with the windows of the vrt which are covered by at least one of its sources
+    """
+    source_windows = get_source_windows(vrt)
+    windows = []
+    for row_off in range(0, vrt.height, window_size):
+        for col_off in range(0, vrt.width, window_size):
+            window = Window(col_off, row_off, min(window_size, vrt.width - col_off),
+                            min(window_size, vrt.height - row_off))
+            if any(_intersects(window, source_window) for source_window in source_windows):
+                windows.append(window)
+    return windows
+
+
+def _intersects(window, other):
+    return (window.col_off < other.col_off + other.width and other.col_off < window.col_off + window.width and
+            window.row_off < other.row_off + other.height and other.row_off < window.row_off + window.height)
+
+
+def write_mosaic(vrt_path, dst_path, num_threads=0, window_size=WINDOW_SIZE):
+    """
+    Writes the mosaic of a vrt file to a tiled geotiff window by window, where the windows are read (ie. composed from
+    the sources of the vrt) by a pool of threads. Windows which are not covered by any of the sources (e.g. the sea
+    around the land of a country) are skipped and left as sparse (empty) blocks of the geotiff, which are read as the
+    nodata value.
+
+    :param vrt_path: Path to the vrt file
+    :param dst_path: Path to the geotiff
+    :param num_threads: Number of threads (0 => the number of cpus)
+    :param window_size: Size of the windows [pixels]
+    :return: Tuple with the number of windows which were written and the total number of windows
+    """
+    with rasterio.open(str(vrt_path)) as vrt:
+        profile = vrt.profile
+        windows = get_mosaic_windows(vrt, window_size=window_size)
+        num_windows = int(np.ceil(vrt.width / window_size) * np.ceil(vrt.height / window_size))
+        scales, offsets = vrt.scales, vrt.offsets
+
+    # The mosaic is written uncompressed with internal tiles (it is converted to a COG afterwards)
+    profile.update(driver='GTiff', tiled=True, blockxsize=512, blockysize=512, BIGTIFF='YES', SPARSE_OK='TRUE')
+    profile.pop('compress', None)
+
+    local = threading.local()
+    handles = []  # The vrt datasets of the threads (closed when done)
+    handles_lock = threading.Lock()
+    write_lock = threading.Lock()  # A rasterio dataset may only be used by one thread at a time
+
+    def process_window(window):
+        if not hasattr(local, 'vrt'):
+            local.vrt = rasterio.open(str(vrt_path))
+            with handles_lock:
+                handles.append(local.vrt)
+        data = local.vrt.read(window=window)
+        with write_lock:
+            dst.write(data, window=window)
+
+    dst = rasterio.open(str(dst_path), 'w', **profile)
+    try:
+        dst.scales, dst.offsets = scales, offsets
+        with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+            # list() raises the first error of the windows (if any)
+            list(executor.map(process_window, windows))
+    finally:
+        for dataset in [dst] + handles:
+            dataset.close()
+
+    return len(windows), num_windows
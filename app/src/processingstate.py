@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from loguru import logger
+
+
+def fingerprint(paths, params=None):
+    """
+    Creates a fingerprint of the inputs to a processing stage. Files are fingerprinted by their path, size and
+    modification time (reading the content of multi-GB rasters would take longer than most of the stages).
+
+    :param paths: Paths to the input files of the stage
+    :param params: Parameters of the stage (must be json serializable)
+    :return: Hex digest of the fingerprint
+    """
+    entries = []
+    for path in sorted(str(path) for path in paths):
+        try:
+            stat = os.stat(path)
+            entries.append([path, stat.st_size, stat.st_mtime_ns])
+        except FileNotFoundError:
+            entries.append([path, None, None])
+    entries.append(params)
+
+    return hashlib.sha1(json.dumps(entries, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ProcessingState(object):
+    """
+    On-disk database with the processing state of each stage (e.g. unzip, preprocess or cog) of each product or group
+    of products (e.g. a date and absolute orbit). Used to skip stages which have already been completed with the same
+    inputs, and to resume processing from where it stopped if it crashed.
+
+    The database is opened for each query (instead of keeping a connection) so the object can be pickled and used from
+    the processes in a multiprocessing pool.
+    """
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        if not self.db_path.parent.exists():  # Create directory if it does not exist
+            os.makedirs(self.db_path.parent)
+
+        with self.__connect() as connection:
+            # WAL allows the processes to read while another process is writing
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS stages ('
+                               'key TEXT NOT NULL, '
+                               'stage TEXT NOT NULL, '
+                               'status TEXT NOT NULL, '
+                               'fingerprint TEXT, '
+                               'outputs TEXT, '
+                               'pid INTEGER, '
+                               'started REAL, '
+                               'finished REAL, '
+                               'duration REAL, '
+                               'error TEXT, '
+                               'PRIMARY KEY (key, stage))')
+            connection.execute('CREATE TABLE IF NOT EXISTS memory_usage ('
+                               'stage TEXT PRIMARY KEY, '
+                               'peak_memory INTEGER NOT NULL, '
+                               'samples INTEGER NOT NULL)')
+
+    @contextmanager
+    def __connect(self):
+        connection = sqlite3.connect(str(self.db_path), timeout=600)
+        try:
+            with connection:  # Commits the transaction (or rolls it back on exceptions)
+                yield connection
+        finally:
+            connection.close()
+
+    def is_completed(self, key, stage, fingerprint=None):
+        """
+        Checks whether a stage has been completed, and whether its outputs still exist.
+
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param fingerprint: Fingerprint of the inputs to the stage (None => do not compare the inputs)
+        :return: True if the stage has been completed with the same inputs and all its outputs exist
+        """
+        with self.__connect() as connection:
+            row = connection.execute('SELECT status, fingerprint, outputs FROM stages WHERE key = ? AND stage = ?',
+                                     (key, stage)).fetchone()
+        if row is None:
+            return False
+        status, completed_fingerprint, outputs = row
+        if status != 'completed':
+            return False
+        if fingerprint is not None and fingerprint != completed_fingerprint:
+            logger.debug(f"Inputs have changed since stage '{stage}' was completed for {key}")
+            return False
+        missing_outputs = [output for output in json.loads(outputs or '[]') if not Path(output).exists()]
+        if missing_outputs:
+            logger.debug(f"Outputs of stage '{stage}' for {key} no longer exist: {missing_outputs}")
+            return False
+
+        return True
+
+    @contextmanager
+    def stage(self, key, stage, fingerprint=None, outputs=()):
+        """
+        Context manager which records the status and timing of a stage. The stage is recorded as running when entering
+        the context and as completed when leaving it (or as failed if an exception is raised).
+
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param fingerprint: Fingerprint of the inputs to the stage
+        :param outputs: Paths to the outputs of the stage. It is read when leaving the context, so a list can be
+                        passed and extended inside the context if the outputs are not known beforehand.
+        """
+        started = time.time()
+        self.__update(key, stage, 'running', fingerprint, (), started)
+        try:
+            yield
+        except BaseException as e:
+            self.__update(key, stage, 'failed', fingerprint, (), started, finished=time.time(), error=repr(e))
+            raise
+        self.__update(key, stage, 'completed', fingerprint, outputs, started, finished=time.time())
+
+    def get_stages(self, key):
+        """
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :return: Dict with the status and timings of each recorded stage of the product or group
+        """
+        with self.__connect() as connection:
+            rows = connection.execute('SELECT stage, status, started, finished, duration, error FROM stages '
+                                      'WHERE key = ?', (key,)).fetchall()
+
+        return {row[0]: {'status': row[1], 'started': row[2], 'finished': row[3], 'duration': row[4],
+                         'error': row[5]} for row in rows}
+
+    def get_peak_memory(self, stage):
+        """
+        :param stage: Name of the stage (e.g. 's1_tile')
+        :return: The highest peak memory usage [bytes] observed for the stage (None if it has not been observed)
+        """
+        with self.__connect() as connection:
+            row = connection.execute('SELECT peak_memory FROM memory_usage WHERE stage = ?', (stage,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def record_peak_memory(self, stage, peak_memory):
+        """
+        Records the peak memory usage of a stage. Only the highest observed peak is kept, so products where the stage
+        was skipped (and used almost no memory) do not lower the estimate.
+
+        :param stage: Name of the stage (e.g. 's1_tile')
+        :param peak_memory: Observed peak memory usage [bytes]
+        """
+        with self.__connect() as connection:
+            connection.execute('INSERT OR IGNORE INTO memory_usage (stage, peak_memory, samples) VALUES (?, ?, 0)',
+                               (stage, int(peak_memory)))
+            connection.execute('UPDATE memory_usage SET peak_memory = MAX(peak_memory, ?), samples = samples + 1 '
+                               'WHERE stage = ?', (int(peak_memory), stage))
+
+    def __update(self, key, stage, status, fingerprint, outputs, started, finished=None, error=None):
+        duration = None if finished is None else finished - started
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO stages '
+                               '(key, stage, status, fingerprint, outputs, pid, started, finished, duration, error) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               (key, stage, status, fingerprint, json.dumps([str(output) for output in outputs]),
+                                os.getpid(), started, finished, duration, error))
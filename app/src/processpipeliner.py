@@ -1,213 +1,283 @@
-from multiprocessing import Pool
-from pathlib import Path
-import shutil
 import os
+import threading
+from pathlib import Path
 
-import numpy as np
 import pandas as pd
 from absl import flags
-from tqdm import tqdm
 from loguru import logger
 
 from src.sentinelprocessors.s1processor import S1Processor
 from src.sentinelprocessors.s2processor import S2Processor
 from src.sentinelprocessors.s3processor import S3Processor
 from src.sentinelprocessors.s5processor import S5Processor
+from src.artifactcache import ArtifactCache
+from src.processingstate import ProcessingState
+from src.shiftcache import ShiftCache
+from src.productnames import parse_product_names
+from src.scheduler import TaskScheduler, get_memory_budget
+from src.tracing import get_trace_path
+from src.workers import init_worker, run_processor
 
 FLAGS = flags.FLAGS
 
+# Large columns from SentinelSat which are not used by the processors (they are dropped to keep the processors small,
+# as the processors are copied to every pool process)
+UNUSED_COLUMNS = ['footprint', 'gmlfootprint', 'summary', 'link', 'link_alternative', 'link_icon', 'identifier']
+
 
 class ProcessPipeliner(object):
-    def __init__(self, products_df, directory=Path('/data/')):
+    def __init__(self, products_df, directory=Path('/data/'), footprint=None):
         self.directory = directory
+        self.footprint = footprint  # Area of interest as WKT (used to subset the Sentinel-1 products)
         self.pbar = None
         self.products_df = self.__concat_product_paths(products_df)
         self.satellite = FLAGS.satellite
         self.s1_num_proc = FLAGS.s1_num_proc
         self.s2_num_proc = FLAGS.s2_num_proc
+        # Shared by all orders, as the products of different orders can overlap
+        self.state = ProcessingState(self.directory / 'orders' / 'processing_state.sqlite')
+        # Co-registration shifts of the acquisitions, shared by all orders
+        self.shifts = ShiftCache(self.directory / 'orders' / 'coregistration_shifts.sqlite')
+        # Outputs of the stages, shared by all orders (None => the outputs are not cached)
+        self.cache = (ArtifactCache(FLAGS.cache_directory,
+                                    max_size=FLAGS.cache_max_gb * 1e9 if FLAGS.cache_max_gb > 0 else None)
+                      if FLAGS.cache_directory else None)
+        # Memory that the processes may use in total (leave 10% of the memory for the OS and this process by default)
+        self.memory_budget = get_memory_budget(FLAGS.memory_budget_gb)
+
+    def process_products(self, downloader=None):
+        """
+        Processes the products of the selected satellite(s). All products are processed with the same scheduler, so
+        e.g. Sentinel-2 tiles are processed while the Sentinel-1 tiles of a date are being combined.
+
+        :param downloader: Downloader to stream the products from. If provided, the products are downloaded while the
+                           processing is running, and each product is processed as soon as it has been downloaded.
+        """
+        platformnames = {'s1': 'Sentinel-1', 's2': 'Sentinel-2', 's3': 'Sentinel-3', 's5p': 'Sentinel-5 Precursor'}
+        processor_classes = {'s1': S1Processor, 's2': S2Processor, 's3': S3Processor, 's5p': S5Processor}
+        kinds = list(platformnames.keys()) if self.satellite == 'all' else [self.satellite]
+        processors = {}
+        for kind in kinds:
+            products_df = self.products_df[self.products_df['platformname'] == platformnames[kind]]
+            products_df = products_df.drop(columns=[c for c in UNUSED_COLUMNS if c in products_df.columns])
+            if kind == 's1':
+                processors[kind] = S1Processor(products_df, self.directory, state=self.state, footprint=self.footprint,
+                                               cache=self.cache, shifts=self.shifts)
+            elif kind == 's2':
+                processors[kind] = S2Processor(products_df, self.directory, state=self.state, cache=self.cache,
+                                               shifts=self.shifts)
+            else:
+                processors[kind] = processor_classes[kind](products_df, self.directory, state=self.state,
+                                                           cache=self.cache)
+
+        # Prepare the reference images of the co-registration once, before the dates are co-registered in parallel
+        if 's1' in processors and FLAGS.s1_coregister:
+            processors['s1'].prepare_references()
+        if 's2' in processors:
+            processors['s2'].prepare_references()
+
+        # Use a single pool for the entire run, where each process gets the processors once when it is started, so the
+        # tasks only carry the name of the processor method and the index of the product
+        limits = {'s1': self.s1_num_proc, 's2': self.s2_num_proc, 's3': os.cpu_count(), 's5p': os.cpu_count()}
+        scheduler = TaskScheduler(num_proc=max(limits[kind] for kind in kinds), memory_budget=self.memory_budget,
+                                  state=self.state, limits=limits, initializer=init_worker,
+                                  initargs=(processors, FLAGS.gdal_cache_max_gb * 1e9, get_trace_path()))
+
+        # When streaming, every product has an external download task which its processing depends on
+        download_tasks = {}
+        if downloader is not None:
+            for title in self.products_df['title'].values:
+                download_tasks[title] = [scheduler.add_external_task('download_' + title)]
+
+        s1_groups, s2_groups = [], []
+        if 's1' in processors:
+            s1_groups = self.__add_s1_tasks(scheduler, processors['s1'], download_tasks)
+        if 's2' in processors:
+            s2_groups = self.__add_s2_tasks(scheduler, processors['s2'], download_tasks)
+        if 's3' in processors:
+            self.__add_product_tasks(scheduler, processors['s3'], download_tasks, 's3')
+        if 's5p' in processors:
+            self.__add_product_tasks(scheduler, processors['s5p'], download_tasks, 's5p')
+
+        if downloader is not None:
+            logger.info("Streaming products from the downloader to the processing")
+            download_thread = threading.Thread(target=self.__stream_downloads, args=(downloader, scheduler),
+                                               daemon=True)
+            download_thread.start()
+        tasks = scheduler.run()
+
+        for failed_product in [name for name in s1_groups if tasks[name].status != 'done']:
+            logger.info(f"Following product failed processing: {failed_product}")
+        for name in s2_groups:
+            # The result of a date is the result of each mode, and the error of a failed date names its failed modes
+            if tasks[name].status == 'done':
+                logger.info(f"Sentinel-2 date {name} has been processed: " +
+                            ', '.join(f'{mode} {result}' for mode, result in tasks[name].result.items()))
+            else:
+                logger.info(f"Following Sentinel-2 date failed processing ({tasks[name].status}): {name} "
+                            f"({tasks[name].result!r})")
+
+    def __stream_downloads(self, downloader, scheduler):
+        # Complete the download tasks when the products have been downloaded (and mark the remaining ones as failed if
+        # the downloader stops, so the scheduler does not wait for them forever)
+        remaining_titles = set(self.products_df['title'].values)
+
+        def on_downloaded(title):
+            if title in remaining_titles:
+                remaining_titles.discard(title)
+                scheduler.complete_external_task('download_' + title)
+
+        def on_failed(title, error=None):
+            if title in remaining_titles:
+                remaining_titles.discard(title)
+                scheduler.complete_external_task('download_' + title, success=False, result=error)
+
+        try:
+            downloader.stream_zipfiles(on_downloaded=on_downloaded, on_failed=on_failed)
+        except Exception as e:
+            logger.exception(f"Downloader failed: {e!r}")
+        finally:
+            for title in list(remaining_titles):
+                on_failed(title, RuntimeError('Product was not downloaded'))
 
-    def process_products(self):
-        if self.satellite == 's1' or self.satellite == 'all':
-            logger.info("### Processing Sentinel-1 products ###")
-            s1_products_df = self.products_df[self.products_df['platformname'] == 'Sentinel-1']
-            s1processor = S1Processor(s1_products_df, self.directory)
-            # Create folders now to avoid multiple processes trying to create the same folder later (leads to errors)
-            s1processor.create_parent_folders()
-
-            # Create a vrt for each product date
-            s1_titles = s1_products_df['title'].values
-            # Get the product data and absolute orbit to get a unique identifier for each Sentinel-1 pass
-            product_dates_abs_orbits = [(title[17:25] + title[48:55]) for title in s1_titles]
-            product_dates_abs_orbits = np.unique(product_dates_abs_orbits)
-            
-            # TODO: To improve processing speed, run the parallel processing (ie. pool.map()) over the 
-            #       product_date_abs_orbit instead of the individual tiles inside the for-loop (just remove
-            #       the pool.map() of the individual tiles and use a for-loop to iterate through the tiles). 
-            #       This would results in the co-registration and the vrt_to_geotiff running in parallel, 
-            #       which should significantly decrease the processing time. Note that the the maximum number
-            #       of processes should be kept the same, as multiple number of tiles will be processed in parallel,
-            #       though not from the necessarily from the same date. In general, always try to perform the 
-            #       parallelization on the outer-most for-loop. The downside is that if the scene to processed
-            #       is from a single date with multiple tiles, there will be no parallization (except for the 
-            #       built-in in some of the used processing functions). But that should be fine. Generally, when
-            #       there is a big need for parallization, it is because data from multiple dates are being 
-            #       processed. For single-date datasets, the user can wait a bit longer.
-
-            # TODO: Get the check for processed products finalized
-            # pseudo-code to check all previously processed products
-            output_directory = Path(FLAGS.output_directory)
-            processed_date_abs_orbits = []
-            if output_directory.exists():
-                filenames = list(output_directory.glob('*.tif'))
-                processed_date_abs_orbits = [filename.stem[4:19] for filename in filenames]
-                #for processed_date_abs_orbit in sorted(processed_date_abs_orbits):
-                #    logger.info(f"Date and abs orbit has been processed: {processed_date_abs_orbit}")
-
-            failed_product_date_abs_orbit = []
-            for product_date_abs_orbit in tqdm(product_dates_abs_orbits):
-                # NOTE: The code below is used for the Elsevier paper. Be careful when using it. The s1_products_df_date
-                #       should be properly implemented, and so should the co-registering of Sentinel-1 data.
-                if product_date_abs_orbit not in processed_date_abs_orbits:
-                    try:
-                        # Process the individual tiles
-                        date = product_date_abs_orbit[:8]
-                        abs_orbit = product_date_abs_orbit[9:]
-                        s1_products_df_date = s1_products_df[s1_products_df['title'].str.contains(date)]
-                        s1_products_df_date = s1_products_df_date[s1_products_df_date['title'].str.contains(abs_orbit)]
-                        s1processor.products_df = s1_products_df_date.copy()
-
-                        # Multiprocessing method from here: https://stackoverflow.com/a/5442981/12045808 (if you want tqdm then look
-                        # here https://github.com/tqdm/tqdm/issues/484#issuecomment-353383768)
-                        index_arg = range(len(s1_products_df_date))
-                        with Pool(processes=self.s1_num_proc) as pool:
-                            pool.map(s1processor.process, index_arg)
-
-                        # Create the vrt with the combined tiles
-                        vrt_path = s1processor.create_vrt_and_cog(product_date_abs_orbit, create_thumbnail=True)
-
-                        # Co-register
-                        if FLAGS.s1_coregister:
-                            logger.info("Co-registering")
-                            coreg_path = (vrt_path.parent / f'{vrt_path.stem}_coreg').with_suffix('.tif')
-                            s1processor.temp_coregister_function_for_elsevier_intepretability_paper(vrt_path, coreg_path)
-
-                        # Move to final output path
-                        if FLAGS.move_to_output_directory and FLAGS.output_directory is not None:
-                            tif_path = vrt_path.with_suffix('.tif')
-                            png_path = vrt_path.with_suffix('.png')
-    #                         coreg_new_path = (Path(FLAGS.output_path) / vrt.name).with_suffix('.tif')
-                            new_output_dir = Path(FLAGS.output_directory)
-                            tif_new_path = new_output_dir / tif_path.name
-                            png_new_path = new_output_dir / png_path.name
-                            if not tif_new_path.parent.exists():  # Create directory if it does not exist
-                                os.makedirs(tif_new_path.parent)
-                            logger.info(f"Moving {str(png_path)} to output directory {str(png_new_path)}")
-                            shutil.move(png_path, png_new_path)
-                            logger.info(f"Finished moving {str(png_path)} to output directory {str(png_new_path)}")
-                            logger.info(f"Moving {str(tif_path)} to output directory {str(tif_new_path)}")
-                            shutil.move(tif_path, tif_new_path)
-                            logger.info(f"Finished moving {str(tif_path)} to output directory {str(tif_new_path)}")
-                        else:
-                            pass
-
-                        if FLAGS.s1_del_intermediate:
-                            # Delete all the individual tile data. Used for Elsevier paper due to lack of storage capacity.
-                            logger.info("Deleting output_data/s1/GRD folder")
-                            grd_data_path = Path('data/output/output_data/s1/GRD')
-                            shutil.rmtree(grd_data_path)
-                    except:
-                        logger.info(f"Following date and absolute orbit failed: {product_date_abs_orbit}")
-                        failed_product_date_abs_orbit.append(product_date_abs_orbit)
-                else:
-                    logger.info(f"Date and absolute orbit has already been processed: {product_date_abs_orbit}")
-
-            for failed_product in failed_product_date_abs_orbit:
-                logger.info(f"Following product failed processing: {failed_product}")
-
-        if self.satellite == 's2' or self.satellite == 'all':
-            logger.info("### Processing Sentinel-2 products ###")
-            s2_products_df = self.products_df[self.products_df['platformname'] == 'Sentinel-2']
-            s2processor = S2Processor(s2_products_df, self.directory)
-
-            # Process the individual tiles
-            # Note: Multiprocessing method from here: https://stackoverflow.com/a/5442981/12045808 (if you want tqdm
-            # then look here https://github.com/tqdm/tqdm/issues/484#issuecomment-353383768)
-            index_arg = range(len(s2_products_df))
-            with Pool(processes=self.s2_num_proc) as pool:
-                pool.map(s2processor.process_tiles, index_arg)
-            # parmap.map(s2processor.process_tiles, index_arg, pm_pbar=True, pm_processes=2)
-
-            # Combine the tiles by creating vrt files and coregister each vrt file and save as geotiff.
-            s2processor.create_vrt_files_and_coregister()
-
-        if self.satellite == 's3' or self.satellite == 'all':
-            logger.info("### Processing Sentinel-3 products ###")
-            s3_products_df = self.products_df[self.products_df['platformname'] == 'Sentinel-3']
-            s3processor = S3Processor(s3_products_df, self.directory)
-            index_arg = range(len(s3_products_df))
-            with Pool(processes=6) as pool:
-                pool.map(s3processor.process, index_arg)
-
-        if self.satellite == 's5p' or self.satellite == 'all':
-            logger.info("### Processing Sentinel-5p products ###")
-            s5_products_df = self.products_df[self.products_df['platformname'] == 'Sentinel-5 Precursor']
-            s5processor = S5Processor(s5_products_df, self.directory)
-            index_arg = range(len(s5_products_df))
-            with Pool(processes=6) as pool:
-                pool.map(s5processor.process, index_arg)
+    def __add_s1_tasks(self, scheduler, s1processor, download_tasks):
+        logger.info("### Processing Sentinel-1 products ###")
+        s1_products_df = s1processor.products_df
+        # Create folders now to avoid multiple processes trying to create the same folder later (leads to errors)
+        s1processor.create_parent_folders()
+
+        # Create a vrt for each product date and absolute orbit, which is a unique identifier for each Sentinel-1 pass
+        s1_titles = s1_products_df['title'].values
+        product_dates_abs_orbits = s1processor.get_groups()
+
+        # Check for previously processed products. Dates and absolute orbits which have been published with the
+        # current settings are found in the processing state, and the output directory is checked for the ones
+        # that were processed before the processing state was recorded.
+        output_directory = Path(FLAGS.output_directory)
+        processed_date_abs_orbits = []
+        if output_directory.exists():
+            filenames = list(output_directory.glob('*.tif'))
+            processed_date_abs_orbits = [filename.stem[4:19] for filename in filenames]
+        if FLAGS.resume:
+            publish_fingerprint = s1processor.publish_fingerprint()
+            processed_date_abs_orbits += [name for name in product_dates_abs_orbits
+                                          if self.state.is_completed(name, 'publish', publish_fingerprint)]
+        processed_date_abs_orbits = set(processed_date_abs_orbits)
+
+        # Parallelize over the dates and absolute orbits instead of only the tiles inside each of them. Every tile
+        # is a task, and the combination of the tiles (ie. vrt, cog, co-registration and moving to the output
+        # directory) is a task that is started as soon as all tiles of its date and absolute orbit are processed.
+        # This way the combination of one date runs while the tiles of the next dates are being processed, with
+        # the same maximum number of processes as before.
+        groups = []
+        for product_date_abs_orbit in product_dates_abs_orbits:
+            # NOTE: The code below is used for the Elsevier paper. Be careful when using it. The s1_products_df_date
+            #       should be properly implemented, and so should the co-registering of Sentinel-1 data.
+            if product_date_abs_orbit not in processed_date_abs_orbits:
+                tile_tasks = []
+                for index in s1processor.get_date_abs_orbit_indices(product_date_abs_orbit):
+                    title = s1_titles[index]
+                    tile_tasks.append(scheduler.add_task(title, run_processor, args=('s1', 'process', index),
+                                                         depends_on=download_tasks.get(title, ()),
+                                                         memory=FLAGS.s1_tile_memory_gb * 1e9, memory_stage='s1_tile',
+                                                         kind='s1'))
+                groups.append(scheduler.add_task(product_date_abs_orbit, run_processor,
+                                                 args=('s1', 'process_date_abs_orbit', product_date_abs_orbit),
+                                                 depends_on=tile_tasks, priority=1,
+                                                 memory=FLAGS.s1_combine_memory_gb * 1e9,
+                                                 memory_stage='s1_date_abs_orbit', kind='s1'))
+            else:
+                logger.info(f"Date and absolute orbit has already been processed: {product_date_abs_orbit}")
+
+        return groups
+
+    def __add_s2_tasks(self, scheduler, s2processor, download_tasks):
+        logger.info("### Processing Sentinel-2 products ###")
+        s2_titles = s2processor.products_df['title'].values
+        s2_modes = ['TCI'] + (list(s2processor.indices) if s2processor.calc_ndvi else [])
+
+        # Process the individual tiles, and combine the tiles of each date by creating vrt files and coregister each
+        # vrt file and save as geotiff (as soon as all tiles from the date have been processed)
+        groups = []
+        for product_date in s2processor.get_product_dates():
+            tile_tasks = []
+            for index in s2processor.get_date_indices(product_date):
+                title = s2_titles[index]
+                tile_tasks.append(scheduler.add_task(title, run_processor, args=('s2', 'process_tiles', index),
+                                                     depends_on=download_tasks.get(title, ()),
+                                                     memory=FLAGS.s2_tile_memory_gb * 1e9, memory_stage='s2_tile',
+                                                     kind='s2'))
+            groups.append(scheduler.add_task('S2_' + product_date, run_processor,
+                                             args=('s2', 'create_vrt_and_coregister_modes', s2_modes, product_date),
+                                             depends_on=tile_tasks, priority=1, memory=FLAGS.s2_tile_memory_gb * 1e9,
+                                             memory_stage='s2_date', kind='s2'))
+
+        return groups
+
+    @staticmethod
+    def __add_product_tasks(scheduler, processor, download_tasks, kind):
+        logger.info(f"### Processing {kind.upper()} products ###")
+        for index, title in enumerate(processor.products_df['title'].values):
+            scheduler.add_task(title, run_processor, args=(kind, 'process', index),
+                               depends_on=download_tasks.get(title, ()),
+                               memory=getattr(FLAGS, f'{kind}_memory_gb') * 1e9, memory_stage=f'{kind}_product',
+                               kind=kind)
 
     def __concat_product_paths(self, products_df):
         """
-        Concatenates the folder paths required for processing.
+        Parses the product names and concatenates the folder paths required for processing. The metadata and paths are
+        computed for all products of each satellite at once, instead of row by row.
 
         :param products_df: Dataframe with all products (as returned from SentinelSat)
-        :return: An updated dataframe with product paths concatenated to the products
+        :return: An updated dataframe with the parsed metadata (see parse_product_names) and product paths concatenated
+                 to the products
         """
-        products_df[['tile_path', 'product_path', 'product_type']] = \
-            products_df.apply(self.__get_product_path, directory=self.directory, axis=1)
-
-        return products_df
+        products_df = parse_product_names(products_df)
+        output_data_path = self.directory / 'output_data'
+        tile_paths = pd.Series("", index=products_df.index, dtype=object)
+        product_paths = pd.Series("", index=products_df.index, dtype=object)
+        product_types = pd.Series("", index=products_df.index, dtype=object)
 
-    @staticmethod
-    def __get_product_path(row, directory):
-        if row.platformname == 'Sentinel-1':
+        is_s1 = products_df['platformname'] == 'Sentinel-1'
+        if is_s1.any():
             # Directory structure from here: https://roda.sentinel-hub.com/sentinel-s1-l1c/GRD/readme.html
             # Note: The polarisation part of the directory structure has been skipped here
-            product = row['title']
-            product_type = row['producttype']
-            begin_time = row['beginposition']
-            year, month, day = str(begin_time)[0:4], str(begin_time)[5:7], str(begin_time)[8:10]
-            mode = row['sensoroperationalmode']
-            product_path = (directory / 'output_data' / 's1' / product_type / year / month /
-                            day / mode / product).with_suffix('.SAFE')
-            tile_path = ""
-
-        elif row.platformname == 'Sentinel-2':
-            # Get product directory path
-            product = row['title']
-            utm_code = product[39:41]  # e.g. 10
-            latitude_band = product[41:42]  # e.g. S
-            square = product[42:44]  # e.g. DG
-            tile_path = directory / 'output_data' / 's2' / 'tiles' / utm_code / latitude_band / square
-            product_path = (tile_path / product).with_suffix('.SAFE')
-
-            # Damn you ESA for making an extra subfolder under granule!
-            # Note: The following only works for some products - so you have to unzip the products before processing
-            # abs_orbit_num = str(row.orbitnumber).zfill(6)  # zfill adds zeroes in front so we always have 6 digits
-            # damn = product[7:11] + 'T' + utm_code + latitude_band + square + '_A' + abs_orbit_num + '_' + product[
-            #                                                                                               11:26]
-            # res_10m_path = granule_path / damn / 'IMG_DATA' / 'R10m/'
-            # res_20m_path = granule_path / damn / 'IMG_DATA' / 'R20m/'
-            # res_60m_path = granule_path / damn / 'IMG_DATA' / 'R60m/'
-            product_type = ""
-        elif row.platformname == 'Sentinel-3':
-            product = row['title']
-            instrument = row['instrumentshortname']
-            product_type = row['producttype'][:-3]  # The [:-3] removes three underscores at the end
-            product_path = (directory / 'output_data' / 's3' / instrument / product_type / product).with_suffix('.SEN3')
-            tile_path = ""
-        elif row.platformname == 'Sentinel-5 Precursor':
-            producttype = row['producttypedescription']
+            s1_df = products_df[is_s1]
+            begin_times = s1_df['beginposition'].astype(str)
+            product_paths[is_s1] = pd.Series(
+                [(output_data_path / 's1' / product_type / year / month / day / mode / product).with_suffix('.SAFE')
+                 for product, product_type, year, month, day, mode
+                 in zip(s1_df['title'], s1_df['producttype'], begin_times.str[0:4], begin_times.str[5:7],
+                        begin_times.str[8:10], s1_df['sensoroperationalmode'])],
+                index=s1_df.index, dtype=object)
+            product_types[is_s1] = s1_df['producttype']
+
+        is_s2 = products_df['platformname'] == 'Sentinel-2'
+        if is_s2.any():
+            # Damn you ESA for making an extra subfolder under granule! The tiles are found when the products have
+            # been unzipped, so only the tile directory (e.g. 10/S/DG) is concatenated here
+            s2_df = products_df[is_s2]
+            s2_tile_paths = [output_data_path / 's2' / 'tiles' / utm_zone / latitude_band / grid_square
+                             for utm_zone, latitude_band, grid_square
+                             in zip(s2_df['utm_zone'], s2_df['latitude_band'], s2_df['grid_square'])]
+            tile_paths[is_s2] = pd.Series(s2_tile_paths, index=s2_df.index, dtype=object)
+            product_paths[is_s2] = pd.Series(
+                [(tile_path / product).with_suffix('.SAFE') for tile_path, product in zip(s2_tile_paths, s2_df['title'])],
+                index=s2_df.index, dtype=object)
+
+        is_s3 = products_df['platformname'] == 'Sentinel-3'
+        if is_s3.any():
+            s3_df = products_df[is_s3]
+            s3_product_types = s3_df['producttype'].str[:-3]  # The [:-3] removes three underscores at the end
+            product_paths[is_s3] = pd.Series(
+                [(output_data_path / 's3' / instrument / product_type / product).with_suffix('.SEN3')
+                 for product, instrument, product_type
+                 in zip(s3_df['title'], s3_df['instrumentshortname'], s3_product_types)],
+                index=s3_df.index, dtype=object)
+            product_types[is_s3] = s3_product_types
+
+        is_s5p = products_df['platformname'] == 'Sentinel-5 Precursor'
+        if is_s5p.any():
             producttype_name_mapping = {'Ozone': 'O3',
                                         'Sulphur Dioxide': 'SO2',
                                         'Nitrogen Dioxide': 'NO2',
@@ -217,11 +287,12 @@ class ProcessPipeliner(object):
                                         'Aerosol Index': 'AER_AI',
                                         'Aerosol Layer Height': 'AER_LH',
                                         'Cloud': 'CLOUD'}
-            product_path = directory / 'output_data' / 's5p'
-            product_type = producttype_name_mapping[producttype]
-            tile_path = ""
-        else:
-            tile_path, product_path, product_type = "", "", ""
+            product_paths[is_s5p] = pd.Series([output_data_path / 's5p'] * int(is_s5p.sum()),
+                                              index=products_df.index[is_s5p], dtype=object)
+            product_types[is_s5p] = products_df.loc[is_s5p, 'producttypedescription'].map(producttype_name_mapping)
 
-        return pd.Series([tile_path, product_path, product_type])
+        products_df['tile_path'] = tile_paths
+        products_df['product_path'] = product_paths
+        products_df['product_type'] = product_types
 
+        return products_df
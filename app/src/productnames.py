@@ -0,0 +1,66 @@
+import pandas as pd
+
+# Sentinel-1 naming convention, e.g. S1A_IW_GRDH_1SDV_20190803T053407_20190803T053432_028412_033562_9A1C
+# (https://sentinel.esa.int/web/sentinel/user-guides/sentinel-1-sar/naming-conventions)
+S1_NAME_PATTERN = (r'^(?P<mission>S1[AB])_(?P<mode>[A-Z0-9]{2})_(?P<product_class>[A-Z_]{4})_(?P<polarisation>\w{4})_'
+                   r'(?P<start_time>\d{8}T\d{6})_(?P<stop_time>\d{8}T\d{6})_(?P<abs_orbit>\d{6})_'
+                   r'(?P<datatake_id>[0-9A-F]{6})_(?P<product_id>[0-9A-F]{4})$')
+
+# Sentinel-2 naming convention, e.g. S2A_MSIL2A_20190803T103031_N0213_R108_T32UNG_20190803T134337
+# (https://sentinel.esa.int/web/sentinel/user-guides/sentinel-2-msi/naming-convention)
+S2_NAME_PATTERN = (r'^(?P<mission>S2[AB])_MSI(?P<level>\w{3})_(?P<sensing_time>\d{8}T\d{6})_N(?P<baseline>\d{4})_'
+                   r'R(?P<rel_orbit>\d{3})_T(?P<utm_zone>\d{2})(?P<latitude_band>[A-Z])(?P<grid_square>[A-Z]{2})_'
+                   r'(?P<discriminator>\d{8}T\d{6})$')
+
+PASS_MODE_ABBREVIATIONS = {'ASCENDING': 'ASC', 'DESCENDING': 'DSC'}
+
+
+def parse_product_names(products_df):
+    """
+    Parses the names (titles) of the Sentinel-1 and Sentinel-2 products in a single vectorized pass, and adds typed
+    columns with the metadata used for processing. Products from other missions get missing values in the columns.
+
+    Added columns:
+        mission (str): e.g. 'S1A' or 'S2B'
+        date (str): Sensing date, e.g. '20190803'
+        sensing_time (datetime): Sensing (start) time
+        abs_orbit (int): Absolute orbit number (Sentinel-1)
+        rel_orbit (int): Relative orbit number
+        pass_mode (str): 'ASC' or 'DSC' (Sentinel-1, if the orbit direction is in the dataframe)
+        utm_zone, latitude_band, grid_square (str): Parts of the MGRS tile (Sentinel-2), e.g. '32', 'U' and 'NG'
+        mgrs_tile (str): MGRS tile (Sentinel-2), e.g. '32UNG'
+        group (str): Products which are combined during processing; the date and absolute orbit for Sentinel-1
+                     (e.g. '20190803_028412') and the date for Sentinel-2
+
+    :param products_df: Dataframe with all products (as returned from SentinelSat)
+    :return: The dataframe with the added columns
+    """
+    titles = products_df['title'].astype(str)
+    s1_names = titles.str.extract(S1_NAME_PATTERN)
+    s2_names = titles.str.extract(S2_NAME_PATTERN)
+    is_s1 = s1_names['mission'].notna()
+
+    products_df['mission'] = s1_names['mission'].where(is_s1, s2_names['mission'])
+    sensing_time = s1_names['start_time'].where(is_s1, s2_names['sensing_time'])
+    products_df['date'] = sensing_time.str[:8]
+    products_df['sensing_time'] = pd.to_datetime(sensing_time, format='%Y%m%dT%H%M%S', errors='coerce')
+    products_df['abs_orbit'] = pd.to_numeric(s1_names['abs_orbit']).astype('Int64')
+
+    # The relative orbit of Sentinel-1 is not in the name, but it is part of the metadata from SentinelSat
+    rel_orbit = pd.to_numeric(s2_names['rel_orbit'])
+    if 'relativeorbitnumber' in products_df.columns:
+        rel_orbit = rel_orbit.where(~is_s1, pd.to_numeric(products_df['relativeorbitnumber'], errors='coerce'))
+    products_df['rel_orbit'] = rel_orbit.astype('Int64')
+    if 'orbitdirection' in products_df.columns:
+        products_df['pass_mode'] = products_df['orbitdirection'].map(PASS_MODE_ABBREVIATIONS).where(is_s1)
+    else:
+        products_df['pass_mode'] = None
+
+    products_df['utm_zone'] = s2_names['utm_zone']
+    products_df['latitude_band'] = s2_names['latitude_band']
+    products_df['grid_square'] = s2_names['grid_square']
+    products_df['mgrs_tile'] = s2_names['utm_zone'] + s2_names['latitude_band'] + s2_names['grid_square']
+
+    products_df['group'] = (products_df['date'] + '_' + s1_names['abs_orbit']).where(is_s1, products_df['date'])
+
+    return products_df
@@ -0,0 +1,25 @@
+import rasterio
+
+from src.bandmath import get_windows
+
+
+def mask_reference(src_path, mask_path, dst_path, nodata=0):
+    """
+    Embeds a bad data mask (e.g. of clouds or changed areas) in a reference image of the co-registration, by setting
+    the masked pixels to the nodata value, so the co-registration only needs the reference image. The image is masked
+    window by window, so it is never read into memory at once.
+
+    :param src_path: Path to the reference image
+    :param mask_path: Path to the mask, in the same grid as the reference image (non-zero => bad data)
+    :param dst_path: Path to the masked reference image (an uncompressed tiled geotiff)
+    :param nodata: Nodata value of the masked reference image
+    """
+    with rasterio.open(str(src_path)) as src, rasterio.open(str(mask_path)) as mask:
+        profile = src.profile
+        profile.update(driver='GTiff', tiled=True, blockxsize=512, blockysize=512, BIGTIFF='YES', nodata=nodata)
+        profile.pop('compress', None)
+        with rasterio.open(str(dst_path), 'w', **profile) as dst:
+            for window in get_windows(src):
+                data = src.read(window=window)
+                data[:, mask.read(1, window=window) != 0] = nodata
+                dst.write(data, window=window)
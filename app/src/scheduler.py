@@ -0,0 +1,296 @@
+import os
+import queue
+import time
+from collections import OrderedDict
+from multiprocessing import Pool, SimpleQueue, active_children
+
+from loguru import logger
+from tqdm import tqdm
+
+from src.tracing import measure_peak_memory, trace_span, write_trace_record
+
+# Memory estimates observed in earlier runs are multiplied by this to leave headroom for variations between products
+OBSERVED_MEMORY_MARGIN = 1.25
+# Interval [s] between the checks for pool processes which died while running a task (e.g. killed by the OOM killer)
+WORKER_CHECK_INTERVAL = 10
+
+# Queue used by the pool processes to report which process has started a task (see init_pool_process())
+started_tasks = None
+
+
+def get_total_memory():
+    """
+    :return: Total physical memory of the machine [bytes]
+    """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_memory_budget(memory_budget_gb=0):
+    """
+    :param memory_budget_gb: Total RAM the processes may use [GB] (0 => 90% of the physical memory)
+    :return: Memory budget of a scheduler [bytes]
+    """
+    return memory_budget_gb * 1e9 if memory_budget_gb > 0 else 0.9 * get_total_memory()
+
+
+def init_pool_process(started_queue, initializer=None, initargs=()):
+    """
+    Initializes a pool process of the scheduler.
+
+    :param started_queue: Queue for reporting the started tasks to the scheduler
+    :param initializer: Function run once in the pool process (see src.workers.init_worker)
+    :param initargs: Arguments for the initializer
+    """
+    global started_tasks
+    started_tasks = started_queue
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def run_task(name, stage, func, args):
+    """
+    Runs a task in a pool process and measures the peak memory usage of the task, including child processes (e.g. the
+    gpt processes of ESA SNAP). The task is recorded as a span in the trace file (if tracing is enabled).
+
+    :return: Tuple with the result of the task and its peak memory usage [bytes] (None if it could not be measured)
+    """
+    if started_tasks is not None:
+        started_tasks.put((name, os.getpid()))
+    with trace_span(stage, product=name, category='task'):
+        with measure_peak_memory() as measurement:
+            result = func(*args)
+
+    return result, measurement.peak_memory
+
+
+class Task(object):
+    def __init__(self, name, func, args=(), depends_on=(), priority=0, memory=0, memory_stage=None, kind=None):
+        self.name = name
+        self.func = func  # None => external task, which is completed with TaskScheduler.complete_external_task()
+        self.args = args
+        self.depends_on = list(depends_on)
+        self.priority = priority
+        self.kind = kind  # Used to limit the number of running tasks of the same kind (e.g. 's1')
+        self.memory = memory  # Estimated memory usage [bytes]
+        self.memory_stage = memory_stage  # Name used to look up and record the observed memory usage
+        self.reserved_memory = 0
+        self.peak_memory = None
+        self.pid = None  # Pool process running the task
+        self.status = 'pending'  # pending -> running -> done/failed/skipped
+        self.result = None
+
+
+class TaskScheduler(object):
+    """
+    Runs tasks in a pool of processes as soon as the tasks they depend on have finished.
+
+    Never more than num_proc tasks are handed to the pool at a time, and ready tasks with a higher priority are
+    started first. This makes it possible to e.g. combine the tiles of one date while the tiles of the next dates are
+    still being processed, instead of waiting for all tiles to finish before the combination can start.
+
+    If a memory budget is given, a task is only started when its estimated memory usage fits within the budget next to
+    the tasks which are already running. The estimate of a task is its configured memory usage, or the peak memory usage
+    observed for its memory_stage in earlier tasks and runs (if a processing state is given).
+
+    External tasks are not run by the scheduler, but are completed from another thread (e.g. when a product has been
+    downloaded), which allows tasks to start while their inputs are still being produced elsewhere.
+
+    A pool process which dies while running a task (e.g. killed by the OOM killer) never returns the result of the task,
+    so the pool processes are checked regularly, and the task of a dead process fails instead of blocking the run.
+    """
+    def __init__(self, num_proc, memory_budget=None, state=None, limits=None, initializer=None, initargs=()):
+        """
+        :param num_proc: Maximum number of tasks running at the same time
+        :param memory_budget: Memory [bytes] that the running tasks may use in total (None => no limit)
+        :param state: ProcessingState used to record and look up the observed memory usage of the tasks
+        :param limits: Dict with the maximum number of running tasks of each kind (e.g. {'s1': 2, 's2': 6})
+        :param initializer: Function run once in each pool process when it is started (see src.workers.init_worker)
+        :param initargs: Arguments for the initializer
+        """
+        self.num_proc = num_proc
+        self.memory_budget = memory_budget
+        self.state = state
+        self.limits = limits if limits is not None else {}
+        self.initializer = initializer
+        self.initargs = initargs
+        self.tasks = OrderedDict()
+        self.__completed = queue.Queue()  # Filled by the pool's result handler thread and external task threads
+        self.__started = None  # Filled by the pool processes with the started tasks (see init_pool_process())
+        self.__reserved_memory = 0
+
+    def add_task(self, name, func, args=(), depends_on=(), priority=0, memory=0, memory_stage=None, kind=None):
+        """
+        Adds a task to the scheduler. Tasks must be added before the scheduler is run.
+
+        :param name: Unique name of the task
+        :param func: Picklable function to run in the pool
+        :param args: Arguments for the function
+        :param depends_on: Names of the tasks that must be finished before this task is started
+        :param priority: Ready tasks with a higher priority are started first
+        :param memory: Estimated memory usage of the task [bytes]
+        :param memory_stage: Name of the processing stage, used to refine the estimate from observed memory usage
+        :param kind: Kind of the task (the number of running tasks of each kind can be limited with limits)
+        :return: The name of the task (to be used in depends_on of other tasks)
+        """
+        if name in self.tasks:
+            raise ValueError(f"Task has already been added to the scheduler: {name}")
+        self.tasks[name] = Task(name, func, args=args, depends_on=depends_on, priority=priority, memory=memory,
+                                memory_stage=memory_stage, kind=kind)
+        return name
+
+    def add_external_task(self, name):
+        """
+        Adds a task which is completed outside the scheduler with complete_external_task(). The scheduler keeps running
+        until all external tasks have been completed.
+
+        :param name: Unique name of the task
+        :return: The name of the task (to be used in depends_on of other tasks)
+        """
+        return self.add_task(name, None)
+
+    def complete_external_task(self, name, success=True, result=None):
+        """
+        Completes an external task. Can be called from any thread, also while the scheduler is running.
+
+        :param name: Name of the external task
+        :param success: Whether the task succeeded (the tasks depending on it are skipped if it failed)
+        :param result: Result of the task (or the error if it failed)
+        """
+        self.__completed.put((name, 'done' if success else 'failed', (result, None) if success else result))
+
+    def run(self):
+        """
+        Runs all added tasks and blocks until they have either finished, failed or been skipped due to a failed
+        dependency.
+
+        :return: Ordered dict with the tasks (use task.status and task.result to get the outcome)
+        """
+        if self.memory_budget is not None:
+            logger.info(f"Running tasks with a memory budget of {self.memory_budget / 1e9:.1f} GB")
+        write_trace_record({'type': 'run', 'start': time.time(), 'num_proc': self.num_proc,
+                            'memory_budget': self.memory_budget})
+        for task in self.tasks.values():
+            write_trace_record({'type': 'task', 'name': task.name, 'depends_on': task.depends_on, 'kind': task.kind})
+        pbar = tqdm(total=len(self.tasks))
+        num_running = 0
+        num_external = 0
+        for task in self.tasks.values():
+            if task.func is None:
+                task.status = 'running'  # External tasks are running from the start
+                num_external += 1
+        # The same pool processes are used for all tasks of the run
+        self.__started = SimpleQueue()  # Written synchronously, so a started task is reported before it can die
+        with Pool(processes=self.num_proc, initializer=init_pool_process,
+                  initargs=(self.__started, self.initializer, self.initargs)) as pool:
+            num_running += self.__submit_ready_tasks(pool, num_running)
+            last_check = time.time()
+            while num_running > 0 or num_external > 0:
+                # The started tasks are read continuously, as the pool processes block when the queue pipe is full
+                self.__read_started_tasks()
+                # The processes are checked on a timer, as other tasks might keep finishing while a process is dead
+                if time.time() - last_check >= WORKER_CHECK_INTERVAL:
+                    self.__fail_tasks_of_dead_processes()
+                    last_check = time.time()
+                try:
+                    name, status, result = self.__completed.get(
+                        timeout=max(0, WORKER_CHECK_INTERVAL - (time.time() - last_check)))
+                except queue.Empty:
+                    continue
+                task = self.tasks[name]
+                if task.status != 'running':  # E.g. an external task which has already been completed
+                    continue
+                if task.func is None:
+                    num_external -= 1
+                else:
+                    num_running -= 1
+                self.__reserved_memory -= task.reserved_memory
+                if status == 'failed':
+                    task.status, task.result = status, result
+                    logger.error(f"Task failed: {name} ({result!r})")
+                    pbar.update(1 + self.__skip_dependents(name))
+                else:
+                    task.status, (task.result, task.peak_memory) = status, result
+                    self.__record_peak_memory(task)
+                    pbar.update(1)
+                num_running += self.__submit_ready_tasks(pool, num_running)
+        pbar.close()
+
+        return self.tasks
+
+    def __read_started_tasks(self):
+        while not self.__started.empty():
+            name, pid = self.__started.get()
+            self.tasks[name].pid = pid
+
+    def __fail_tasks_of_dead_processes(self):
+        self.__read_started_tasks()
+        # The pool replaces dead processes, so the processes of the pool are the live child processes
+        live_pids = {process.pid for process in active_children()}
+        for task in self.tasks.values():
+            if task.status == 'running' and task.func is not None and task.pid is not None and \
+                    task.pid not in live_pids:
+                error = RuntimeError(f"Pool process {task.pid} died while running the task (e.g. killed by the OOM "
+                                     f"killer)")
+                self.__completed.put((task.name, 'failed', error))
+                task.pid = None  # The task is only failed once
+
+    def __submit_ready_tasks(self, pool, num_running):
+        ready_tasks = [task for task in self.tasks.values()
+                       if task.status == 'pending' and
+                       all(self.tasks[dependency].status == 'done' for dependency in task.depends_on)]
+        # sorted() is stable, so tasks with equal priority are started in the order they were added
+        ready_tasks = sorted(ready_tasks, key=lambda task: -task.priority)
+
+        num_running_kind = {}
+        for task in self.tasks.values():
+            if task.status == 'running' and task.func is not None:
+                num_running_kind[task.kind] = num_running_kind.get(task.kind, 0) + 1
+
+        num_submitted = 0
+        for task in ready_tasks:
+            if num_running + num_submitted >= self.num_proc:
+                break
+            if num_running_kind.get(task.kind, 0) >= self.limits.get(task.kind, self.num_proc):
+                continue
+            memory = self.__estimate_memory(task)
+            if self.memory_budget is not None and self.__reserved_memory + memory > self.memory_budget:
+                if num_running + num_submitted > 0:
+                    # Wait for running tasks to free memory instead of starting smaller tasks with a lower priority,
+                    # which could keep the task waiting forever
+                    break
+                logger.warning(f"Estimated memory usage of {memory / 1e9:.1f} GB exceeds the memory budget, but "
+                               f"running it anyway as no other tasks are running: {task.name}")
+            task.status = 'running'
+            num_running_kind[task.kind] = num_running_kind.get(task.kind, 0) + 1
+            task.reserved_memory = memory
+            self.__reserved_memory += memory
+            pool.apply_async(run_task, (task.name, task.memory_stage or task.kind or 'task', task.func, task.args),
+                             callback=lambda result, name=task.name: self.__completed.put((name, 'done', result)),
+                             error_callback=lambda error, name=task.name: self.__completed.put((name, 'failed', error)))
+            num_submitted += 1
+
+        return num_submitted
+
+    def __estimate_memory(self, task):
+        if self.state is not None and task.memory_stage is not None:
+            observed_memory = self.state.get_peak_memory(task.memory_stage)
+            if observed_memory is not None:
+                return observed_memory * OBSERVED_MEMORY_MARGIN
+        return task.memory
+
+    def __record_peak_memory(self, task):
+        if task.peak_memory is None:
+            return
+        logger.debug(f"Peak memory usage of {task.peak_memory / 1e9:.2f} GB for task: {task.name}")
+        if self.state is not None and task.memory_stage is not None:
+            self.state.record_peak_memory(task.memory_stage, task.peak_memory)
+
+    def __skip_dependents(self, name):
+        num_skipped = 0
+        for task in self.tasks.values():
+            if task.status == 'pending' and name in task.depends_on:
+                task.status = 'skipped'
+                logger.info(f"Task skipped due to failed dependency {name}: {task.name}")
+                num_skipped += 1 + self.__skip_dependents(task.name)
+
+        return num_skipped
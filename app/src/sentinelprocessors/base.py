@@ -1,97 +1,483 @@
+import fnmatch
 import os
+import uuid
 import zipfile
+from contextlib import contextmanager
 
 from pathlib import Path
-from osgeo import gdal
+import numpy as np
+from osgeo import gdal, osr
 from loguru import logger
 
+from src.mosaic import write_mosaic
+from src.processingstate import fingerprint
+from src.reference import mask_reference
+from src.tracing import traced
+
 
 class BaseProcessor(object):
-    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False):
+    # Stages whose outputs are not derived artifacts, so they are not stored in the artifact cache
+    UNCACHED_STAGES = ('publish',)
+
+    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, state=None,
+                 footprint=None, cache=None):
         self.products_df = products_df
         self.directory = directory
         self.compress_gtiff = compress_gtiff
         self.overwrite_products = overwrite_products
+        self.state = state  # ProcessingState (None => the processing state is not recorded)
+        self.cache = cache  # ArtifactCache with the outputs of the stages (None => the outputs are not cached)
+        self.footprint = footprint  # Area of interest as WKT (e.g. the footprint of the order)
+        # Patterns of the members in the product zip files which are used by the processor (None => unzip everything)
+        self.zip_members = None
+        self.resume = True  # Skip stages which the processing state has recorded as completed with the same inputs
+        self.__group_indices = {}
+        self.__grouped_products_df = None
+
+    def get_groups(self):
+        """
+        Products whose names could not be parsed have no group, so they are not processed (a warning lists them).
+
+        :return: Sorted array with the unique groups of the products (see the 'group' column in parse_product_names())
+        """
+        is_unparsed = self.products_df['group'].isna()
+        if is_unparsed.any():
+            logger.warning(f"Skipping {is_unparsed.sum()} product(s) whose names could not be parsed: "
+                           f"{', '.join(self.products_df.loc[is_unparsed, 'title'].astype(str))}")
+        return np.unique(self.products_df['group'].dropna().values)
+
+    def get_group_indices(self, group):
+        """
+        Finds the products belonging to a group. The products are grouped once (and again if self.products_df is
+        replaced), instead of comparing all products for every group.
 
+        :param group: Group of products which are combined during processing (e.g. '20190803_028412' for Sentinel-1)
+        :return: List with the positional indices of the products in self.products_df
+        """
+        if self.__grouped_products_df is not self.products_df:
+            self.__group_indices = self.products_df.groupby('group', sort=False).indices
+            self.__grouped_products_df = self.products_df
+        return list(self.__group_indices.get(group, []))
+
+    def stage_completed(self, key, stage, stage_fingerprint=None):
+        """
+        Checks the processing state for whether a stage has already been completed with the same inputs, or restores the
+        outputs of the stage from the artifact cache if they have been created with the same inputs before (e.g. by
+        another order). Takes precedence over self.overwrite_products, so reruns do not redo stages that have been
+        completed.
+
+        :param key: Product title or group identifier (e.g. a date and absolute orbit)
+        :param stage: Name of the stage
+        :param stage_fingerprint: Fingerprint of the inputs to the stage (see src.processingstate.fingerprint())
+        :return: True if the stage can be skipped
+        """
+        if self.state is not None and self.resume and self.state.is_completed(key, stage, stage_fingerprint):
+            return True
+        if not self.is_cached_stage(stage, stage_fingerprint):
+            return False
+        outputs = self.cache.fetch(key, stage, stage_fingerprint)
+        if outputs is None:
+            return False
+        logger.info(f"Outputs of stage '{stage}' for {key} have been restored from the cache")
+        if self.state is not None:
+            with self.state.stage(key, stage, stage_fingerprint, outputs=outputs):
+                pass
+        return True
+
+    @contextmanager
+    def track_stage(self, key, stage, stage_fingerprint=None, outputs=()):
+        """
+        Records the status and timing of a stage in the processing state (see ProcessingState.stage()), and stores the
+        outputs of the stage in the artifact cache when it has been completed.
+        """
+        if self.is_cached_stage(stage, stage_fingerprint):
+            self.cache.unlink_outputs(outputs)
+        if self.state is None:
+            yield
+        else:
+            with self.state.stage(key, stage, stage_fingerprint, outputs=outputs):
+                yield
+        if self.is_cached_stage(stage, stage_fingerprint):
+            self.cache.store(key, stage, stage_fingerprint, outputs)
+
+    def is_cached_stage(self, stage, stage_fingerprint):
+        return self.cache is not None and stage_fingerprint is not None and stage not in self.UNCACHED_STAGES
+
+    @traced()
     def unzip_product(self, product, use_tile_path=False):
+        file_name = product['title'].values[0]
+        zip_path = (self.directory / 'zipfiles' / file_name).with_suffix('.zip')
+        stage_fingerprint = fingerprint([zip_path], params={'use_tile_path': use_tile_path,
+                                                            'zip_members': self.zip_members})
+        if self.stage_completed(file_name, 'unzip', stage_fingerprint):
+            logger.info('Product has already been unzipped according to the processing state: ' + file_name)
+            return
+
         if not product['product_path'].values[0].exists() or self.overwrite_products:
-            logger.info('Product will be unzipped: ' + product['title'].values[0])
-            file_name = product['title'].values[0]
-            with zipfile.ZipFile((self.directory / 'zipfiles' / file_name).with_suffix('.zip'), "r") as zip_ref:
-                if use_tile_path:
-                    zip_ref.extractall(product['tile_path'].values[0])
-                else:
-                    zip_ref.extractall((product['product_path'].values[0]).parent)
-            logger.info('Product has been unzipped: ' + product['title'].values[0])
+            logger.info('Product will be unzipped: ' + file_name)
+            with self.track_stage(file_name, 'unzip', stage_fingerprint, outputs=[product['product_path'].values[0]]):
+                with zipfile.ZipFile(zip_path, "r") as zip_ref:
+                    members = self.select_zip_members(zip_ref.namelist())
+                    if use_tile_path:
+                        zip_ref.extractall(product['tile_path'].values[0], members=members)
+                    else:
+                        zip_ref.extractall((product['product_path'].values[0]).parent, members=members)
+            logger.info('Product has been unzipped: ' + file_name)
         else:
-            logger.info('Unzipped product already exists: ' + product['title'].values[0])
+            logger.info('Unzipped product already exists: ' + file_name)
+
+    def select_zip_members(self, names):
+        """
+        Selects the members of a product zip file which match the patterns in self.zip_members.
 
+        :param names: Names of all members in the zip file (ie. from its central directory)
+        :return: List with the names of the members to extract (None => extract all members)
+        """
+        if self.zip_members is None:
+            return None
+        members = [name for name in names if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.zip_members)]
+        if not members:
+            logger.warning('No members of the zip file matched the patterns of the processor, so all members will '
+                           'be extracted: ' + str(self.zip_members))
+            return None
+        logger.debug(f"Extracting {len(members)} of {len(names)} members of the zip file")
+        return members
+
+    @traced()
     def reproject_image(self, src, dst, crs='EPSG:32632'):
         src_tmp = None
         if src == dst:  # If you want to replace the src file with the output of this function
-            src_tmp = Path(src.parent, 'temp' + src.suffix)  # Create path for temp file
+            src_tmp = get_temp_path(src)  # Create path for temp file
             src.rename(src_tmp)  # Rename the file to the temp filename
             src = src_tmp  # Set the temp file to be the source file
         src_ds = gdal.Open(str(src))  # src is a Path object but gdal requires a string, therefore str(src)
         creation_options = ['NUM_THREADS=ALL_CPUS']
-        config_options = ['GDAL_CACHEMAX=16000000000']
         warp_options = gdal.WarpOptions(dstSRS=crs, resampleAlg='cubic', srcNodata="0 0 0", multithread=True,
                                         creationOptions=creation_options)
-        dst_ds = gdal.Warp(str(dst), src_ds, options=warp_options, config_options=config_options)
+        dst_ds = gdal.Warp(str(dst), src_ds, options=warp_options)
         dst_ds = None
         src_ds = None
 
         if src_tmp is not None:
             os.remove(src_tmp)
 
+    @traced()
+    def reproject_to_cog(self, src, dst, crs='EPSG:32632', compression='DEFLATE'):
+        """
+        Reprojects an image and writes it as a Cloud Optimized GeoTIFF in a single pass (the fused version of
+        reproject_image() followed by create_cog()). If the image already is in the given CRS, the reprojection would
+        be an identity resampling, so the image is translated directly to the COG instead. Otherwise, the image is
+        warped through an in-memory warped VRT, so the reprojected image is streamed into the COG without writing an
+        intermediate file.
+
+        :param src: Path to the image (or a GDAL path, e.g. /vsizip/)
+        :param dst: Path to the COG
+        :param crs: CRS of the COG
+        :param compression: 'NONE', 'DEFLATE' or 'JPEG'
+        """
+        src_ds = gdal.Open(str(src))  # src is a Path object but gdal requires a string, therefore str(src)
+        dst_srs = osr.SpatialReference()
+        dst_srs.SetFromUserInput(crs)
+        src_srs = osr.SpatialReference(wkt=src_ds.GetProjection())
+        if src_srs.IsSame(dst_srs):
+            logger.debug("Image is already in " + crs + ", so it is not reprojected: " + str(src))
+            # Same nodata as the warp (0 in all bands)
+            self.translate_to_cog(src_ds, dst, compression=compression, no_data=0)
+        else:
+            warp_options = gdal.WarpOptions(format='VRT', dstSRS=crs, resampleAlg='cubic', srcNodata="0 0 0",
+                                            multithread=True)
+            warped_ds = gdal.Warp('', src_ds, options=warp_options)
+            self.translate_to_cog(warped_ds, dst, compression=compression)
+            warped_ds = None
+        src_ds = None
+
+    @staticmethod
+    @traced()
+    def create_cog(img, factors=[2, 4, 8, 16, 32], compression='NONE', resampling=None, max_z_error=None):
+        """
+        Converts a GeoTIFF to a Cloud Optimized GeoTIFF (tiled, compressed and with overviews) in a single pass with the
+        GDAL COG driver, and replaces the GeoTIFF with it.
+
+        :param img: Path to the GeoTIFF
+        :param factors: Overview factors (the COG driver uses factors of 2, so only the number of overviews is used)
+        :param compression: 'NONE', 'DEFLATE', 'JPEG' or 'LERC_DEFLATE'
+        :param resampling: Resampling of the overviews (None => chosen from the data type, see
+                           get_overview_resampling())
+        :param max_z_error: Maximum absolute error of LERC compression (None => lossless)
+        """
+        ds = gdal.Open(str(img))  # img is a Path object but gdal requires a string, therefore str(img)
+        BaseProcessor.translate_to_cog(ds, img, factors=factors, compression=compression, resampling=resampling,
+                                       max_z_error=max_z_error)
+        ds = None
+
     @staticmethod
-    def create_cog(img, factors=[2, 4, 8, 16, 32], compression='NONE'):
-        # Define a new configuration, save the previous configuration,
-        # and then apply the new one.
-        new_config = {
-            'GDAL_CACHEMAX': '8192',
-            'COMPRESS_OVERVIEW': 'NONE'  # Compression will be made in the next step
-        }
-        prev_config = {
-            key: gdal.GetConfigOption(key) for key in new_config.keys()}
-        for key, val in new_config.items():
-            gdal.SetConfigOption(key, val)
-
-        InputImage = str(img)
-        Image = gdal.Open(InputImage, 1)  # 0 = read-only, 1 = read-write.
-        Image.BuildOverviews("NEAREST", factors)
-        del Image
-
-        # Restore previous configuration.
-        for key, val in prev_config.items():
-            gdal.SetConfigOption(key, val)
-
-
-        # Run gdal_translate to properly tile and compress gtiff file after overviews have been added
-        # Note: Should not be necessary, but the current version of gdal destroys tiles when adding overviews
-        img_tmp = Path(img.parent, 'temp' + img.suffix)
-        img.rename(img_tmp)
-
-        ds = gdal.Open(str(img_tmp))  # img is a Path object but gdal requires a string, therefore str(img)
+    def translate_to_cog(src_ds, dst, factors=[2, 4, 8, 16, 32], compression='NONE', resampling=None, no_data=None,
+                         max_z_error=None):
+        """
+        Writes a GDAL dataset as a Cloud Optimized GeoTIFF with the GDAL COG driver. The COG is written to a temp file
+        next to the destination, which replaces the destination when the COG is done (so the destination can also be
+        the file of the dataset).
+
+        :param src_ds: GDAL dataset (e.g. an opened GeoTIFF or a VRT)
+        :param dst: Path to the COG
+        :param factors: Overview factors (the COG driver uses factors of 2, so only the number of overviews is used)
+        :param compression: 'NONE', 'DEFLATE', 'JPEG' or 'LERC_DEFLATE'
+        :param resampling: Resampling of the overviews (None => chosen from the data type, see
+                           get_overview_resampling())
+        :param no_data: Nodata value of the COG (None => the nodata value of the dataset)
+        :param max_z_error: Maximum absolute error of LERC compression (None => lossless)
+        """
+        if resampling is None:
+            resampling = BaseProcessor.get_overview_resampling(src_ds.GetRasterBand(1).DataType)
+
         # NOTE: ZSTD and WEBP compression is not working here
         # (https://lists.osgeo.org/pipermail/gdal-dev/2018-November/049289.html)
-        if compression == 'NONE':
-            creation_options = ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
-                                'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
+        # NOTE: The COG driver uses YCbCr for JPEG compression of RGB images
+        creation_options = [f'COMPRESS={compression}', 'BLOCKSIZE=512', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES',
+                            f'OVERVIEW_RESAMPLING={resampling}', f'OVERVIEW_COUNT={len(factors)}']
+        if compression == 'JPEG':
+            creation_options.append('QUALITY=90')
         elif compression == 'DEFLATE':
-            creation_options = ['COMPRESS=DEFLATE', 'TILED=YES', 'COPY_SRC_OVERVIEWS=YES',
-                                'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
-        elif compression == 'JPEG':
-            creation_options = ['COMPRESS=JPEG', 'PHOTOMETRIC=YCBCR', 'JPEG_QUALITY=90', 'TILED=YES',
-                                'COPY_SRC_OVERVIEWS=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'NUM_THREADS=ALL_CPUS',
-                                'BIGTIFF=YES']
-        config_options = ['GDAL_CACHEMAX=16000000000']
-        translate_options = gdal.TranslateOptions(creationOptions=creation_options)
-        ds = gdal.Translate(str(img), ds, options=translate_options, config_options=config_options)
-        ds = None
+            creation_options.append('PREDICTOR=YES')  # Horizontal differencing for integers, floating point for floats
+        elif compression.startswith('LERC') and max_z_error is not None:
+            creation_options.append(f'MAX_Z_ERROR={max_z_error}')
+
+        dst_tmp = get_temp_path(dst)
+        try:
+            translate_options = gdal.TranslateOptions(format='COG', creationOptions=creation_options, noData=no_data)
+            out_ds = gdal.Translate(str(dst_tmp), src_ds, options=translate_options)
+            if out_ds is None:
+                raise RuntimeError(f"Could not create COG {dst}: {gdal.GetLastErrorMsg()}")
+            out_ds = None
+            os.replace(dst_tmp, dst)
+        finally:
+            if dst_tmp.exists():
+                os.remove(dst_tmp)
+
+    @staticmethod
+    def copy_band_metadata(src, dst):
+        """
+        Copies the nodata value, scale and offset of the bands of an image to another image with the same bands (e.g. to
+        the output of co-registration, which does not keep the scale and offset).
 
-        os.remove(img_tmp)
+        :param src: Path to the image with the metadata
+        :param dst: Path to the image which the metadata is copied to
+        """
+        src_ds = gdal.Open(str(src))
+        dst_ds = gdal.Open(str(dst), 1)  # 0 = read-only, 1 = read-write.
+        for band_number in range(1, src_ds.RasterCount + 1):
+            src_band = src_ds.GetRasterBand(band_number)
+            dst_band = dst_ds.GetRasterBand(band_number)
+            if src_band.GetNoDataValue() is not None:
+                dst_band.SetNoDataValue(src_band.GetNoDataValue())
+            dst_band.SetScale(src_band.GetScale() or 1)
+            dst_band.SetOffset(src_band.GetOffset() or 0)
+        dst_ds = None
+        src_ds = None
+
+    @staticmethod
+    def get_overview_resampling(data_type):
+        """
+        :param data_type: GDAL data type of the raster (e.g. gdal.GDT_Float32)
+        :return: Resampling of the overviews; averaging for imagery and continuous values (e.g. reflectances, dB and
+                 indices) and nearest neighbour for 32-bit integers, which are used for classes and labels
+        """
+        if data_type in (gdal.GDT_Int32, gdal.GDT_UInt32):
+            return 'NEAREST'
+        return 'AVERAGE'
 
+    @traced()
+    def prepare_reference(self, src, dst, mask=None, crs='EPSG:32632', resolution=None, nodata=0):
+        """
+        Prepares a reference image of the co-registration once, instead of in every co-registration. The image is
+        warped to the CRS (and resolution) of the images which are co-registered to it, its bad data mask is embedded
+        as nodata, and it is written as a tiled COG with overviews. Each co-registration then reads the reference
+        through a VRT clipped to the footprint and resolution of its image (see clip_reference()).
+
+        :param src: Path to the reference image (e.g. an orthophoto)
+        :param dst: Path to the prepared reference image
+        :param mask: Path to the bad data mask of the reference image (non-zero => bad data; None => no mask)
+        :param crs: CRS of the prepared reference image
+        :param resolution: Resolution of the prepared reference image in the units of the CRS (None => the resolution
+                           of the reference image)
+        :param nodata: Nodata value of the prepared reference image
+        """
+        stage_fingerprint = fingerprint([src] + ([mask] if mask is not None else []),
+                                        params={'crs': crs, 'resolution': resolution, 'nodata': nodata})
+        if self.stage_completed(dst.name, 'reference', stage_fingerprint):
+            logger.info("Reference image has already been prepared according to the processing state: " + str(dst))
+            return
+
+        logger.info("Preparing reference image: " + str(dst))
+        os.makedirs(dst.parent, exist_ok=True)
+        vrt_tmp, mask_tmp, masked_tmp = get_temp_path(dst), get_temp_path(dst), get_temp_path(dst)
+        with self.track_stage(dst.name, 'reference', stage_fingerprint, outputs=[dst]):
+            try:
+                warp_options = gdal.WarpOptions(format='VRT', dstSRS=crs, xRes=resolution, yRes=resolution,
+                                                resampleAlg='average', dstNodata=nodata)
+                ref_ds = gdal.Warp(str(vrt_tmp), str(src), options=warp_options)
+                if mask is not None:
+                    # A pixel of the prepared reference is bad data if any of the pixels it is resampled from are
+                    mask_options = gdal.WarpOptions(format='VRT', dstSRS=crs, outputBounds=get_bounds(ref_ds),
+                                                    width=ref_ds.RasterXSize, height=ref_ds.RasterYSize,
+                                                    resampleAlg='max')
+                    mask_ds = gdal.Warp(str(mask_tmp), str(mask), options=mask_options)
+                    mask_ds = ref_ds = None  # Required for saving the vrt files
+                    mask_reference(vrt_tmp, mask_tmp, masked_tmp, nodata=nodata)
+                    ref_ds = gdal.Open(str(masked_tmp))
+                self.translate_to_cog(ref_ds, dst, compression='DEFLATE', no_data=nodata)
+                ref_ds = None
+            finally:
+                for path in (vrt_tmp, mask_tmp, masked_tmp):
+                    if path.exists():
+                        os.remove(path)
+
+    @staticmethod
+    def clip_reference(reference, target, dst):
+        """
+        Clips a prepared reference image (see prepare_reference()) to the footprint, CRS and resolution of an image
+        which is co-registered to it. The clipped reference is a warped VRT, so only the parts of the reference which
+        are read by the co-registration are resampled (from the overviews of the reference if the image is coarser).
+
+        :param reference: Path to the prepared reference image
+        :param target: Path to the image which is co-registered
+        :param dst: Path to the clipped reference (a vrt file)
+        """
+        target_ds = gdal.Open(str(target))
+        _, x_res, _, _, _, y_res = target_ds.GetGeoTransform()
+        warp_options = gdal.WarpOptions(format='VRT', dstSRS=target_ds.GetProjection(),
+                                        outputBounds=get_bounds(target_ds), xRes=x_res, yRes=abs(y_res),
+                                        resampleAlg='average')
+        clipped_ds = gdal.Warp(str(dst), str(reference), options=warp_options)
+        if clipped_ds is None:
+            raise RuntimeError(f"Could not clip reference image {reference}: {gdal.GetLastErrorMsg()}")
+        clipped_ds = None  # Required for saving the vrt
+
+    @traced()
+    def coregister_coarse_to_fine(self, reference, target, coreg_kwargs, prepared=True, factor=8,
+                                  fine_window=(512, 512)):
+        """
+        Estimates the global shift of an image in two stages, instead of in a large window at full resolution. The
+        coarse stage estimates the shift on the image and reference downsampled by a factor (read from their overviews),
+        in a window covering the same area as the window in coreg_kwargs. The fine stage then refines the shift in a
+        small window at full resolution of the image, which is pre-shifted by the coarse shift (in a VRT), so only
+        the residual shift of a few pixels has to be found.
+
+        :param reference: Path to the reference image
+        :param target: Path to the image (e.g. a vrt mosaic)
+        :param coreg_kwargs: Keyword arguments for arosics.COREG (e.g. the window size, ws)
+        :param prepared: Whether the reference is a prepared reference (see prepare_reference()), which is clipped to
+                         the image in each stage (otherwise it is passed to COREG as it is)
+        :param factor: Downsampling factor of the coarse stage
+        :param fine_window: Size of the window of the fine stage [pixels]
+        :return: Tuple with the coreg_info of the total shift (the coarse shift in map units is added as
+                 'coarse_shifts_map') and the reliability of the fine stage [%]
+        """
+        from arosics import COREG
+
+        target = Path(target)
+        target_ds = gdal.Open(str(target))
+        x_min, x_res, x_rotation, y_max, y_rotation, y_res = target_ds.GetGeoTransform()
+        coarse_target, coarse_reference, shifted_target, fine_reference = [get_temp_path(target) for _ in range(4)]
+
+        def get_reference(stage_target, stage_reference):
+            if not prepared:
+                return str(reference)
+            self.clip_reference(reference, stage_target, stage_reference)
+            return str(stage_reference)
+
+        def get_shift(coreg_info):
+            # Translation of the upper left corner in map units (ENVI map info: [projection, 1, 1, x, y, ...])
+            original_map_info, updated_map_info = coreg_info['original map info'], coreg_info['updated map info']
+            return (float(updated_map_info[3]) - float(original_map_info[3]),
+                    float(updated_map_info[4]) - float(original_map_info[4]))
+
+        try:
+            # Coarse stage
+            coarse_ds = gdal.Translate(str(coarse_target), target_ds, format='VRT', resampleAlg='average',
+                                       width=max(1, target_ds.RasterXSize // factor),
+                                       height=max(1, target_ds.RasterYSize // factor))
+            coarse_ds = None  # Required for saving the vrt
+            ws = coreg_kwargs.get('ws', (256, 256))
+            CR = COREG(get_reference(coarse_target, coarse_reference), str(coarse_target),
+                       **dict(coreg_kwargs, ws=(max(64, ws[0] // factor), max(64, ws[1] // factor))))
+            CR.calculate_spatial_shifts()
+            x_shift, y_shift = get_shift(CR.coreg_info)
+            logger.info(f"Coarse shift (1/{factor} resolution) is ({x_shift:.2f}, {y_shift:.2f}) with a reliability "
+                        f"of {round(CR.shift_reliability, 2)}% for {target.name}")
+
+            # Fine stage
+            shifted_ds = gdal.Translate(str(shifted_target), target_ds, format='VRT')
+            shifted_ds.SetGeoTransform((x_min + x_shift, x_res, x_rotation, y_max + y_shift, y_rotation, y_res))
+            shifted_ds = None  # Required for saving the vrt
+            CR = COREG(get_reference(shifted_target, fine_reference), str(shifted_target),
+                       **dict(coreg_kwargs, ws=tuple(fine_window), max_shift=max(5, 2 * factor)))
+            CR.calculate_spatial_shifts()
+            fine_x_shift, fine_y_shift = get_shift(CR.coreg_info)
+            logger.info(f"Fine shift is ({fine_x_shift:.2f}, {fine_y_shift:.2f}) with a reliability of "
+                        f"{round(CR.shift_reliability, 2)}% for {target.name}")
+        finally:
+            target_ds = None
+            for path in (coarse_target, coarse_reference, shifted_target, fine_reference):
+                if path.exists():
+                    os.remove(path)
+
+        # The fine stage found the shift relative to the pre-shifted image, so the original map info is moved back
+        # to the image (the updated map info then holds the total shift)
+        coreg_info = dict(CR.coreg_info)
+        original_map_info = list(coreg_info['original map info'])
+        original_map_info[3] = float(original_map_info[3]) - x_shift
+        original_map_info[4] = float(original_map_info[4]) - y_shift
+        coreg_info['original map info'] = original_map_info
+        coreg_info['coarse_shifts_map'] = {'x': x_shift, 'y': y_shift}
+        return coreg_info, CR.shift_reliability
+
+    @traced()
+    def translate_to_shifted_cog(self, src, dst, coreg_info, compression='DEFLATE', max_z_error=None,
+                                 align_grids=False, tolerance=0.1):
+        """
+        Applies a global co-registration shift to an image without resampling it. A global shift is a translation, so
+        it is applied to the geotransform of a VRT of the image, which is written as a COG in a single pass (instead of
+        writing the shifted image with DESHIFTER and rewriting it as a COG).
+
+        :param src: Path to the image (e.g. the vrt of a mode)
+        :param dst: Path to the co-registered COG
+        :param coreg_info: The coreg_info of the shift (see arosics.COREG.coreg_info)
+        :param compression: Compression of the COG (see translate_to_cog())
+        :param max_z_error: Maximum error of LERC compression (see translate_to_cog())
+        :param align_grids: Keep the image on its pixel grid, by rounding the shift to whole pixels
+        :param tolerance: Maximum distance [pixels] of the shift from whole pixels when align_grids is set
+        :return: True if the shift has been applied, or False if it requires resampling (ie. the image is not in the
+                 CRS of the reference image, or align_grids is set and the shift is not within the tolerance of whole
+                 pixels)
+        """
+        src_ds = gdal.Open(str(src))
+        src_srs, reference_srs = osr.SpatialReference(), osr.SpatialReference()
+        src_srs.ImportFromWkt(src_ds.GetProjection())
+        reference_srs.SetFromUserInput(coreg_info['reference projection'])  # WKT or e.g. an EPSG code
+        if not src_srs.IsSame(reference_srs):
+            return False
+
+        # The shift in map units is the translation of the upper left corner (ENVI map info: [projection, 1, 1, x, y,
+        # x resolution, y resolution, ...]), so it also applies to the modes with other resolutions
+        original_map_info, updated_map_info = coreg_info['original map info'], coreg_info['updated map info']
+        x_shift = float(updated_map_info[3]) - float(original_map_info[3])
+        y_shift = float(updated_map_info[4]) - float(original_map_info[4])
+        x_min, x_res, x_rotation, y_max, y_rotation, y_res = src_ds.GetGeoTransform()
+        if align_grids:
+            x_shift_px, y_shift_px = x_shift / x_res, y_shift / y_res
+            if max(abs(x_shift_px - round(x_shift_px)), abs(y_shift_px - round(y_shift_px))) > tolerance:
+                return False
+            x_shift, y_shift = round(x_shift_px) * x_res, round(y_shift_px) * y_res
+
+        vrt_ds = gdal.Translate('', src_ds, format='VRT')
+        vrt_ds.SetGeoTransform((x_min + x_shift, x_res, x_rotation, y_max + y_shift, y_rotation, y_res))
+        self.translate_to_cog(vrt_ds, dst, compression=compression, max_z_error=max_z_error)
+        vrt_ds = src_ds = None
+        logger.debug(f"Shift of ({x_shift}, {y_shift}) has been applied to the geotransform of: {dst}")
+        return True
+
+    @traced()
     def create_vrt(self, src_paths, vrt_path):
         vrt_options = gdal.BuildVRTOptions(addAlpha=False, hideNodata=False, allowProjectionDifference=False,
                                            resolution='highest')
@@ -104,21 +490,120 @@ class BaseProcessor(object):
         else:
             logger.debug("vrt file already exists: " + str(vrt_path))
 
-    def vrt_to_geotiff(self, vrt_path, img_path, dst_format='COG', compression='DEFLATE'):
+    @traced()
+    def vrt_to_geotiff(self, vrt_path, img_path, dst_format='COG', compression='DEFLATE', max_z_error=None,
+                       num_threads=0):
+        """
+        Writes the mosaic of a vrt file to a geotiff. COGs are written by first composing the mosaic window by window
+        in parallel (skipping the windows without any sources, see src.mosaic.write_mosaic()), and then converting it
+        to a COG in a single pass.
+
+        :param vrt_path: Path to the vrt file
+        :param img_path: Path to the geotiff
+        :param dst_format: 'COG' or another GDAL raster format (which is written with a single translation)
+        :param compression: 'NONE', 'DEFLATE', 'JPEG' or 'LERC_DEFLATE'
+        :param max_z_error: Maximum absolute error of LERC compression (None => lossless)
+        :param num_threads: Number of threads composing the mosaic (0 => the number of cpus)
+        """
         if not img_path.exists() or self.overwrite_products:
-            ds = gdal.Open(str(vrt_path))
-            config_options = ['GDAL_CACHEMAX=16000000000']
-#             creation_options = ['TILED=YES', 'COPY_SRC_OVERVIEWS=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
-#                                 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
-#             translate_options = gdal.TranslateOptions(creationOptions=creation_options)
-            creation_options = [f'COMPRESS={compression}', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
-            translate_options = gdal.TranslateOptions(format=dst_format, creationOptions=creation_options)
-            ds = gdal.Translate(destName=str(img_path), srcDS=ds, options=translate_options,
-                                config_options=config_options)
-            ds = None
+            if dst_format != 'COG':
+                creation_options = [f'COMPRESS={compression}', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=YES']
+                if max_z_error is not None:
+                    creation_options.append(f'MAX_Z_ERROR={max_z_error}')
+                translate_options = gdal.TranslateOptions(format=dst_format, creationOptions=creation_options)
+                ds = gdal.Translate(destName=str(img_path), srcDS=str(vrt_path), options=translate_options)
+                ds = None
+                return
+
+            mosaic_path = get_temp_path(img_path)
+            try:
+                num_written, num_windows = write_mosaic(vrt_path, mosaic_path, num_threads=num_threads)
+                logger.debug(f"Wrote {num_written} of {num_windows} windows of the mosaic (the others have no "
+                             f"sources): {img_path}")
+                ds = gdal.Open(str(mosaic_path))
+                self.translate_to_cog(ds, img_path, compression=compression, max_z_error=max_z_error)
+                ds = None
+            finally:
+                if mosaic_path.exists():
+                    os.remove(mosaic_path)
 
     @staticmethod
-    def create_thumbnail(src, dst):
-        translate_options = gdal.TranslateOptions(widthPct=3.25, heightPct=3.25, format='PNG')
-        out_ds = gdal.Translate(str(dst), str(src), options=translate_options)
+    @traced()
+    def create_thumbnail(src, dst, size_pct=3.25):
+        """
+        Creates a PNG thumbnail of an image or a vrt mosaic from the overviews of the image (or of each image in the
+        mosaic), so only the coarsest overviews which still have a resolution of at least the thumbnail are read instead
+        of the full resolution images.
+
+        :param src: Path to the image or vrt file
+        :param dst: Path to the thumbnail
+        :param size_pct: Size of the thumbnail relative to the image [%]
+        """
+        src_ds = gdal.Open(str(src))
+        width = max(1, int(round(src_ds.RasterXSize * size_pct / 100)))
+        height = max(1, int(round(src_ds.RasterYSize * size_pct / 100)))
+        factor = 100 / size_pct  # Maximum reduction of the resolution of the images
+        if src_ds.GetDriver().ShortName == 'VRT':
+            # A vrt without overviews of its own is read from the overviews of the images in the mosaic
+            src_paths = src_ds.GetFileList()[1:]  # The first file is the vrt file itself
+            overview_datasets = [BaseProcessor.open_overview(path, factor) for path in src_paths]
+            vrt_options = gdal.BuildVRTOptions(resolution='highest', outputBounds=get_bounds(src_ds))
+            thumbnail_src_ds = gdal.BuildVRT('', overview_datasets, options=vrt_options)
+        else:
+            thumbnail_src_ds = BaseProcessor.open_overview(src, factor)
+
+        translate_options = gdal.TranslateOptions(width=width, height=height, format='PNG')
+        out_ds = gdal.Translate(str(dst), thumbnail_src_ds, options=translate_options)
         out_ds = None  # Not sure if this is necessary
+        thumbnail_src_ds = None
+        src_ds = None
+
+    @staticmethod
+    def open_overview(path, factor):
+        """
+        Opens the coarsest overview of an image whose resolution is reduced by at most a factor relative to the image.
+
+        :param path: Path to the image
+        :param factor: Maximum reduction of the resolution (e.g. 30.8 for a thumbnail of 3.25% of the image)
+        :return: GDAL dataset with the overview (or with the image, if it has no suitable overviews)
+        """
+        ds = gdal.Open(str(path))
+        band = ds.GetRasterBand(1)
+        overview_level = None
+        for i in range(band.GetOverviewCount()):
+            if ds.RasterXSize / band.GetOverview(i).XSize <= factor:
+                overview_level = i
+        if overview_level is None:
+            return ds
+        return gdal.OpenEx(str(path), gdal.OF_RASTER, open_options=[f'OVERVIEW_LEVEL={overview_level}'])
+
+def get_temp_path(path):
+    """
+    :param path: Path to a file
+    :return: Unique path for a temp file next to the file (the processes of the pool can share a directory). The temp
+             file is hidden and has the suffix .tmp, so it is not matched when globbing for the output files.
+    """
+    return path.with_name(f'.{path.name}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp')
+
+
+def get_shift_params(coreg_kwargs, coarse_to_fine=False, coarse_factor=8, fine_window=512):
+    """
+    :param coreg_kwargs: Keyword arguments for arosics.COREG of the shift estimation
+    :param coarse_to_fine: Whether the shift is estimated coarse to fine (see BaseProcessor.coregister_coarse_to_fine())
+    :param coarse_factor: Downsampling factor of the coarse stage
+    :param fine_window: Size of the window of the fine stage [pixels]
+    :return: Settings of the shift estimation (ie. the parameters of the key of a shift in the shift cache, see
+             src.shiftcache.ShiftCache.get_key())
+    """
+    if not coarse_to_fine:
+        return coreg_kwargs
+    return dict(coreg_kwargs, coarse_factor=coarse_factor, fine_window=fine_window)
+
+
+def get_bounds(ds):
+    """
+    :param ds: GDAL dataset
+    :return: Bounds of the dataset (min x, min y, max x, max y)
+    """
+    x_min, x_res, _, y_max, _, y_res = ds.GetGeoTransform()
+    return x_min, y_max + y_res * ds.RasterYSize, x_min + x_res * ds.RasterXSize, y_max
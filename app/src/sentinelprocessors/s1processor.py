@@ -1,29 +1,60 @@
 import os
-import subprocess
 from pathlib import Path
+from xml.etree import ElementTree
 
 import numpy as np
 import rasterio
 import shutil
 from absl import flags
 from matplotlib import pyplot as plt
+from shapely import wkt
+from shapely.geometry import box
 from time import sleep
 from random import randint
 
 from loguru import logger
-from src.sentinelprocessors.base import BaseProcessor
+from src.bandmath import encode_values, get_value_storage
+from src.gptrunner import GptRunner
+from src.processingstate import fingerprint
+from src.sentinelprocessors.base import BaseProcessor, get_shift_params, get_temp_path
+from src.shiftcache import ShiftCache
+from src.tracing import traced
 
 FLAGS = flags.FLAGS
 
+# Members of the Sentinel-1 GRD zip files which are read by SNAP (ie. everything but the quick-look previews)
+S1_ZIP_MEMBERS = ['*.SAFE/manifest.safe', '*.SAFE/annotation/*', '*.SAFE/measurement/*', '*.SAFE/support/*']
+# Graph which preprocesses a product and writes the band geotiffs in a single gpt run (see create_fused_graph())
+FUSED_GRAPH_PATH = Path('data') / 'graphs' / 'preprocessToGeotiffGraph.xml'
+# Reference image of the co-registration (remember to set nodata value to 0 when saving the ortofoto)
+REFERENCE_PATH = Path('/workspace/mnt/app/data/reference') / 'ortofoto_reference_epsg4326.tif'
+# Settings of the estimation of the shifts (part of the key of the shifts in the shift cache)
+COREG_KWARGS = {'wp': (9.20, 56.10), 'ws': (8192, 8192), 'nodata': (255., -32768), 'calc_corners': False}
+
 
 class S1Processor(BaseProcessor):
-    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False):
-        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products)
+    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, state=None,
+                 footprint=None, cache=None, shifts=None):
+        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products,
+                         state=state, footprint=footprint, cache=cache)
+        self.shifts = shifts  # ShiftCache with the co-registration shifts (None => the shifts are not stored)
         self.compress_gtiff = FLAGS.compress_gtiff
         self.del_intermediate = FLAGS.s1_del_intermediate
         self.directory = directory
         self.overwrite_products = FLAGS.overwrite
+        self.resume = FLAGS.resume
         self.output_crs = FLAGS.s1_output_crs
+        self.fused_graph = FLAGS.s1_fused_graph
+        self.subset_to_aoi = FLAGS.s1_subset_to_aoi
+        if FLAGS.selective_unzip:
+            self.zip_members = S1_ZIP_MEMBERS
+        # Storage of the backscatter [dB] in the RGB geotiffs (None => truncated to the dtype of to_geotiff_rgb())
+        self.rgb_storage = get_value_storage(FLAGS.compact_storage, precision=0.01)
+        self.gpt_runner = GptRunner(timeout=FLAGS.gpt_timeout_minutes * 60 if FLAGS.gpt_timeout_minutes > 0 else None,
+                                    stall_timeout=(FLAGS.gpt_stall_timeout_minutes * 60
+                                                   if FLAGS.gpt_stall_timeout_minutes > 0 else None),
+                                    max_memory=FLAGS.gpt_max_memory_gb * 1e9 if FLAGS.gpt_max_memory_gb > 0 else None,
+                                    retries=FLAGS.gpt_retries)
 
     def process(self, index):
         # Sleep between 0 and 2 seconds to test if errors were caused by simultaneously starting the processing of multiple products in parallel
@@ -41,11 +72,15 @@ class S1Processor(BaseProcessor):
         manifest_path = product_path / 'manifest.safe'
         rel_orbit, pass_mode = self.get_rel_orbit_and_pass_mode(manifest_path)
 
-        # Run preprocessing graph
-        preprocessed_product_path = self.preprocess(product_path, rel_orbit, pass_mode)
+        if self.fused_graph:
+            # Run preprocessing and create geotiffs with a single graph
+            vh_path, vv_path, vv_vh_path = self.preprocess_to_geotiff_bands(product_path, rel_orbit, pass_mode)
+        else:
+            # Run preprocessing graph
+            preprocessed_product_path = self.preprocess(product_path, rel_orbit, pass_mode)
 
-        # Create geotiffs
-        vh_path, vv_path, vv_vh_path = self.to_geotiff_bands(preprocessed_product_path)
+            # Create geotiffs
+            vh_path, vv_path, vv_vh_path = self.to_geotiff_bands(preprocessed_product_path)
         self.to_geotiff_rgb(vh_path, vv_path, vv_vh_path, product_path, dtype=rasterio.int16)
 
         # Delete intermediate data
@@ -56,6 +91,7 @@ class S1Processor(BaseProcessor):
 #         except:
 #             logger.error("An error occured during proccesing of: " + str(product['title'].values[0]))
 
+    @traced()
     def preprocess(self, product_path, rel_orbit, pass_mode):
         graph_path = Path('data') / 'graphs' / 'preprocessGraph.xml'
         specklefilter = 'None'  # Use 'None' or 'Refined Lee' ('Refined Lee' might need "" or something around it to be parsed properly)
@@ -65,16 +101,91 @@ class S1Processor(BaseProcessor):
                                                                         str(product_path),
                                                                         str(specklefilter),
                                                                         str(dst_path))
-        if not dst_path.exists() or self.overwrite_products:
+        stage_fingerprint = fingerprint([product_path / 'manifest.safe', graph_path],
+                                        params={'specklefilter': specklefilter})
+        if self.stage_completed(product_path.stem, 'preprocess', stage_fingerprint):
+            logger.info('Sentinel-1 product has already been preprocessed according to the processing state: ' +
+                        str(product_path))
+        elif not dst_path.exists() or self.overwrite_products:
             logger.info('Executing SNAP pre-processing graph for product: ' + str(product_path))
             logger.info(f"SNAP graph cmd: {cmd}")
-            self.exec_graph(cmd)
+            with self.track_stage(product_path.stem, 'preprocess', stage_fingerprint, outputs=[dst_path]):
+                self.exec_graph(cmd, name=f'preprocess {product_path.stem}')
             logger.info('Sentinel-1 product has been preprocessed: ' + str(product_path))
         else:
             logger.info('Sentinel-1 product has already been preprocessed: ' + str(product_path))
 
         return dst_path
 
+    @traced()
+    def preprocess_to_geotiff_bands(self, product_path, rel_orbit, pass_mode):
+        """
+        Preprocesses a product and creates the individual band geotiffs in a single gpt run. This is the same processing
+        as preprocess() followed by to_geotiff_bands(), but without starting a second JVM and without writing and
+        reading the intermediate BEAM-DIMAP product.
+
+        :return: Paths to the VH, VV and VV-VH geotiffs
+        """
+        specklefilter = 'None'  # Use 'None' or 'Refined Lee' ('Refined Lee' might need "" or something around it to be parsed properly)
+        dst_name = str(product_path.stem) + '_' + pass_mode + '_' + rel_orbit
+        dst_path = product_path / 'preprocessed' / dst_name
+        graph_path = Path(str(dst_path) + '_graph.xml')
+        output_vh = Path(str(dst_path) + '_VH.tif')
+        output_vv = Path(str(dst_path) + '_VV.tif')
+        output_vv_vh = Path(str(dst_path) + '_VV-VH.tif')
+
+        geo_region = self.get_subset_region()
+        stage_fingerprint = fingerprint([product_path / 'manifest.safe', FUSED_GRAPH_PATH],
+                                        params={'specklefilter': specklefilter, 'geo_region': geo_region})
+        if self.stage_completed(product_path.stem, 'preprocess_bands', stage_fingerprint):
+            logger.info('Sentinel-1 product has already been preprocessed to band geotiffs according to the processing '
+                        'state: ' + str(product_path))
+        elif not output_vh.exists() or self.overwrite_products:
+            os.makedirs(dst_path.parent, exist_ok=True)
+            self.create_fused_graph(graph_path, geo_region)
+            cmd = 'gpt {} -Pinput={} -Pspecklefilter={} -Poutput_vh={} -Poutput_vv={} -Poutput_vv-vh={}'.format(
+                str(graph_path), str(product_path), str(specklefilter), str(output_vh), str(output_vv),
+                str(output_vv_vh))
+            logger.info('Executing SNAP pre-processing graph (incl. band geotiffs) for product: ' + str(product_path))
+            logger.info(f"SNAP graph cmd: {cmd}")
+            with self.track_stage(product_path.stem, 'preprocess_bands', stage_fingerprint,
+                                  outputs=[output_vh, output_vv, output_vv_vh]):
+                self.exec_graph(cmd, name=f'preprocess_bands {product_path.stem}')
+            logger.info('Sentinel-1 product has been preprocessed to band geotiffs: ' + str(product_path))
+        else:
+            logger.info('Sentinel-1 product has already been preprocessed to band geotiffs: ' + str(product_path))
+
+        return [output_vh, output_vv, output_vv_vh]
+
+    def get_subset_region(self):
+        """
+        :return: WKT of the bounding box of the area of interest, which the products are subset to before calibration
+                 and terrain correction (None => the products are not subset)
+        """
+        if self.footprint is None or not self.subset_to_aoi:
+            return None
+        return box(*wkt.loads(self.footprint).bounds).wkt
+
+    @staticmethod
+    def create_fused_graph(dst_graph_path, geo_region=None):
+        """
+        Generates the graph used by preprocess_to_geotiff_bands() from FUSED_GRAPH_PATH. The Subset operator (placed
+        after the border noise removal) is set to geo_region, or removed from the graph if geo_region is None.
+
+        :param dst_graph_path: Path to write the generated graph to
+        :param geo_region: WKT polygon (in WGS84) of the region to keep
+        """
+        tree = ElementTree.parse(str(FUSED_GRAPH_PATH))
+        graph = tree.getroot()
+        nodes = {node.get('id'): node for node in graph.findall('node')}
+        if geo_region is None:
+            nodes['Calibration'].find('sources/sourceProduct').set('refid', 'Remove-GRD-Border-Noise')
+            graph.remove(nodes['Subset'])
+        else:
+            nodes['Subset'].find('parameters/geoRegion').text = geo_region
+        tree.write(str(dst_graph_path))
+
+    @traced()
     def to_geotiff_bands(self, preprocessed_product_path):
         graph_path = Path('data') / 'graphs' / 'geotiffFloat32Graph.xml'
         output_vh = Path(str(preprocessed_product_path.with_suffix('')) + '_VH.tif')
@@ -87,42 +198,63 @@ class S1Processor(BaseProcessor):
                                                                                          str(output_vv),
                                                                                          str(output_vv_vh))
 
-        if not output_vh.exists() or self.overwrite_products:
+        key = preprocessed_product_path.parent.parent.stem  # The product title (ie. the name of the .SAFE folder)
+        stage_fingerprint = fingerprint([preprocessed_product_path, graph_path])
+        if self.stage_completed(key, 'band_geotiffs', stage_fingerprint):
+            logger.info('Sentinel-1 product already had individual band geotiffs created according to the processing '
+                        'state: ' + str(preprocessed_product_path))
+        elif not output_vh.exists() or self.overwrite_products:
             logger.info('Creating Sentinel-1 individual band geotiffs for product: ' +
                         str(preprocessed_product_path))
-            self.exec_graph(cmd)
+            with self.track_stage(key, 'band_geotiffs', stage_fingerprint, outputs=[output_vh, output_vv, output_vv_vh]):
+                self.exec_graph(cmd, name=f'band_geotiffs {key}')
         else:
             logger.info('Sentinel-1 product already had individual band geotiffs created: ' +
                         str(preprocessed_product_path))
 
         return [output_vh, output_vv, output_vv_vh]
 
+    @traced()
     def to_geotiff_rgb(self, vh_path, vv_path, vv_vh_path, product_path, dtype=rasterio.float32):
         # From https://gis.stackexchange.com/a/223920
         file_list = [vh_path, vv_path, vv_vh_path]
         dst_name = str(vh_path.stem)[:-2] + 'RGB.tif'
         dst_path = product_path / 'processed' / dst_name
 
-        if not dst_path.exists() or self.overwrite_products:
+        stage_fingerprint = fingerprint(file_list, params={'dtype': dtype, 'storage': FLAGS.compact_storage})
+        if self.stage_completed(product_path.stem, 'rgb', stage_fingerprint):
+            logger.info('Sentinel-1 product already had RGB geotiff created according to the processing state: ' +
+                        str(dst_path))
+        elif not dst_path.exists() or self.overwrite_products:
             logger.info('Creating Sentinel-1 RGB geotiff for product: ' + str(dst_path))
             if not dst_path.parent.exists():  # Create directory if it does not exist
                 os.makedirs(dst_path.parent)
 
-            # Read metadata of first file
-            with rasterio.open(file_list[0]) as src0:
-                profile = src0.profile
-
-            # Update meta to reflect the number of layers
-            profile.update(
-                count=len(file_list),
-                nodata=-32768,
-                dtype=dtype)
-
-            # Read each layer and write it to stack
-            with rasterio.open(dst_path, 'w', **profile, BIGTIFF='YES') as dst:
-                for i, layer in enumerate(file_list, start=1):
-                    with rasterio.open(layer) as src1:
-                        dst.write_band(i, src1.read(1).astype(dtype))
+            with self.track_stage(product_path.stem, 'rgb', stage_fingerprint, outputs=[dst_path]):
+                # Read metadata of first file
+                with rasterio.open(file_list[0]) as src0:
+                    profile = src0.profile
+
+                # Update meta to reflect the number of layers
+                profile.update(
+                    count=len(file_list),
+                    nodata=-32768,
+                    dtype=dtype)
+                if self.rgb_storage is not None:
+                    profile.update(dtype=self.rgb_storage.dtype, nodata=self.rgb_storage.nodata)
+
+                # Read each layer and write it to stack
+                with rasterio.open(dst_path, 'w', **profile, BIGTIFF='YES') as dst:
+                    for i, layer in enumerate(file_list, start=1):
+                        with rasterio.open(layer) as src1:
+                            if self.rgb_storage is None:
+                                dst.write_band(i, src1.read(1).astype(dtype))
+                            else:
+                                data = src1.read(1, masked=True).astype(rasterio.float32).filled(np.nan)
+                                dst.write_band(i, encode_values(data, self.rgb_storage))
+                    if self.rgb_storage is not None and self.rgb_storage.scale is not None:
+                        dst.scales = [self.rgb_storage.scale] * len(file_list)
+                        dst.offsets = [0] * len(file_list)
 
             # Create cloud optimized geotiff
             # NOTE: Commented out for Elsevier paper to improve processing speed (the individual tiles are deleted after they have been combined anyways)
@@ -135,37 +267,125 @@ class S1Processor(BaseProcessor):
         else:
             logger.info('Sentinel-1 product already had RGB geotiff created: ' + str(dst_path))
 
+    def get_date_abs_orbit_indices(self, product_date_abs_orbit):
+        """
+        Finds the products belonging to a date and absolute orbit.
+
+        :param product_date_abs_orbit: Product date and absolute orbit (e.g. '20190803_028412')
+        :return: List with the positional indices of the products in self.products_df
+        """
+        return self.get_group_indices(product_date_abs_orbit)
+
+    def process_date_abs_orbit(self, product_date_abs_orbit):
+        """
+        Combines the processed tiles of a date and absolute orbit, co-registers the combined geotiff and moves it to
+        the output directory. Must only be run after all tiles of the date and absolute orbit have been processed.
+
+        :param product_date_abs_orbit: Product date and absolute orbit (e.g. '20190803_028412')
+        """
+        # Create the vrt with the combined tiles
+        vrt_path = self.create_vrt_and_cog(product_date_abs_orbit, create_thumbnail=True)
+
+        # Co-register
+        if FLAGS.s1_coregister:
+            coreg_path = (vrt_path.parent / f'{vrt_path.stem}_coreg').with_suffix('.tif')
+            shift = self.get_shift_key(product_date_abs_orbit)
+            stage_fingerprint = fingerprint([vrt_path], params={'shift': shift, 'storage': FLAGS.compact_storage,
+                                                                'align_grids': FLAGS.coreg_align_grids,
+                                                                'subpixel_tolerance': FLAGS.coreg_subpixel_tolerance,
+                                                                'coarse_to_fine': FLAGS.coreg_coarse_to_fine,
+                                                                'coarse_factor': FLAGS.coreg_coarse_factor,
+                                                                'fine_window': FLAGS.coreg_fine_window})
+            if self.stage_completed(product_date_abs_orbit, 'coreg', stage_fingerprint):
+                logger.info(f"Already co-registered according to the processing state: {str(coreg_path)}")
+            else:
+                logger.info("Co-registering")
+                with self.track_stage(product_date_abs_orbit, 'coreg', stage_fingerprint, outputs=[coreg_path]):
+                    self.temp_coregister_function_for_elsevier_intepretability_paper(vrt_path, coreg_path, shift)
+
+        # Move to final output path
+        tif_path = vrt_path.with_suffix('.tif')
+        png_path = vrt_path.with_suffix('.png')
+        published_paths = [tif_path, png_path]  # Updated if moved (the outputs are read when the stage is completed)
+        with self.track_stage(product_date_abs_orbit, 'publish', self.publish_fingerprint(), outputs=published_paths):
+            if FLAGS.move_to_output_directory and FLAGS.output_directory is not None:
+                new_output_dir = Path(FLAGS.output_directory)
+                tif_new_path = new_output_dir / tif_path.name
+                png_new_path = new_output_dir / png_path.name
+                # exist_ok, as several dates and absolute orbits can be moved to the output directory in parallel
+                os.makedirs(tif_new_path.parent, exist_ok=True)
+                logger.info(f"Moving {str(png_path)} to output directory {str(png_new_path)}")
+                shutil.move(png_path, png_new_path)
+                logger.info(f"Finished moving {str(png_path)} to output directory {str(png_new_path)}")
+                logger.info(f"Moving {str(tif_path)} to output directory {str(tif_new_path)}")
+                shutil.move(tif_path, tif_new_path)
+                logger.info(f"Finished moving {str(tif_path)} to output directory {str(tif_new_path)}")
+                published_paths[:] = [tif_new_path, png_new_path]
+
+        if self.del_intermediate:
+            # Delete the individual tile data of this date and absolute orbit (the tiles of the other dates and
+            # absolute orbits might still be processing, so the entire GRD folder cannot be deleted here).
+            # Used for Elsevier paper due to lack of storage capacity.
+            for index in self.get_date_abs_orbit_indices(product_date_abs_orbit):
+                product_path = self.products_df.iloc[index]['product_path']
+                logger.info(f"Deleting {str(product_path)}")
+                shutil.rmtree(product_path, ignore_errors=True)
+
+        return vrt_path
+
+    @staticmethod
+    def publish_fingerprint():
+        """
+        :return: Fingerprint of the settings which decide the final output of a date and absolute orbit
+        """
+        return fingerprint([], params={'s1_coregister': FLAGS.s1_coregister,
+                                       'move_to_output_directory': FLAGS.move_to_output_directory,
+                                       'output_directory': FLAGS.output_directory})
+
+    @traced()
     def create_vrt_and_cog(self, product_date_abs_orbit, create_thumbnail=True):
         logger.info("Creating Sentinel-1 vrt and geotiff file(s) for date and abs orbit: " + product_date_abs_orbit)
         rgb_paths = []
-        for index in range(len(self.products_df.index)):
+        for index in self.get_date_abs_orbit_indices(product_date_abs_orbit):
             product = self.products_df.iloc[[index]].copy()
             rgb_path = list((product['product_path'].values[0] / 'processed').glob('*RGB.tif*'))[0]
-            product_date = product['title'].values[0][17:25]
-            product_abs_orbit = product['title'].values[0][48:55]
-            if product_date_abs_orbit == (product_date + product_abs_orbit):
-                rgb_paths.append(str(rgb_path))
+            rgb_paths.append(str(rgb_path))
 
-                # The values below should also be in the products dataframe.
-                satellite_name = product['title'].values[0][0:3]
-                pass_mode = str(rgb_path.stem)[-11:-8]
-                rel_orbit = str(rgb_path.stem)[-7:-4]
+            # The pass mode and relative orbit are read from the name of the RGB geotiff (ie. from the manifest)
+            satellite_name = product['mission'].values[0]
+            pass_mode = str(rgb_path.stem)[-11:-8]
+            rel_orbit = str(rgb_path.stem)[-7:-4]
 
         vrt_name = satellite_name + '_' + product_date_abs_orbit + '_' + pass_mode + '_' + rel_orbit + '_RGB.vrt'
         vrt_path = Path(self.directory / 'output_data' / 's1' / 'combined' / vrt_name)
-        self.create_vrt(src_paths=rgb_paths, vrt_path=vrt_path)
+        stage_fingerprint = fingerprint(rgb_paths)
+        if self.stage_completed(product_date_abs_orbit, 'vrt', stage_fingerprint):
+            logger.info("vrt file already exists according to the processing state: " + str(vrt_path))
+        else:
+            with self.track_stage(product_date_abs_orbit, 'vrt', stage_fingerprint, outputs=[vrt_path]):
+                self.create_vrt(src_paths=rgb_paths, vrt_path=vrt_path)
 
         img_path = vrt_path.with_suffix('.tif')
+        stage_fingerprint = fingerprint([vrt_path] + rgb_paths, params={'create_thumbnail': create_thumbnail,
+                                                                        'storage': FLAGS.compact_storage})
+        if self.stage_completed(product_date_abs_orbit, 'cog', stage_fingerprint):
+            logger.info("Geotiff file already exists according to the processing state: " + str(img_path))
         # File check has to be done here or COG will be made every time (there might be better way to implement this)
-        if not img_path.exists() or self.overwrite_products:
-            # TODO: Get reprojection to work properly
-            # self.reproject_image(src=img_path, dst=img_path, crs=self.output_crs)
-            # Create cloud optimized geotiff
-            self.vrt_to_geotiff(vrt_path, img_path, dst_format='COG', compression='DEFLATE')
-            # The new vrt_to_geotiff() function should make cloud-optimized geotiff by default, so there should not be a reason to do it afterwards
-            #             self.create_cog(img_path, compression='DEFLATE')
-            if create_thumbnail:
-                self.create_sentinel1_thumbnail(img_path)
+        elif not img_path.exists() or self.overwrite_products:
+            cog_outputs = [img_path, img_path.with_suffix('.png')] if create_thumbnail else [img_path]
+            with self.track_stage(product_date_abs_orbit, 'cog', stage_fingerprint, outputs=cog_outputs):
+                # TODO: Get reprojection to work properly
+                # self.reproject_image(src=img_path, dst=img_path, crs=self.output_crs)
+                # Create cloud optimized geotiff
+                if self.rgb_storage is None:
+                    self.vrt_to_geotiff(vrt_path, img_path, dst_format='COG', compression='DEFLATE')
+                else:
+                    self.vrt_to_geotiff(vrt_path, img_path, dst_format='COG', compression=self.rgb_storage.compression,
+                                        max_z_error=self.rgb_storage.max_z_error)
+                # The new vrt_to_geotiff() function should make cloud-optimized geotiff by default, so there should not be a reason to do it afterwards
+                #             self.create_cog(img_path, compression='DEFLATE')
+                if create_thumbnail:
+                    self.create_sentinel1_thumbnail(img_path)
 
         # NOTE: This return is for temporary use to run the temp_coregister_function_for_elsevier_intepretability_paper() function.
         return vrt_path
@@ -190,6 +410,8 @@ class S1Processor(BaseProcessor):
 
             # Convert 0 values to NaNs
             thumbnail[thumbnail == -32768] = np.nan
+            # Scaled values (see rgb_storage) are converted to dB
+            thumbnail *= np.array(src.scales, dtype=rasterio.float32)[:, np.newaxis, np.newaxis]
 
             # Move channels to last axis and normalize with the colours manually found (ie. vh=+30, vv=+20, vv-vh=+0)
             thumbnail = np.rollaxis(thumbnail, 0, 3)
@@ -199,12 +421,14 @@ class S1Processor(BaseProcessor):
 
         plt.imsave(thumbnail_path, thumbnail)
 
-    @staticmethod
-    def exec_graph(cmd):
-        p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        for line in p.stdout.readlines():
-            logger.debug(line.strip().decode())
-        retval = p.wait()
+    def exec_graph(self, cmd, name=''):
+        """
+        Runs a gpt command with the time and memory limits of the processor (see GptRunner).
+
+        :raises GptError: If gpt fails or is killed, so the processing of the product stops instead of continuing
+                          without the outputs of the graph
+        """
+        self.gpt_runner.run(cmd, name=name)
 
     @staticmethod
     def get_rel_orbit_and_pass_mode(manifest_path):
@@ -230,32 +454,112 @@ class S1Processor(BaseProcessor):
 
         return rel_orbit, pass_mode
 
-    @staticmethod
-    def temp_coregister_function_for_elsevier_intepretability_paper(target_img, coreg_path):
-        from arosics import COREG
-        from pathlib import Path
-
-        # Remember to set nodata value to 0 when saving the ortofoto
-        reference_im_path = Path('/workspace/mnt/app/data/reference')
-        im_reference = str(reference_im_path / 'ortofoto_reference_epsg4326.tif')
+    def get_reference_path(self):
+        """
+        :return: Path to the prepared reference image of the co-registration (see prepare_references())
+        """
+        return self.directory / 'reference' / (REFERENCE_PATH.stem + '_prepared.tif')
+
+    def prepare_references(self):
+        """
+        Prepares the reference image of the co-registration (see BaseProcessor.prepare_reference()) in the CRS of the
+        combined Sentinel-1 geotiffs. Must be run before the dates and absolute orbits are co-registered.
+        """
+        if not REFERENCE_PATH.exists():
+            logger.warning("Reference image of the co-registration does not exist: " + str(REFERENCE_PATH))
+            return
+        self.prepare_reference(REFERENCE_PATH, self.get_reference_path(), crs='EPSG:4326',
+                               nodata=COREG_KWARGS['nodata'][0])
+
+    def get_shift_key(self, product_date_abs_orbit):
+        """
+        :param product_date_abs_orbit: Product date and absolute orbit (e.g. '20190803_028412')
+        :return: Tuple with the mission, date, relative orbit and key of the shift of the date and absolute orbit in the
+                 shift cache (see src.shiftcache.ShiftCache)
+        """
+        product = self.products_df.iloc[self.get_date_abs_orbit_indices(product_date_abs_orbit)[0]]
+        mission, date = product['mission'], product_date_abs_orbit[:8]
+        relative_orbit = 'R' + format(int(product['rel_orbit']), '03d')
+        params = get_shift_params(COREG_KWARGS, FLAGS.coreg_coarse_to_fine, FLAGS.coreg_coarse_factor,
+                                  FLAGS.coreg_fine_window)
+        return mission, date, relative_orbit, ShiftCache.get_key(mission, date, relative_orbit, [REFERENCE_PATH],
+                                                                 params=params)
+
+    @traced()
+    def temp_coregister_function_for_elsevier_intepretability_paper(self, target_img, coreg_path, shift=None):
+        """
+        Co-registers an image to the reference image. The shift is stored in the shift cache, so it is only estimated
+        once for each date and relative orbit, and reruns only apply the stored shift.
+
+        :param target_img: Path to the image
+        :param coreg_path: Path to the co-registered COG
+        :param shift: Tuple with the mission, date, relative orbit and key of the shift (see get_shift_key(); None =>
+                      the shift is always estimated)
+        """
+        from arosics import COREG, DESHIFTER
+
+        im_reference = str(REFERENCE_PATH)
         #         im_target = '/workspace/mnt/app/data/output/output_data/s1/combined/S1A_20210324_037136_DSC_139_RGB.tif'
         #         dst_path = '/workspace/mnt/app/data/output/output_data/s1/combined/S1A_20210324_037136_DSC_139_RGB_coreg.tif'
         im_target = str(target_img)
-
-        kwargs = {
-            #     'mask_baddata_ref': str(reference_im_path / 'ortofoto_reference_epsg4326_nodata_mask.tif'),
+        out_kwargs = {
             'path_out': str(coreg_path),
             'fmt_out': 'COG',
             'out_crea_options': ['COMPRESS=DEFLATE', 'NUM_THREADS=ALL_CPUS'],
-            'wp': (9.20, 56.10),
-            'ws': (8192, 8192),
-            'nodata': (255., -32768),
-            'calc_corners': False,
-            'q': True,
-            'v': False
         }
-
-        CR = COREG(im_reference, im_target, **kwargs)
-        CR.calculate_spatial_shifts()
-        CR.correct_shifts()
-        logger.info("Shift reliability is " + str(round(CR.shift_reliability, 2)) + "% for " + str(dst_path))
+        # The co-registered image is stored like the RGB geotiffs (see create_vrt_and_cog())
+        if self.rgb_storage is None:
+            compression, max_z_error, nodata = 'DEFLATE', None, COREG_KWARGS['nodata'][1]
+        else:
+            compression, max_z_error, nodata = (self.rgb_storage.compression, self.rgb_storage.max_z_error,
+                                                self.rgb_storage.nodata)
+
+        cached_shift = self.shifts.get(shift[3]) if self.shifts is not None and shift is not None else None
+        if cached_shift is not None:
+            coreg_info, reliability = cached_shift
+            logger.info(f"Shift has been found in the shift cache (reliability is {round(reliability or 0, 2)}%) for "
+                        f"{str(coreg_path)}")
+        else:
+            kwargs = {
+                #     'mask_baddata_ref': str(REFERENCE_PATH.parent / 'ortofoto_reference_epsg4326_nodata_mask.tif'),
+                'q': True,
+                'v': False
+            }
+            prepared = self.get_reference_path().exists()
+            if FLAGS.coreg_coarse_to_fine:
+                coreg_info, reliability = self.coregister_coarse_to_fine(
+                    self.get_reference_path() if prepared else im_reference, im_target, dict(COREG_KWARGS, **kwargs),
+                    prepared=prepared, factor=FLAGS.coreg_coarse_factor,
+                    fine_window=(FLAGS.coreg_fine_window, FLAGS.coreg_fine_window))
+            else:
+                clipped_reference_path = get_temp_path(Path(coreg_path))
+                try:
+                    if prepared:  # Read the prepared reference within the footprint of the image
+                        self.clip_reference(self.get_reference_path(), target_img, clipped_reference_path)
+                        im_reference = str(clipped_reference_path)
+                    CR = COREG(im_reference, im_target, **COREG_KWARGS, **kwargs)
+                    CR.calculate_spatial_shifts()
+                finally:
+                    if clipped_reference_path.exists():
+                        os.remove(clipped_reference_path)
+                coreg_info, reliability = CR.coreg_info, CR.shift_reliability
+            logger.info("Shift reliability is " + str(round(reliability, 2)) + "% for " + str(coreg_path))
+            if self.shifts is not None and shift is not None:
+                mission, date, relative_orbit, shift_key = shift
+                self.shifts.put(shift_key, mission, date, relative_orbit, coreg_info, reliability)
+
+        # The shift is applied to the geotransform when possible, and otherwise the image is resampled by DESHIFTER
+        if self.translate_to_shifted_cog(target_img, coreg_path, coreg_info, compression=compression,
+                                         max_z_error=max_z_error, align_grids=FLAGS.coreg_align_grids,
+                                         tolerance=FLAGS.coreg_subpixel_tolerance):
+            return
+        if self.rgb_storage is None:
+            DESHIFTER(im_target, coreg_info, nodata=nodata, align_grids=FLAGS.coreg_align_grids, q=True,
+                      **out_kwargs).correct_shifts()
+        else:
+            # DESHIFTER does not keep the scale of the values, so the scale is copied to an uncompressed intermediate
+            # geotiff before it is compressed as a COG
+            DESHIFTER(im_target, coreg_info, nodata=nodata, align_grids=FLAGS.coreg_align_grids, q=True,
+                      path_out=str(coreg_path), fmt_out='GTIFF', out_crea_options=['COMPRESS=NONE']).correct_shifts()
+            self.copy_band_metadata(target_img, coreg_path)
+            self.create_cog(coreg_path, compression=compression, max_z_error=max_z_error)
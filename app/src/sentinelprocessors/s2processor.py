@@ -1,153 +1,220 @@
+import fnmatch
 import os
-import rasterio
+import zipfile
 
 import numpy as np
 
 from arosics import COREG, DESHIFTER
+from collections import OrderedDict
 from absl import logging, flags
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
-from src.sentinelprocessors.base import BaseProcessor
+from src.bandmath import get_value_storage
+from src.processingstate import fingerprint
+from src.sentinelprocessors.base import BaseProcessor, get_shift_params, get_temp_path
+from src.shiftcache import ShiftCache
+from src.spectralindices import SPECTRAL_INDICES, calculate_indices, get_index_bands
+from src.tracing import traced
 
 FLAGS = flags.FLAGS
 
+# Reference image of the co-registration (remember to set nodata value to 0 when saving the ortofoto)
+REFERENCE_PATH = Path('data/reference') / 'ortofoto_reference_epsg32632.tif'
+REFERENCE_MASK_PATH = Path('data/reference') / 'ortofoto_reference_epsg32632_nodata_mask.tif'
+# Resolution of the prepared reference image (see S2Processor.prepare_references()) [m]
+REFERENCE_RESOLUTION = 10
+# Settings of the estimation of the shifts (part of the key of the shifts in the shift cache)
+COREG_KWARGS = {'ws': (4096, 4096)}
+
 
 class S2Processor(BaseProcessor):
-    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, delete_jp2_files=False):
-        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products)
+    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, delete_jp2_files=False,
+                 state=None, cache=None, shifts=None):
+        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products,
+                         state=state, cache=cache)
+        self.shifts = shifts  # ShiftCache with the co-registration shifts (None => the shifts are not stored)
         self.calc_ndvi = FLAGS.s2_ndvi
+        self.indices = FLAGS.s2_indices
         self.compress_gtiff = FLAGS.compress_gtiff
         self.delete_jp2_files = FLAGS.delete_jp2_files
         self.overwrite_products = FLAGS.overwrite
+        self.resume = FLAGS.resume
+        self.read_from_zip = FLAGS.read_from_zip
+        self.band_math_threads = FLAGS.band_math_threads
+        # Storage of the spectral indices (None => float32 rounded to 2 decimals)
+        self.index_storage = get_value_storage(FLAGS.compact_storage, precision=0.01)
+        if FLAGS.selective_unzip or self.read_from_zip:
+            self.zip_members = self.get_zip_members(FLAGS.s2_bands, FLAGS.s2_resolutions,
+                                                    self.indices if self.calc_ndvi else ())
+        self.__zip_listings = {}  # Names of the members of each zip file (see __get_zip_listing())
+
+    @staticmethod
+    def get_zip_members(bands, resolutions, indices=()):
+        """
+        :param bands: Bands to process (e.g. ['B03', 'B04', 'B08', 'TCI'])
+        :param resolutions: Resolutions of the bands to process (e.g. ['10m'])
+        :param indices: Spectral indices to calculate (their bands are added at the resolution of each index)
+        :return: Patterns of the members of the Sentinel-2 L2A zip files which are used by the processing
+        """
+        band_resolutions = [(band, resolution) for resolution in resolutions for band in bands]
+        for resolution, index_bands in get_index_bands(indices).items():
+            band_resolutions += [(band, resolution) for band in index_bands
+                                 if (band, resolution) not in band_resolutions]
+
+        members = ['*.SAFE/MTD_MSIL2A.xml']
+        for band, resolution in band_resolutions:
+            members.append(f'*.SAFE/GRANULE/*/IMG_DATA/R{resolution}/*_{band}_{resolution}.jp2')
+        return members
+
+    @staticmethod
+    def get_band_geotiffs_fingerprint(zip_path, compress_gtiff, zip_members=None):
+        """
+        :param zip_path: Path to the zip file of the product (the jp2 files might have been deleted after translation,
+                         so the zip file is used to fingerprint the inputs)
+        :param compress_gtiff: Whether the geotiffs are compressed
+        :param zip_members: Patterns of the translated members of the zip file (see get_zip_members(); None => all)
+        :return: Fingerprint of the translation of the jp2 files to geotiffs, which changes with the selected bands,
+                 resolutions and indices (e.g. the 20m bands of NDMI are translated when NDMI is added)
+        """
+        return fingerprint([zip_path], params={'compress_gtiff': compress_gtiff,
+                                               'members': None if zip_members is None else sorted(zip_members)})
 
     def process_tiles(self, index):
         # Extract the row from the dataframe with the product process (use copy to avoid "copy of a slice warning")
         # https://stackoverflow.com/questions/31468176/setting-values-on-a-copy-of-a-slice-from-a-dataframe
         product = self.products_df.iloc[[index]].copy()
-        self.unzip_product(product, use_tile_path=True)
+        if not self.read_from_zip:  # Otherwise the jp2 files are read directly from the zip file
+            self.unzip_product(product, use_tile_path=True)
         product = self.__concat_resolutions_paths(product)  # Must be done after unzipping (damnit ESA!)
         self.__translate_jp2_to_gtiff(product)
-        self.__calculate_ndvi__(product)
-        self.__calculate_gndvi__(product)
+        if self.calc_ndvi:
+            self.__calculate_indices__(product)
         # self.__calculate_gndvi_gdal__(product)
 
-    @staticmethod
-    def __concat_resolutions_paths(product):
+    def __concat_resolutions_paths(self, product):
         granule_path = product['product_path'].values[0] / 'GRANULE'
-        resolutions_path = list(granule_path.glob('*/'))[0] / 'IMG_DATA'
+        if granule_path.exists():
+            resolutions_path = list(granule_path.glob('*/'))[0] / 'IMG_DATA'
+        else:
+            # The product has not been unzipped, so find the granule folder in the zip file. The geotiffs are written
+            # to the same folders as if the product had been unzipped.
+            names = self.__get_zip_listing(product)
+            img_data_path = next(PurePosixPath(name).parent.parent for name in names
+                                 if fnmatch.fnmatchcase(name, '*.SAFE/GRANULE/*/IMG_DATA/R*/*.jp2'))
+            resolutions_path = product['tile_path'].values[0] / img_data_path
         product['res_10m_path'] = resolutions_path / 'R10m/'
         product['res_20m_path'] = resolutions_path / 'R20m/'
         product['res_60m_path'] = resolutions_path / 'R60m/'
         return product
 
+    def __get_zip_listing(self, product):
+        # The central directory of each zip file is only read once
+        zip_path = (self.directory / 'zipfiles' / product['title'].values[0]).with_suffix('.zip')
+        if zip_path not in self.__zip_listings:
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+                self.__zip_listings[zip_path] = zip_ref.namelist()
+        return self.__zip_listings[zip_path]
+
+    def __get_jp2_files(self, product, resolution_path):
+        if not self.read_from_zip:
+            return sorted(resolution_path.glob('*.jp2'))
+        # GDAL reads the jp2 files from inside the zip file (/vsizip/), so they are never extracted to the disk
+        zip_path = (self.directory / 'zipfiles' / product['title'].values[0]).with_suffix('.zip')
+        names = self.select_zip_members(self.__get_zip_listing(product)) or self.__get_zip_listing(product)
+        resolution_folder = resolution_path.relative_to(product['tile_path'].values[0]).as_posix()
+        return sorted('/vsizip/' + str(zip_path) + '/' + name for name in names
+                      if name.endswith('.jp2') and str(PurePosixPath(name).parent) == resolution_folder)
+
+    @traced()
     def __translate_jp2_to_gtiff(self, product):
+        title = product['title'].values[0]
+        zip_path = (self.directory / 'zipfiles' / title).with_suffix('.zip')
+        stage_fingerprint = self.get_band_geotiffs_fingerprint(zip_path, self.compress_gtiff, self.zip_members)
+        if self.stage_completed(title, 'band_geotiffs', stage_fingerprint):
+            logging.info("Sentinel-2 files already exist as GeoTiff according to the processing state: " + title)
+            return
+
+        gtiff_files = []  # Filled with the translated files, which are recorded as the outputs of the stage
+        with self.track_stage(title, 'band_geotiffs', stage_fingerprint, outputs=gtiff_files):
+            self.__translate_jp2_files_to_gtiff(product, gtiff_files)
+
+    def __translate_jp2_files_to_gtiff(self, product, gtiff_files):
         # Translate all files to geotiff
         resolution_paths = [product['res_10m_path'].values[0],
                             product['res_20m_path'].values[0],
                             product['res_60m_path'].values[0]]
 
         for resolution_path in resolution_paths:
-            jp2_files = list(resolution_path.glob('*.jp2'))
-            jp2_files.sort()
+            jp2_files = self.__get_jp2_files(product, resolution_path)
             for jp2_file in jp2_files:
-                gtiff_file = jp2_file.with_suffix('.tiff')
+                gtiff_file = resolution_path / (PurePosixPath(str(jp2_file)).stem + '.tiff')
                 if not gtiff_file.exists() or self.overwrite_products:
-                    self.reproject_image(jp2_file, gtiff_file)
+                    if not resolution_path.exists():  # Create directory if it does not exist
+                        os.makedirs(resolution_path)
+                    # Reprojection (skipped if the jp2 file already is in the output CRS) and COG creation are done
+                    # in a single pass, so no intermediate files are written
                     if self.compress_gtiff:
-                        if 'TCI' in gtiff_file.stem:
-                            # self.create_cog(gtiff_file, compression='JPEG')
-                            # logging.debug('Jpeg2000 file has been converted to Gtiff with JPEG compression: ' +
-                            #               str(gtiff_file))
-                            self.create_cog(gtiff_file, compression='DEFLATE')
-                            logging.debug('Jpeg2000 file has been converted to Gtiff with DEFLATE compression: ' +
-                                          str(gtiff_file))
-                        else:
-                            self.create_cog(gtiff_file, compression='DEFLATE')
-                            logging.debug('Jpeg2000 file has been converted to Gtiff with DEFLATE compression: ' +
-                                          str(gtiff_file))
+                        # NOTE: JPEG compression could be used for the TCI files (compression='JPEG')
+                        self.reproject_to_cog(jp2_file, gtiff_file, compression='DEFLATE')
+                        logging.debug('Jpeg2000 file has been converted to Gtiff with DEFLATE compression: ' +
+                                      str(gtiff_file))
                     else:
-                        self.create_cog(gtiff_file, compression='NONE')
+                        self.reproject_to_cog(jp2_file, gtiff_file, compression='NONE')
                         logging.debug('Jpeg2000 file has been converted to Gtiff with no compression: ' +
                                       str(gtiff_file))
 
                     # Delete jp2 files
-                    if self.delete_jp2_files:
+                    if self.delete_jp2_files and not self.read_from_zip:
                         os.remove(jp2_file)
                         logging.info('Jpeg2000 file has been deleted: ' + str(jp2_file))
 
                     logging.info("Sentinel-2 file has been translated to GeoTiff: " + str(gtiff_file))
                 else:
                     logging.info("Sentinel-2 file already exists as GeoTiff: " + str(gtiff_file))
+                gtiff_files.append(gtiff_file)
 
-    def __calculate_ndvi__(self, product, use_acorvi=True):
-        # ACORVI: Regarding use of visible bands for vegetation indicies with atmospherically corrected data
-        # https://labo.obs-mip.fr/multitemp/using-ndvi-with-atmospherically-corrected-data/
-        res_10m_path = product['res_10m_path'].values[0]
-        red_band_path = list(res_10m_path.glob('*B04_10m.tiff'))[0]
-        nir_band_path = list(res_10m_path.glob('*B08_10m.tiff'))[0]
-        ndvi_path = Path(red_band_path.parent, str(red_band_path.stem)[:-7] + 'NDVI_10m' + red_band_path.suffix)
-
-        if not ndvi_path.exists() or self.overwrite_products:
-            with rasterio.open(red_band_path) as red:
-                with rasterio.open(nir_band_path) as nir:
-                    profile = red.profile
-                    # Is compression needed here? We make a cog afterwards anyways.
-                    # if self.compress_gtiff:
-                    #     profile.update(dtype=rasterio.float32, compress='DEFLATE', predictor=3, zlevel=9)
-                    # else:
-                    #     profile.update(dtype=rasterio.float32)
-                    profile.update(dtype=rasterio.float32)
-                    red_data = red.read().astype(rasterio.float32)
-                    nir_data = nir.read().astype(rasterio.float32)
-                    with np.errstate(divide='ignore', invalid='ignore'):
-                        if use_acorvi:
-                            # https://labo.obs-mip.fr/multitemp/using-ndvi-with-atmospherically-corrected-data/
-                            # ndvi_data = (nir_data - red_data + 0.05) / (nir_data + red_data + 0.05)
-                            ndvi_data = (nir_data - red_data) / (nir_data + red_data)
-                        else:
-                            ndvi_data = (nir_data - red_data) / (nir_data + red_data)
-                        with rasterio.open(ndvi_path, 'w', **profile) as dst:
-                            # Round the NDVI data to 2 decimals (reduces the size after compression) and save the data
-                            dst.write(np.round(ndvi_data, decimals=2))
-                    self.create_cog(ndvi_path, compression='DEFLATE')
-            logging.info("Sentinel-2 product has had NDVI calculated: " + product['title'].values[0])
-        else:
-            logging.info("Sentinel-2 product already had NDVI calculated: " + product['title'].values[0])
+    @traced()
+    def __calculate_indices__(self, product, indices=None):
+        """
+        Calculates the spectral indices of a product (see src.spectralindices.SPECTRAL_INDICES) in a single pass per
+        resolution, such that the bands shared by the indices (e.g. B08 for NDVI and GNDVI) are only read once.
 
-    def __calculate_gndvi__(self, product, use_acorvi=True):
-        # ACORVI: Regarding use of visible bands for vegetation indicies with atmospherically corrected data
-        # https://labo.obs-mip.fr/multitemp/using-ndvi-with-atmospherically-corrected-data/
-        res_10m_path = product['res_10m_path'].values[0]
-        green_band_path = list(res_10m_path.glob('*B03_10m.tiff'))[0]
-        nir_band_path = list(res_10m_path.glob('*B08_10m.tiff'))[0]
-        gndvi_path = Path(green_band_path.parent, str(green_band_path.stem)[:-7] + 'GNDVI_10m' + green_band_path.suffix)
+        :param product: Dataframe with the product
+        :param indices: Names of the indices (None => self.indices)
+        """
+        indices = self.indices if indices is None else indices
+        title = product['title'].values[0]
+        for resolution, bands in get_index_bands(indices).items():
+            resolution_path = product['res_' + resolution + '_path'].values[0]
+            band_paths = OrderedDict((band, list(resolution_path.glob('*_' + band + '_' + resolution + '.tiff'))[0])
+                                     for band in bands)
+            prefix = band_paths[bands[0]].stem[:-len(bands[0] + '_' + resolution)]  # e.g. 'T32UNG_20190803T103031_'
+            index_paths = OrderedDict((name, resolution_path / (prefix + name + '_' + resolution + '.tiff'))
+                                      for name in indices if SPECTRAL_INDICES[name].resolution == resolution)
 
-        if not gndvi_path.exists() or self.overwrite_products:
-            with rasterio.open(green_band_path) as green:
-                with rasterio.open(nir_band_path) as nir:
-                    profile = green.profile
-                    # Is compression needed here? We make a cog afterwards anyways.
-                    # if self.compress_gtiff:
-                    #     profile.update(dtype=rasterio.float32, compress='DEFLATE', predictor=3, zlevel=9)
-                    # else:
-                    #     profile.update(dtype=rasterio.float32)
-                    profile.update(dtype=rasterio.float32)
-                    green_data = green.read().astype(rasterio.float32)
-                    nir_data = nir.read().astype(rasterio.float32)
-                    with np.errstate(divide='ignore', invalid='ignore'):
-                        if use_acorvi:
-                            # https://labo.obs-mip.fr/multitemp/using-ndvi-with-atmospherically-corrected-data/
-                            # gndvi_data = (nir_data - green_data + 0.05) / (nir_data + green_data + 0.05)
-                            gndvi_data = (nir_data - green_data) / (nir_data + green_data)
-                        else:
-                            gndvi_data = (nir_data - green_data) / (nir_data + green_data)
-                        with rasterio.open(gndvi_path, 'w', **profile) as dst:
-                            # Round the NDVI data to 2 decimals (reduces the size after compression) and save the data
-                            dst.write(np.round(gndvi_data, decimals=2))
-                    self.create_cog(gndvi_path, compression='DEFLATE')
-            logging.info("Sentinel-2 product has had GNDVI calculated: " + product['title'].values[0])
-        else:
-            logging.info("Sentinel-2 product already had GNDVI calculated: " + product['title'].values[0])
+            stage = 'indices_' + resolution
+            params = {name: SPECTRAL_INDICES[name].expression for name in index_paths}
+            params['storage'] = FLAGS.compact_storage
+            stage_fingerprint = fingerprint(list(band_paths.values()), params=params)
+            if self.stage_completed(title, stage, stage_fingerprint):
+                logging.info(f"Sentinel-2 product already had {list(index_paths)} calculated according to the "
+                             f"processing state: " + title)
+            elif not all(path.exists() for path in index_paths.values()) or self.overwrite_products:
+                with self.track_stage(title, stage, stage_fingerprint, outputs=list(index_paths.values())):
+                    calculate_indices(band_paths, index_paths, num_threads=self.band_math_threads,
+                                      storage=self.index_storage)
+                    for name, index_path in index_paths.items():
+                        self.create_cog(index_path, **self.__get_cog_options(name))
+                logging.info(f"Sentinel-2 product has had {list(index_paths)} calculated: " + title)
+            else:
+                logging.info(f"Sentinel-2 product already had {list(index_paths)} calculated: " + title)
+
+    def __get_cog_options(self, mode):
+        # Compression of the COGs of a mode (e.g. 'TCI' or 'NDVI'), where the spectral indices use the compression of
+        # their storage (see --compact_storage)
+        if mode in SPECTRAL_INDICES and self.index_storage is not None:
+            return {'compression': self.index_storage.compression, 'max_z_error': self.index_storage.max_z_error}
+        return {'compression': 'DEFLATE'}
 
     def __calculate_gndvi_gdal__(self, product):
         res_10m_path = product['res_10m_path'].values[0]
@@ -176,86 +243,206 @@ class S2Processor(BaseProcessor):
         else:
             logging.info("Sentinel-2 product already had GNDVI calculated: " + product['title'].values[0])
 
-    def create_vrt_files_and_coregister(self, modes=['TCI', 'NDVI', 'GNDVI']):
-        product_titles = self.products_df['title'].values
-        product_dates = [title[11:19] for title in product_titles]
-        product_dates = np.unique(product_dates)
-        logging.info("Creating vrt file(s)")
-        for product_date in product_dates:
-            self.create_vrt_and_coregister_modes(modes, product_date)
+    def get_product_dates(self):
+        """
+        :return: Sorted array with the unique sensing dates of the products (e.g. '20190803')
+        """
+        return self.get_groups()
+
+    def get_date_indices(self, product_date):
+        """
+        :param product_date: Sensing date (e.g. '20190803')
+        :return: List with the positional indices of the products from the date in self.products_df
+        """
+        return self.get_group_indices(product_date)
 
     def create_vrt_and_coregister_modes(self, modes, product_date):
-        # TODO: This function, along with coregister, should be written more elegantly
-        coreg_info = None  # Co-registration object (http://danschef.gitext.gfz-potsdam.de/arosics/doc/usage/global_coreg.html)
+        """
+        Combines the products of a date into a vrt file for each mode, and co-registers them. Each mode is processed
+        even if another mode fails, and the date fails afterwards if any of the modes have failed.
+
+        :param modes: Modes to combine and co-register (e.g. ['TCI', 'NDVI'])
+        :param product_date: Sensing date (e.g. '20190803')
+        :return: Ordered dict with the result of each mode ('done', or 'skipped' if it was already co-registered)
+        :raises RuntimeError: If any of the modes failed
+        """
+        # The shift is found once for the date (on the TCI mosaic, see get_shift()) and applied to all modes
+        # (http://danschef.gitext.gfz-potsdam.de/arosics/doc/usage/global_coreg.html)
+        shift = {}  # The coreg_info (or the error of the shift estimation) of each relative orbit
+        results = OrderedDict()
         for mode in modes:
-            relative_orbit, tile_paths = self.__get_tile_paths(product_date, mode=mode)
-            vrt_name = 'S2_L2A_' + product_date + '_' + relative_orbit + '_' + mode + '.vrt'
-            vrt_path = Path(self.directory / 'output_data' / 's2' / 'combined' / vrt_name)
-            self.create_vrt(src_paths=tile_paths, vrt_path=vrt_path)
-            if mode == 'TCI':
-                self.create_thumbnail(src=vrt_path, dst=vrt_path.with_suffix('.png'))
-
-            # Co-register and create geotiff
-            dst_path = Path(str(vrt_path)[:-4] + '_coreg.tiff')
-            if coreg_info is None:  # Find the spatial shift (ie. for the first mode)
-                coreg_info = self.coregister(src_path=vrt_path, dst_path=dst_path)
-            elif coreg_info != 'coreg_error':  # Apply to other modes
+            try:
+                results[mode] = self.__create_vrt_and_coregister_mode(mode, product_date, shift)
+            except Exception as e:
+                logging.exception(f"Sentinel-2 mode {mode} of {product_date} failed: {e!r}")
+                results[mode] = e
+
+        logging.info(f"Sentinel-2 date {product_date}: " +
+                     ', '.join(f"{mode} {result if isinstance(result, str) else 'failed'}"
+                               for mode, result in results.items()))
+        failed_modes = OrderedDict((mode, result) for mode, result in results.items() if not isinstance(result, str))
+        if failed_modes:
+            raise RuntimeError(f"Sentinel-2 date {product_date} failed for {list(failed_modes)}: "
+                               + '; '.join(f'{mode}: {error!r}' for mode, error in failed_modes.items()))
+        return results
+
+    def __create_vrt_and_coregister_mode(self, mode, product_date, shift):
+        relative_orbit, tile_paths = self.__get_tile_paths(product_date, mode=mode)
+        vrt_path = self.__get_vrt_path(product_date, relative_orbit, mode)
+        stage_fingerprint = fingerprint(tile_paths)
+        if self.stage_completed(vrt_path.stem, 'vrt', stage_fingerprint):
+            logging.info("vrt file already exists according to the processing state: " + str(vrt_path))
+        else:
+            vrt_outputs = [vrt_path, vrt_path.with_suffix('.png')] if mode == 'TCI' else [vrt_path]
+            with self.track_stage(vrt_path.stem, 'vrt', stage_fingerprint, outputs=vrt_outputs):
+                self.create_vrt(src_paths=tile_paths, vrt_path=vrt_path)
+                if mode == 'TCI':
+                    self.create_thumbnail(src=vrt_path, dst=vrt_path.with_suffix('.png'))
+
+        # Co-register and create geotiff
+        dst_path = Path(str(vrt_path)[:-4] + '_coreg.tiff')
+        stage_fingerprint = fingerprint([vrt_path] + tile_paths,
+                                        params={'shift': self.__get_shift_key(product_date, relative_orbit),
+                                                'align_grids': FLAGS.coreg_align_grids,
+                                                'subpixel_tolerance': FLAGS.coreg_subpixel_tolerance,
+                                                'coarse_to_fine': FLAGS.coreg_coarse_to_fine,
+                                                'coarse_factor': FLAGS.coreg_coarse_factor,
+                                                'fine_window': FLAGS.coreg_fine_window})
+        if self.stage_completed(vrt_path.stem, 'coreg', stage_fingerprint):
+            logging.info("Coregistered image already exists according to the processing state: " + str(dst_path))
+            return 'skipped'
+        with self.track_stage(vrt_path.stem, 'coreg', stage_fingerprint, outputs=[dst_path]):
+            if relative_orbit not in shift:
+                # A failed shift estimation is stored as well, so it is not repeated for the other modes
                 try:
-                    DESHIFTER(im2shift=str(vrt_path), path_out=str(dst_path), fmt_out='GTIFF',
-                              coreg_results=coreg_info).correct_shifts()
-                    self.create_cog(dst_path, compression='DEFLATE')
-                except:
-                    logging.error("Coregistration error with file: " + str(dst_path))
-            else:  # Log an error if the coregistration has failed
-                logging.error("Coregistration error with file: " + str(dst_path))
+                    shift[relative_orbit] = self.get_shift(product_date, relative_orbit)
+                except Exception as e:
+                    shift[relative_orbit] = e
+            if isinstance(shift[relative_orbit], Exception):
+                raise RuntimeError(f"Shift of {product_date} ({relative_orbit}) could not be estimated: "
+                                   f"{shift[relative_orbit]!r}")
+            self.deshift(src_path=vrt_path, dst_path=dst_path, coreg_info=shift[relative_orbit],
+                         **self.__get_cog_options(mode))
+        return 'done'
+
+    def __get_vrt_path(self, product_date, relative_orbit, mode):
+        vrt_name = 'S2_L2A_' + product_date + '_' + relative_orbit + '_' + mode + '.vrt'
+        return Path(self.directory / 'output_data' / 's2' / 'combined' / vrt_name)
+
+    def __get_shift_key(self, product_date, relative_orbit):
+        mission = self.products_df.iloc[self.get_date_indices(product_date)[0]]['mission']
+        return mission, ShiftCache.get_key(mission, product_date, relative_orbit, [REFERENCE_PATH, REFERENCE_MASK_PATH],
+                                           params=get_shift_params(COREG_KWARGS, FLAGS.coreg_coarse_to_fine,
+                                                                   FLAGS.coreg_coarse_factor, FLAGS.coreg_fine_window))
 
     def __get_tile_paths(self, product_date, mode='TCI'):
         tile_paths = []  # Placeholder for the paths to all TCI products
-        for index in range(len(self.products_df.index)):
+        # Only look up the products from the date, as the products from other dates might not have been processed yet
+        for index in self.get_date_indices(product_date):
             product = self.products_df.iloc[[index]].copy()
             product = self.__concat_resolutions_paths(product)
-            res_10m_path = product['res_10m_path'].values[0]
-            tile_path = list(res_10m_path.glob('*_' + mode + '_10m.tiff'))[0]
+            resolution = SPECTRAL_INDICES[mode].resolution if mode in SPECTRAL_INDICES else '10m'
+            resolution_path = product['res_' + resolution + '_path'].values[0]
+            tile_path = list(resolution_path.glob('*_' + mode + '_' + resolution + '.tiff'))[0]
             # file_names = os.listdir(product_paths['res_10m'])
             # tci_path = product_paths['res_10m'] + [f for f in file_names if 'TCI_10m.tiff' in f][0]
-            product_date_current = product['title'].values[0][11:19]
-            if product_date_current == product_date:
-                tile_paths.append(str(tile_path))
-                relative_orbit = product['title'].values[0][33:37]
+            tile_paths.append(str(tile_path))
+            relative_orbit = 'R' + format(int(product['rel_orbit'].values[0]), '03d')
         return relative_orbit, tile_paths
 
-    def coregister(self, src_path, dst_path):
-        try:
-            logging.debug("Coregistering image: " + str(dst_path))
-            if not dst_path.exists() or self.overwrite_products:
-                compress_option = 'COMPRESS=NONE'  # This is only used for the intermediate file and does not need compression
-
-                # Remember to set nodata value to 0 when saving the ortofoto
-                reference_im_path = Path('data/reference')
-                im_reference = str(reference_im_path / 'ortofoto_reference_epsg32632.tif')
-                im_target = str(src_path)
-                kwargs = {
-                    'mask_baddata_ref': str(reference_im_path / 'ortofoto_reference_epsg32632_nodata_mask.tif'),
-                    'path_out': str(dst_path),
-                    'fmt_out': 'GTIFF',
-                    'out_crea_options': [compress_option],
-                    'ws': (4096, 4096),
-                    'q': False,
-                    'v': False
-                }
-
-                CR = COREG(im_reference, im_target, **kwargs)
+    def get_reference_path(self):
+        """
+        :return: Path to the prepared reference image of the co-registration (see prepare_references())
+        """
+        return self.directory / 'reference' / (REFERENCE_PATH.stem + '_prepared.tif')
+
+    def prepare_references(self):
+        """
+        Prepares the reference image of the co-registration (see BaseProcessor.prepare_reference()) in the CRS and
+        resolution of the Sentinel-2 mosaics. Must be run before the dates are co-registered.
+        """
+        if not REFERENCE_PATH.exists():
+            logging.warning("Reference image of the co-registration does not exist: " + str(REFERENCE_PATH))
+            return
+        self.prepare_reference(REFERENCE_PATH, self.get_reference_path(),
+                               mask=REFERENCE_MASK_PATH if REFERENCE_MASK_PATH.exists() else None, crs='EPSG:32632',
+                               resolution=REFERENCE_RESOLUTION, nodata=0)
+
+    @traced()
+    def get_shift(self, product_date, relative_orbit):
+        """
+        Finds the spatial shift of the products from a date relative to the reference image. The shift is estimated on
+        the TCI mosaic of the date, and is stored in the shift cache, so it is only estimated once for each date and
+        relative orbit (ie. not for each mode, rerun or reprocessing with other parameters).
+
+        :param product_date: Sensing date (e.g. '20190803')
+        :param relative_orbit: Relative orbit (e.g. 'R008')
+        :return: The coreg_info of the shift
+        """
+        mission, shift_key = self.__get_shift_key(product_date, relative_orbit)
+        shift = self.shifts.get(shift_key) if self.shifts is not None else None
+        if shift is not None:
+            coreg_info, reliability = shift
+            logging.info(f"Shift of {product_date} ({relative_orbit}) has been found in the shift cache (reliability "
+                         f"is {round(reliability or 0, 2)}%)")
+            return coreg_info
+
+        vrt_path = self.__get_vrt_path(product_date, relative_orbit, 'TCI')
+        if not vrt_path.exists():  # E.g. if only the spectral indices are reprocessed
+            self.create_vrt(src_paths=self.__get_tile_paths(product_date, mode='TCI')[1], vrt_path=vrt_path)
+        reference_path = self.get_reference_path()
+        if reference_path.exists():
+            reference, coreg_kwargs = reference_path, dict(COREG_KWARGS, q=False, v=False)
+        else:  # The reference image has not been prepared (see prepare_references())
+            reference = REFERENCE_PATH
+            coreg_kwargs = dict(COREG_KWARGS, mask_baddata_ref=str(REFERENCE_MASK_PATH), q=False, v=False)
+        logging.debug("Estimating the shift of image: " + str(vrt_path))
+        if FLAGS.coreg_coarse_to_fine:
+            coreg_info, reliability = self.coregister_coarse_to_fine(
+                reference, vrt_path, coreg_kwargs, prepared=reference_path.exists(), factor=FLAGS.coreg_coarse_factor,
+                fine_window=(FLAGS.coreg_fine_window, FLAGS.coreg_fine_window))
+        else:
+            clipped_reference_path = get_temp_path(vrt_path)
+            try:
+                if reference_path.exists():  # Read the prepared reference within the footprint of the mosaic
+                    self.clip_reference(reference_path, vrt_path, clipped_reference_path)
+                    reference = clipped_reference_path
+                CR = COREG(str(reference), str(vrt_path), **coreg_kwargs)
                 CR.calculate_spatial_shifts()
-                logging.info("Shift reliability is " + str(round(CR.shift_reliability, 2)) + "% for " + str(src_path.name))
+            finally:
+                if clipped_reference_path.exists():
+                    os.remove(clipped_reference_path)
+            coreg_info, reliability = CR.coreg_info, CR.shift_reliability
+        logging.info("Shift reliability is " + str(round(reliability, 2)) + "% for " + str(vrt_path.name))
 
-                CR.correct_shifts()
-                self.create_cog(dst_path, compression='DEFLATE')
-                coreg_info = CR.coreg_info
+        if self.shifts is not None:
+            self.shifts.put(shift_key, mission, product_date, relative_orbit, coreg_info, reliability)
+        return coreg_info
 
-                return coreg_info
-            else:
-                logging.debug("Coregistered image already exist: " + str(dst_path))
-        except:
-            logging.error("Coregistration error with file: " + str(src_path))
-            CR = 'coreg_error'
-            return CR
\ No newline at end of file
+    @traced()
+    def deshift(self, src_path, dst_path, coreg_info, compression='DEFLATE', max_z_error=None):
+        """
+        Corrects the spatial shift of an image (see get_shift()) and writes it as a COG. The shift is applied to the
+        geotransform of the image when possible (see BaseProcessor.translate_to_shifted_cog()), and otherwise the image
+        is resampled by DESHIFTER.
+
+        :param src_path: Path to the image (e.g. the vrt of a mode)
+        :param dst_path: Path to the co-registered COG
+        :param coreg_info: The coreg_info of the shift
+        :param compression: Compression of the COG (see create_cog())
+        :param max_z_error: Maximum error of LERC compression (see create_cog())
+        """
+        logging.debug("Coregistering image: " + str(dst_path))
+        if not dst_path.exists() or self.overwrite_products:
+            if self.translate_to_shifted_cog(src_path, dst_path, coreg_info, compression=compression,
+                                             max_z_error=max_z_error, align_grids=FLAGS.coreg_align_grids,
+                                             tolerance=FLAGS.coreg_subpixel_tolerance):
+                return
+            # The shift requires resampling (the intermediate file does not need compression)
+            DESHIFTER(im2shift=str(src_path), coreg_results=coreg_info, path_out=str(dst_path), fmt_out='GTIFF',
+                      out_crea_options=['COMPRESS=NONE'], align_grids=FLAGS.coreg_align_grids,
+                      q=True).correct_shifts()
+            self.copy_band_metadata(src_path, dst_path)  # The scale of the values is not kept
+            self.create_cog(dst_path, compression=compression, max_z_error=max_z_error)
+        else:
+            logging.debug("Coregistered image already exist: " + str(dst_path))
@@ -13,16 +13,20 @@ FLAGS = flags.FLAGS
 
 
 class S3Processor(BaseProcessor):
-    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False):
-        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products)
+    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, state=None,
+                 cache=None):
+        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products,
+                         state=state, cache=cache)
         self.compress_gtiff = FLAGS.compress_gtiff
         self.overwrite_products = FLAGS.overwrite
+        self.resume = FLAGS.resume
 
     def process(self, index):
         # Extract the row from the dataframe with the product process (use copy to avoid "copy of a slice warning")
         # https://stackoverflow.com/questions/31468176/setting-values-on-a-copy-of-a-slice-from-a-dataframe
         product = self.products_df.iloc[[index]].copy()
-        self.unzip_product(product)
+        if not FLAGS.read_from_zip:  # Sentinel-3 products are not extracted with read_from_zip (see the flag)
+            self.unzip_product(product)
 
         # self.__convert_nc_to_basemap(product, map_type='DK')
         # self.__convert_nc_to_basemap(product, map_type='EU')
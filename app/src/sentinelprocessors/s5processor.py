@@ -14,10 +14,13 @@ FLAGS = flags.FLAGS
 
 
 class S5Processor(BaseProcessor):
-    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False):
-        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products)
+    def __init__(self, products_df, directory, compress_gtiff=True, overwrite_products=False, state=None,
+                 cache=None):
+        super().__init__(products_df, directory, compress_gtiff=compress_gtiff, overwrite_products=overwrite_products,
+                         state=state, cache=cache)
         self.compress_gtiff = FLAGS.compress_gtiff
         self.overwrite_products = FLAGS.overwrite
+        self.resume = FLAGS.resume
 
     def process(self, index):
         # Extract the row from the dataframe with the product process (use copy to avoid "copy of a slice warning")
@@ -29,10 +32,20 @@ class S5Processor(BaseProcessor):
         self.__convert_nc_to_basemap(product, map_type='DK')
         self.__convert_nc_to_basemap(product, map_type='EU')
 
+    def get_src_path(self, file_name):
+        """
+        :param file_name: Product title
+        :return: Path to the netCDF file of the product. The downloaded file is a netCDF file with a .zip extension, so
+                 it is read directly when reading from the zip files (instead of from the .nc copy).
+        """
+        if FLAGS.read_from_zip:
+            return (self.directory / 'zipfiles' / file_name).with_suffix('.zip')
+        return (self.directory / 'zipfiles' / file_name).with_suffix('.nc')
+
     def __move_product(self, product):
         if not product['product_path'].values[0].exists() or self.overwrite_products:
             file_name = product['title'].values[0]
-            src_path = (self.directory / 'zipfiles' / file_name).with_suffix('.nc')
+            src_path = self.get_src_path(file_name)
             dst_path = (product['product_path'].values[0] / file_name).with_suffix('.nc')
             if not dst_path.parent.exists():  # Create directory if it does not exist
                 os.makedirs(dst_path.parent)
@@ -46,7 +59,7 @@ class S5Processor(BaseProcessor):
         begin_time = product['beginposition'].values[0]
         end_time = product['endposition'].values[0]
 
-        src_path = (self.directory / 'zipfiles' / file_name).with_suffix('.nc')
+        src_path = self.get_src_path(file_name)
 
         # See here for list of available variables:
         # https://earth.esa.int/web/sentinel/technical-guides/sentinel-5p/level-2/products/main-variables
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from src.processingstate import fingerprint
+
+
+class ShiftCache(object):
+    """
+    On-disk database with the spatial shifts found by the co-registration (see arosics.COREG.coreg_info) of each
+    acquisition, ie. a date and relative orbit of a mission. The shift of an acquisition only depends on the
+    acquisition, the reference image and the settings of the shift estimation (e.g. the size of the matching window),
+    so it is estimated once and reused by all modes (e.g. TCI and NDVI), reruns and reprocessing with other
+    parameters.
+
+    Like ProcessingState, the database is opened for each query, so the object can be pickled and used from the
+    processes in a multiprocessing pool.
+    """
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        if not self.db_path.parent.exists():  # Create directory if it does not exist
+            os.makedirs(self.db_path.parent)
+
+        with self.__connect() as connection:
+            # WAL allows the processes to read while another process is writing
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS shifts ('
+                               'key TEXT PRIMARY KEY, '
+                               'mission TEXT NOT NULL, '
+                               'date TEXT NOT NULL, '
+                               'relative_orbit TEXT NOT NULL, '
+                               'reliability REAL, '
+                               'coreg_info TEXT NOT NULL, '
+                               'created REAL NOT NULL)')
+
+    @contextmanager
+    def __connect(self):
+        connection = sqlite3.connect(str(self.db_path), timeout=600)
+        try:
+            with connection:  # Commits the transaction (or rolls it back on exceptions)
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def get_key(mission, date, relative_orbit, reference_paths, params=None):
+        """
+        :param mission: Mission of the acquisition (e.g. 'S2A')
+        :param date: Sensing date of the acquisition (e.g. '20190803')
+        :param relative_orbit: Relative orbit of the acquisition (e.g. 'R008')
+        :param reference_paths: Paths to the reference image and its masks (fingerprinted by their size and
+                                modification time, so a new reference image invalidates the shifts)
+        :param params: Settings of the shift estimation, e.g. the size and position of the matching window (must be
+                       json serializable)
+        :return: Key of the shift
+        """
+        return hashlib.sha1(json.dumps([mission, date, relative_orbit, fingerprint(reference_paths, params=params)])
+                            .encode()).hexdigest()
+
+    def get(self, key):
+        """
+        :param key: Key of the shift (see get_key())
+        :return: Tuple with the coreg_info of the shift and its reliability [%] (None if the shift is not stored)
+        """
+        with self.__connect() as connection:
+            row = connection.execute('SELECT coreg_info, reliability FROM shifts WHERE key = ?', (key,)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def put(self, key, mission, date, relative_orbit, coreg_info, reliability):
+        """
+        :param key: Key of the shift (see get_key())
+        :param mission: Mission of the acquisition (e.g. 'S2A')
+        :param date: Sensing date of the acquisition (e.g. '20190803')
+        :param relative_orbit: Relative orbit of the acquisition (e.g. 'R008')
+        :param coreg_info: The coreg_info of the COREG object which estimated the shift
+        :param reliability: Reliability of the shift [%] (see arosics.COREG.shift_reliability)
+        """
+        # The numpy values and arrays in coreg_info are stored as lists and numbers
+        coreg_info = json.dumps(coreg_info,
+                                default=lambda value: value.tolist() if hasattr(value, 'tolist') else str(value))
+        with self.__connect() as connection:
+            connection.execute('INSERT OR REPLACE INTO shifts '
+                               '(key, mission, date, relative_orbit, reliability, coreg_info, created) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, mission, date, relative_orbit, None if reliability is None else float(reliability),
+                                coreg_info, time.time()))
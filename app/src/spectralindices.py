@@ -0,0 +1,78 @@
+import re
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+from src.bandmath import calculate_band_math
+
+try:
+    import numexpr  # Optional; evaluates the expressions without temporary arrays
+except ImportError:
+    numexpr = None
+
+SpectralIndex = namedtuple('SpectralIndex', ['expression', 'resolution', 'description'])
+
+# Spectral indices of the Sentinel-2 L2A products as expressions over the band names. The bands are read from the
+# resolution of the index, and contain the surface reflectances scaled by 10000 (hence the scaled constants of EVI and
+# SAVI).
+SPECTRAL_INDICES = OrderedDict([
+    ('NDVI', SpectralIndex('(B08 - B04) / (B08 + B04)', '10m', 'Normalized difference vegetation index')),
+    ('GNDVI', SpectralIndex('(B08 - B03) / (B08 + B03)', '10m', 'Green normalized difference vegetation index')),
+    ('NDWI', SpectralIndex('(B03 - B08) / (B03 + B08)', '10m', 'Normalized difference water index (McFeeters)')),
+    ('NDMI', SpectralIndex('(B8A - B11) / (B8A + B11)', '20m', 'Normalized difference moisture index')),
+    ('EVI', SpectralIndex('2.5 * (B08 - B04) / (B08 + 6 * B04 - 7.5 * B02 + 10000)', '10m',
+                          'Enhanced vegetation index')),
+    ('SAVI', SpectralIndex('1.5 * (B08 - B04) / (B08 + B04 + 5000)', '10m',
+                           'Soil adjusted vegetation index (L = 0.5)')),
+])
+
+BAND_PATTERN = re.compile(r'\bB(?:\d{2}|8A)\b')
+
+
+def get_index_bands(indices):
+    """
+    :param indices: Names of spectral indices (e.g. ['NDVI', 'NDMI'])
+    :return: OrderedDict with the bands (e.g. ['B04', 'B08']) which are used by the indices at each resolution
+    :raises ValueError: If an index is not in SPECTRAL_INDICES
+    """
+    unknown_indices = [name for name in indices if name not in SPECTRAL_INDICES]
+    if unknown_indices:
+        raise ValueError(f"Unknown spectral indices {unknown_indices} (available: {list(SPECTRAL_INDICES)})")
+
+    bands = OrderedDict()
+    for name in indices:
+        index = SPECTRAL_INDICES[name]
+        bands.setdefault(index.resolution, set()).update(BAND_PATTERN.findall(index.expression))
+    return OrderedDict((resolution, sorted(names)) for resolution, names in bands.items())
+
+
+def calculate_indices(band_paths, index_paths, num_threads=0, storage=None):
+    """
+    Calculates spectral indices in a single pass over the bands, where each band is read once per window and shared by
+    all of the indices (see calculate_band_math()). The indices are rounded to 2 decimals (reduces the size after
+    compression).
+
+    :param band_paths: Dict with the path to each band used by the indices (e.g. {'B04': ..., 'B08': ...}), all with the
+                       same resolution
+    :param index_paths: Dict with the output path of each index (e.g. {'NDVI': ..., 'GNDVI': ...})
+    :param num_threads: Number of threads (0 => the number of cpus)
+    :param storage: ValueStorage of the indices (None => float32)
+    """
+    bands = list(band_paths)
+    expressions = [SPECTRAL_INDICES[name].expression for name in index_paths]
+    if numexpr is None:
+        code = [compile(expression, '<' + name + '>', 'eval') for name, expression in zip(index_paths, expressions)]
+    else:
+        numexpr.set_num_threads(1)  # The windows are already processed in parallel
+
+    def calculate_window(band_arrays, index_arrays):
+        arrays = dict(zip(bands, band_arrays))
+        for i, out in enumerate(index_arrays):
+            if numexpr is None:
+                out[...] = eval(code[i], {'__builtins__': {}}, arrays)
+            else:
+                numexpr.evaluate(expressions[i], local_dict=arrays, out=out, casting='same_kind')
+            np.round(out, decimals=2, out=out)
+
+    calculate_band_math([band_paths[band] for band in bands], list(index_paths.values()), calculate_window,
+                        num_threads=num_threads, storage=storage)
@@ -0,0 +1,272 @@
+import functools
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+# Trace file of the run (None => tracing is disabled). Set with configure_tracing() in the main process and in each pool
+# process (see src.workers.init_worker).
+_trace_path = None
+# Highest peak resident set size [kB] observed by each active measure_peak_memory() (see _reset_peak_rss())
+_peak_trackers = []
+
+
+def configure_tracing(trace_path):
+    """
+    Enables tracing to a JSON lines file, where each line is a record of e.g. a span (see trace_span()). All processes
+    of a run append to the same file.
+
+    :param trace_path: Path to the trace file (None => disable tracing)
+    """
+    global _trace_path
+    _trace_path = None if trace_path is None else Path(trace_path)
+    if _trace_path is not None and not _trace_path.parent.exists():
+        os.makedirs(_trace_path.parent, exist_ok=True)
+
+
+def get_trace_path():
+    """
+    :return: Path to the trace file of the run (None if tracing is disabled)
+    """
+    return _trace_path
+
+
+def write_trace_record(record):
+    """
+    Appends a record to the trace file (if tracing is enabled).
+
+    :param record: Json serializable dict, with the type of the record in 'type' (e.g. 'span', 'task' or 'run')
+    """
+    if _trace_path is None:
+        return
+    # A single write of a line to a file opened for appending is not interleaved with the writes of other processes
+    with open(str(_trace_path), 'a') as trace_file:
+        trace_file.write(json.dumps(record, default=str) + '\n')
+
+
+def _read_peak_rss():
+    try:
+        with open('/proc/self/status') as status:
+            return [int(line.split()[1]) for line in status if line.startswith('VmHWM')][0]  # [kB]
+    except (OSError, IndexError):
+        return None
+
+
+def _reset_peak_rss():
+    # The peak resident set size of the process can only be reset for all measurements at once, so the peak before the
+    # reset is passed on to the active (ie. enclosing) measurements first
+    # (https://www.kernel.org/doc/Documentation/filesystems/proc.txt)
+    peak_rss = _read_peak_rss()
+    if peak_rss is not None:
+        for tracker in _peak_trackers:
+            tracker[0] = max(tracker[0], peak_rss)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class PeakMemory(object):
+    def __init__(self):
+        self.peak_memory = None  # [bytes] (None if it could not be measured)
+
+
+@contextmanager
+def measure_peak_memory():
+    """
+    Measures the peak memory usage of the code inside the context, including child processes (e.g. the gpt processes
+    of ESA SNAP). Measurements can be nested.
+
+    :return: PeakMemory, where peak_memory [bytes] is set when leaving the context
+    """
+    measurement = PeakMemory()
+    peak_rss_reset = _reset_peak_rss()
+    children_peak_before = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    tracker = [0]
+    _peak_trackers.append(tracker)
+    try:
+        yield measurement
+    finally:
+        _peak_trackers.remove(tracker)
+        if peak_rss_reset:
+            peak_memory = max(tracker[0], _read_peak_rss() or 0)  # [kB]
+            # ru_maxrss of the children is the peak of the largest child so far, so it is only known to belong to this
+            # measurement if it has increased inside the context
+            children_peak_after = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss  # [kB]
+            if children_peak_after > children_peak_before:
+                peak_memory += children_peak_after
+            measurement.peak_memory = peak_memory * 1024
+
+
+def _read_io():
+    # Bytes read from and written to storage by this process (not incl. child processes)
+    try:
+        with open('/proc/self/io') as io:
+            counters = dict(line.split(': ') for line in io.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+@contextmanager
+def trace_span(name, product=None, category='stage', **attributes):
+    """
+    Records a span in the trace file with the start and end time, process id, product, bytes read and written, and peak
+    memory usage of the code inside the context. Does nothing if tracing is disabled.
+
+    :param name: Name of the span (e.g. 'create_cog')
+    :param product: Product title or file name which the span processes
+    :param category: Category of the span ('task' for the tasks of the scheduler and 'stage' for processing stages)
+    :param attributes: Additional json serializable attributes of the span
+    """
+    if _trace_path is None:
+        yield
+        return
+    read_bytes_before, write_bytes_before = _read_io()
+    started = time.time()
+    error = None
+    measurement = None
+    try:
+        with measure_peak_memory() as measurement:
+            yield
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        finished = time.time()
+        read_bytes_after, write_bytes_after = _read_io()
+        record = OrderedDict([('type', 'span'), ('name', name), ('category', category), ('product', product),
+                              ('pid', os.getpid()), ('start', started), ('end', finished),
+                              ('duration', finished - started),
+                              ('read_bytes', None if read_bytes_before is None else
+                               read_bytes_after - read_bytes_before),
+                              ('write_bytes', None if write_bytes_before is None else
+                               write_bytes_after - write_bytes_before),
+                              ('peak_memory', None if measurement is None else measurement.peak_memory),
+                              ('error', error)])
+        record.update(attributes)
+        write_trace_record(record)
+
+
+def traced(name=None):
+    """
+    Decorator which records a span (see trace_span()) for every call of a processor method. The product of the span is
+    the first argument of the method which is a product (dataframe with a title) or a path.
+
+    :param name: Name of the span (None => the name of the method)
+    """
+    def decorator(method):
+        span_name = name if name is not None else method.__name__.strip('_')
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            if _trace_path is None:
+                return method(*args, **kwargs)
+            with trace_span(span_name, product=_describe_product(list(args) + list(kwargs.values()))):
+                return method(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _describe_product(values):
+    for value in values:
+        if hasattr(value, 'columns') and 'title' in value.columns:
+            return str(value['title'].values[0])
+        if isinstance(value, (str, Path)):
+            return Path(value).name
+    return None
+
+
+def read_trace(trace_path):
+    """
+    :param trace_path: Path to a trace file
+    :return: List with the records of the trace file
+    """
+    with open(str(trace_path)) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+def summarize_trace(records):
+    """
+    Summarizes a trace with the totals of each span name, the utilization of the pool processes, and the critical path
+    of the tasks (ie. the chain of tasks which determined the duration of the run).
+
+    :param records: Records of a trace file (see read_trace())
+    :return: Dict with 'stages', 'workers', 'utilization', 'wall_time' and 'critical_path'
+    """
+    spans = [record for record in records if record['type'] == 'span']
+    runs = [record for record in records if record['type'] == 'run']
+    if not spans:
+        return {'stages': {}, 'workers': {}, 'utilization': None, 'wall_time': 0, 'critical_path': []}
+
+    stages = OrderedDict()
+    for span in sorted(spans, key=lambda span: span['start']):
+        stage = stages.setdefault(span['name'], OrderedDict([('count', 0), ('errors', 0), ('total_time', 0),
+                                                             ('max_time', 0), ('read_bytes', 0), ('write_bytes', 0),
+                                                             ('max_peak_memory', None)]))
+        stage['count'] += 1
+        stage['errors'] += span['error'] is not None
+        stage['total_time'] += span['duration']
+        stage['max_time'] = max(stage['max_time'], span['duration'])
+        stage['read_bytes'] += span['read_bytes'] or 0
+        stage['write_bytes'] += span['write_bytes'] or 0
+        if span['peak_memory'] is not None:
+            stage['max_peak_memory'] = max(stage['max_peak_memory'] or 0, span['peak_memory'])
+
+    # Utilization of the pool processes is the time spent running tasks relative to the duration of the run
+    run_start = min([run['start'] for run in runs] + [span['start'] for span in spans])
+    run_end = max(span['end'] for span in spans)
+    wall_time = run_end - run_start
+    task_spans = [span for span in spans if span['category'] == 'task']
+    workers = OrderedDict()
+    for span in task_spans:
+        workers[span['pid']] = workers.get(span['pid'], 0) + span['duration']
+    num_proc = max([run['num_proc'] for run in runs] + [len(workers)])
+    utilization = sum(workers.values()) / (num_proc * wall_time) if task_spans and wall_time > 0 else None
+
+    return {'stages': stages, 'workers': workers, 'utilization': utilization, 'wall_time': wall_time,
+            'critical_path': _critical_path(records, task_spans)}
+
+
+def _critical_path(records, task_spans):
+    # Start from the task which finished last, and follow the dependency which finished last (ie. the one which the
+    # task waited for) back to the start of the run
+    dependencies = {record['name']: record['depends_on'] for record in records if record['type'] == 'task'}
+    task_spans = {span['product']: span for span in task_spans}
+    if not task_spans:
+        return []
+    path = [max(task_spans.values(), key=lambda span: span['end'])]
+    while True:
+        dependency_spans = [task_spans[name] for name in dependencies.get(path[-1]['product'], ())
+                            if name in task_spans]
+        if not dependency_spans:
+            break
+        path.append(max(dependency_spans, key=lambda span: span['end']))
+
+    return [OrderedDict([('task', span['product']), ('name', span['name']), ('start', span['start']),
+                         ('duration', span['duration'])]) for span in reversed(path)]
+
+
+def to_chrome_trace(records):
+    """
+    Converts the spans of a trace to the Chrome trace event format (can be opened in chrome://tracing or Perfetto).
+
+    :param records: Records of a trace file (see read_trace())
+    :return: Dict in the Chrome trace event format
+    """
+    events = []
+    for record in records:
+        if record['type'] != 'span':
+            continue
+        args = {key: value for key, value in record.items() if key not in ('type', 'name', 'category', 'pid', 'start',
+                                                                           'end', 'duration')}
+        events.append({'name': record['name'], 'cat': record['category'], 'ph': 'X', 'pid': record['pid'],
+                       'tid': record['pid'], 'ts': record['start'] * 1e6, 'dur': record['duration'] * 1e6,
+                       'args': args})
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -0,0 +1,34 @@
+from osgeo import gdal
+
+from src.tracing import configure_tracing
+
+# Processors of the pool process (set once by init_worker() when the process is started)
+_processors = {}
+
+
+def init_worker(processors, gdal_cache_max, trace_path=None):
+    """
+    Initializes a pool process. The processors (incl. their products dataframes) are passed to each process once,
+    instead of being pickled along with every task.
+
+    :param processors: Dict with the processor of each kind of task (e.g. {'s1': S1Processor, 's2': S2Processor})
+    :param gdal_cache_max: Maximum size of the GDAL block cache of the process [bytes]
+    :param trace_path: Trace file of the run (None => tracing is disabled)
+    """
+    gdal.SetCacheMax(int(gdal_cache_max))
+    configure_tracing(trace_path)
+    _processors.clear()
+    _processors.update(processors)
+
+
+def run_processor(kind, method, *args):
+    """
+    Runs a method of one of the processors of the pool process, such that a task only has to carry the name of the
+    method and its (small) arguments, e.g. ('s1', 'process', 12).
+
+    :param kind: Kind of the processor (e.g. 's1')
+    :param method: Name of the method to run
+    :param args: Arguments for the method
+    :return: The return value of the method
+    """
+    return getattr(_processors[kind], method)(*args)
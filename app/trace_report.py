@@ -0,0 +1,50 @@
+import json
+
+from absl import app, flags
+
+from src.tracing import read_trace, summarize_trace, to_chrome_trace
+
+FLAGS = flags.FLAGS
+
+
+def define_flags():
+    flags.DEFINE_string('trace_file', None, 'Trace file of a run (e.g. /data/logs/trace-20190803-120000-UTC.jsonl)')
+    flags.DEFINE_string('chrome_trace', None, 'Also convert the trace to a Chrome trace file (open it in '
+                                              'chrome://tracing or https://ui.perfetto.dev)')
+    flags.mark_flag_as_required('trace_file')
+
+
+def main(argv):
+    records = read_trace(FLAGS.trace_file)
+    summary = summarize_trace(records)
+
+    print(f"Wall time: {summary['wall_time'] / 60:.1f} min")
+    if summary['utilization'] is not None:
+        print(f"Worker utilization: {summary['utilization'] * 100:.1f}%")
+    print()
+    print(f"{'Stage':<40}{'Count':>8}{'Errors':>8}{'Total [min]':>14}{'Max [min]':>12}{'Read [GB]':>12}"
+          f"{'Written [GB]':>14}{'Peak mem. [GB]':>16}")
+    stages = sorted(summary['stages'].items(), key=lambda item: -item[1]['total_time'])
+    for name, stage in stages:
+        peak_memory = '' if stage['max_peak_memory'] is None else f"{stage['max_peak_memory'] / 1e9:.2f}"
+        print(f"{name:<40}{stage['count']:>8}{stage['errors']:>8}{stage['total_time'] / 60:>14.1f}"
+              f"{stage['max_time'] / 60:>12.1f}{stage['read_bytes'] / 1e9:>12.2f}{stage['write_bytes'] / 1e9:>14.2f}"
+              f"{peak_memory:>16}")
+    print()
+    print("Busy time of each worker:")
+    for pid, busy_time in summary['workers'].items():
+        print(f"  {pid}: {busy_time / 60:.1f} min")
+    print()
+    print("Critical path:")
+    for task in summary['critical_path']:
+        print(f"  {task['task']} ({task['name']}): {task['duration'] / 60:.1f} min")
+
+    if FLAGS.chrome_trace is not None:
+        with open(FLAGS.chrome_trace, 'w') as chrome_trace_file:
+            json.dump(to_chrome_trace(records), chrome_trace_file)
+        print(f"\nChrome trace written to: {FLAGS.chrome_trace}")
+
+
+if __name__ == '__main__':
+    define_flags()
+    app.run(main)
@@ -0,0 +1,61 @@
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pytest.importorskip('loguru')
+from src.artifactcache import ArtifactCache  # noqa: E402
+from src.processingstate import fingerprint  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ArtifactCache(tmp_path / 'cache')
+
+
+@pytest.fixture
+def output(tmp_path):
+    path = tmp_path / 'order' / 'S1A_20190803_028412_RGB.tif'
+    path.parent.mkdir()
+    path.write_bytes(b'cog')
+    return path
+
+
+def test_hit_restores_outputs(cache, output):
+    stage_fingerprint = fingerprint([], params={'compression': 'DEFLATE'})
+    cache.store('20190803_028412', 'cog', stage_fingerprint, [output])
+    output.unlink()
+
+    assert cache.fetch('20190803_028412', 'cog', stage_fingerprint) == [output]
+    assert output.read_bytes() == b'cog'
+
+
+def test_miss_on_parameter_change(cache, output):
+    cache.store('20190803_028412', 'cog', fingerprint([], params={'compression': 'DEFLATE'}), [output])
+
+    assert cache.fetch('20190803_028412', 'cog', fingerprint([], params={'compression': 'LERC_DEFLATE'})) is None
+    assert cache.fetch('20190803_028412', 'vrt', fingerprint([], params={'compression': 'DEFLATE'})) is None
+    assert cache.fetch('20190804_028427', 'cog', fingerprint([], params={'compression': 'DEFLATE'})) is None
+
+
+def test_directories_are_not_cached(cache, tmp_path):
+    product_path = tmp_path / 'S1A_IW_GRDH_1SDV.SAFE'
+    product_path.mkdir()
+    cache.store('S1A_IW_GRDH_1SDV', 'unzip', fingerprint([]), [product_path])
+
+    assert cache.fetch('S1A_IW_GRDH_1SDV', 'unzip', fingerprint([])) is None
+
+
+def test_least_recently_used_is_evicted(tmp_path, output):
+    cache = ArtifactCache(tmp_path / 'cache', max_size=2 * len(b'cog'))
+    for i in range(3):
+        cache.store(f'key_{i}', 'cog', fingerprint([]), [output])
+        time.sleep(0.01)
+        if i == 1:
+            cache.fetch('key_0', 'cog', fingerprint([]))  # key_1 is now the least recently used
+
+    assert cache.fetch('key_0', 'cog', fingerprint([])) is not None
+    assert cache.fetch('key_1', 'cog', fingerprint([])) is None
+    assert cache.fetch('key_2', 'cog', fingerprint([])) is not None
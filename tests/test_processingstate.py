@@ -0,0 +1,75 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pytest.importorskip('loguru')
+from src.processingstate import ProcessingState, fingerprint  # noqa: E402
+
+
+@pytest.fixture
+def state(tmp_path):
+    return ProcessingState(tmp_path / 'orders' / 'processing_state.sqlite')
+
+
+@pytest.fixture
+def output(tmp_path):
+    path = tmp_path / 'output.tif'
+    path.write_bytes(b'output')
+    return path
+
+
+def test_completed_stage_is_skipped_with_same_fingerprint(state, output):
+    stage_fingerprint = fingerprint([output], params={'compression': 'DEFLATE'})
+    with state.stage('S1A_20190803', 'cog', stage_fingerprint, outputs=[output]):
+        pass
+
+    assert state.is_completed('S1A_20190803', 'cog', stage_fingerprint)
+    assert state.is_completed('S1A_20190803', 'cog')  # The inputs are not compared without a fingerprint
+    assert state.get_stages('S1A_20190803')['cog']['status'] == 'completed'
+
+
+def test_stage_is_rerun_when_fingerprint_changes(state, output):
+    with state.stage('S1A_20190803', 'cog', fingerprint([output], params={'compression': 'DEFLATE'}), outputs=[output]):
+        pass
+
+    assert not state.is_completed('S1A_20190803', 'cog', fingerprint([output], params={'compression': 'LERC'}))
+    assert not state.is_completed('S1A_20190803', 'vrt', fingerprint([output], params={'compression': 'DEFLATE'}))
+
+
+def test_stage_is_rerun_when_outputs_are_missing(state, output):
+    stage_fingerprint = fingerprint([output])
+    with state.stage('S1A_20190803', 'cog', stage_fingerprint, outputs=[output]):
+        pass
+    output.unlink()
+
+    assert not state.is_completed('S1A_20190803', 'cog', stage_fingerprint)
+
+
+def test_failed_stage_is_not_completed(state):
+    with pytest.raises(RuntimeError):
+        with state.stage('S1A_20190803', 'cog'):
+            raise RuntimeError('gpt failed')
+
+    assert not state.is_completed('S1A_20190803', 'cog')
+    assert state.get_stages('S1A_20190803')['cog']['error'] == repr(RuntimeError('gpt failed'))
+
+
+def test_fingerprint_changes_with_file_and_params(tmp_path):
+    path = tmp_path / 'input.tif'
+    path.write_bytes(b'input')
+    original = fingerprint([path], params={'dtype': 'int16'})
+
+    assert fingerprint([path], params={'dtype': 'int16'}) == original
+    assert fingerprint([path], params={'dtype': 'float32'}) != original
+    path.write_bytes(b'changed input')
+    assert fingerprint([path], params={'dtype': 'int16'}) != original
+
+
+def test_peak_memory_keeps_highest_observation(state):
+    assert state.get_peak_memory('s1_tile') is None
+    state.record_peak_memory('s1_tile', 4e9)
+    state.record_peak_memory('s1_tile', 1e9)
+
+    assert state.get_peak_memory('s1_tile') == 4e9
@@ -0,0 +1,63 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pd = pytest.importorskip('pandas')
+from src.productnames import parse_product_names  # noqa: E402
+
+S1_TITLE = 'S1A_IW_GRDH_1SDV_20190803T053407_20190803T053432_028412_033562_9A1C'
+S2_TITLE = 'S2B_MSIL2A_20190805T103029_N0213_R108_T32UNG_20190805T134337'
+S3_TITLE = 'S3A_OL_1_EFR____20190803T095331_20190803T095631_20190804T141139_0179_047_350_1980_LN1_O_NT_002'
+
+
+@pytest.fixture
+def products_df():
+    return pd.DataFrame({'title': [S1_TITLE, S2_TITLE, S3_TITLE, 'not a product name'],
+                         'relativeorbitnumber': [139, 108, 350, None],
+                         'orbitdirection': ['DESCENDING', 'DESCENDING', 'DESCENDING', None]})
+
+
+def test_sentinel1_title(products_df):
+    product = parse_product_names(products_df).iloc[0]
+
+    assert product['mission'] == 'S1A'
+    assert product['date'] == '20190803'
+    assert product['sensing_time'] == pd.Timestamp('2019-08-03 05:34:07')
+    assert product['abs_orbit'] == 28412
+    assert product['rel_orbit'] == 139  # From the metadata, as it is not in the name
+    assert product['pass_mode'] == 'DSC'
+    assert product['group'] == '20190803_028412'
+    assert pd.isna(product['mgrs_tile'])
+
+
+def test_sentinel2_title(products_df):
+    product = parse_product_names(products_df).iloc[1]
+
+    assert product['mission'] == 'S2B'
+    assert product['date'] == '20190805'
+    assert product['rel_orbit'] == 108
+    assert product['mgrs_tile'] == '32UNG'
+    assert (product['utm_zone'], product['latitude_band'], product['grid_square']) == ('32', 'U', 'NG')
+    assert product['group'] == '20190805'
+    assert pd.isna(product['abs_orbit']) and pd.isna(product['pass_mode'])
+
+
+def test_titles_that_do_not_match(products_df):
+    products_df = parse_product_names(products_df)
+
+    for _, product in products_df.iloc[2:].iterrows():
+        assert pd.isna(product['mission'])
+        assert pd.isna(product['date'])
+        assert pd.isna(product['sensing_time'])
+        assert pd.isna(product['rel_orbit'])
+        assert pd.isna(product['group'])
+
+
+def test_without_orbit_metadata():
+    products_df = parse_product_names(pd.DataFrame({'title': [S1_TITLE]}))
+
+    assert pd.isna(products_df['rel_orbit'].iloc[0])
+    assert products_df['pass_mode'].isna().all()
+    assert products_df['group'].iloc[0] == '20190803_028412'
@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pytest.importorskip('osgeo')
+pytest.importorskip('arosics')
+from src.processingstate import ProcessingState  # noqa: E402
+from src.sentinelprocessors.s2processor import S2Processor  # noqa: E402
+
+TITLE = 'S2A_MSIL2A_20190803T103031_N0213_R108_T32UNG_20190803T134337'
+
+
+@pytest.fixture
+def zip_path(tmp_path):
+    path = tmp_path / 'zipfiles' / f'{TITLE}.zip'
+    path.parent.mkdir()
+    path.write_bytes(b'zip')
+    return path
+
+
+def test_changed_bands_invalidate_band_geotiffs(tmp_path, zip_path):
+    state = ProcessingState(tmp_path / 'orders' / 'processing_state.sqlite')
+    ndvi_members = S2Processor.get_zip_members(['TCI'], ['10m'], indices=['NDVI'])
+    with state.stage(TITLE, 'band_geotiffs', S2Processor.get_band_geotiffs_fingerprint(zip_path, True, ndvi_members)):
+        pass
+
+    assert state.is_completed(TITLE, 'band_geotiffs',
+                              S2Processor.get_band_geotiffs_fingerprint(zip_path, True, ndvi_members))
+    # NDMI needs the 20m bands B8A and B11, which have not been translated
+    ndmi_members = S2Processor.get_zip_members(['TCI'], ['10m'], indices=['NDVI', 'NDMI'])
+    assert not state.is_completed(TITLE, 'band_geotiffs',
+                                  S2Processor.get_band_geotiffs_fingerprint(zip_path, True, ndmi_members))
+    assert not state.is_completed(TITLE, 'band_geotiffs', S2Processor.get_band_geotiffs_fingerprint(zip_path, True))
@@ -0,0 +1,79 @@
+import os
+import signal
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pytest.importorskip('loguru')
+pytest.importorskip('tqdm')
+import src.scheduler  # noqa: E402
+from src.scheduler import TaskScheduler  # noqa: E402
+
+
+def timed_sleep(seconds):
+    start = time.time()
+    time.sleep(seconds)
+    return start, time.time()
+
+
+def kill_process():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def test_task_over_budget_waits_for_running_tasks():
+    scheduler = TaskScheduler(num_proc=2, memory_budget=1e9)
+    scheduler.add_task('first', timed_sleep, args=(0.5,), memory=0.6e9)
+    scheduler.add_task('second', timed_sleep, args=(0.5,), memory=0.6e9)
+    tasks = scheduler.run()
+
+    assert [task.status for task in tasks.values()] == ['done', 'done']
+    (_, first_end), (second_start, _) = tasks['first'].result, tasks['second'].result
+    assert second_start >= first_end
+
+
+def test_tasks_within_budget_run_concurrently():
+    scheduler = TaskScheduler(num_proc=2, memory_budget=1e9)
+    scheduler.add_task('first', timed_sleep, args=(0.5,), memory=0.4e9)
+    scheduler.add_task('second', timed_sleep, args=(0.5,), memory=0.4e9)
+    tasks = scheduler.run()
+
+    (first_start, first_end), (second_start, second_end) = tasks['first'].result, tasks['second'].result
+    assert second_start < first_end and first_start < second_end
+
+
+def test_task_exceeding_budget_runs_alone():
+    scheduler = TaskScheduler(num_proc=2, memory_budget=1e9)
+    scheduler.add_task('large', timed_sleep, args=(0,), memory=2e9)
+
+    assert scheduler.run()['large'].status == 'done'
+
+
+def test_task_of_dead_process_fails(monkeypatch):
+    monkeypatch.setattr(src.scheduler, 'WORKER_CHECK_INTERVAL', 0.1)
+    scheduler = TaskScheduler(num_proc=1)
+    scheduler.add_task('killed', kill_process)
+    scheduler.add_task('dependent', timed_sleep, args=(0,), depends_on=['killed'])
+    scheduler.add_task('independent', timed_sleep, args=(0,))
+    tasks = scheduler.run()
+
+    assert tasks['killed'].status == 'failed'
+    assert tasks['dependent'].status == 'skipped'
+    assert tasks['independent'].status == 'done'
+
+
+def test_task_of_dead_process_fails_while_other_tasks_finish(monkeypatch):
+    monkeypatch.setattr(src.scheduler, 'WORKER_CHECK_INTERVAL', 0.3)
+    scheduler = TaskScheduler(num_proc=2, limits={'large': 1})
+    scheduler.add_task('killed', kill_process, priority=2, kind='large')
+    scheduler.add_task('waiting', timed_sleep, args=(0,), priority=1, kind='large')
+    for i in range(40):
+        scheduler.add_task(f'short_{i}', timed_sleep, args=(0.05,), kind='short')
+    tasks = scheduler.run()
+
+    assert tasks['killed'].status == 'failed'
+    # The dead process is found while the short tasks keep finishing (ie. the results queue is never idle)
+    waiting_start, _ = tasks['waiting'].result
+    assert waiting_start < max(tasks[f'short_{i}'].result[1] for i in range(40))
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+pytest.importorskip('loguru')
+from src.shiftcache import ShiftCache  # noqa: E402
+
+COREG_INFO = {'corrected_shifts_map': {'x': 2.5, 'y': -1.0}, 'reference projection': 'EPSG:25832',
+              'original map info': ['UTM', 1, 1, 500000.0, 6200000.0, 10.0, 10.0],
+              'updated map info': ['UTM', 1, 1, 500002.5, 6199999.0, 10.0, 10.0]}
+
+
+@pytest.fixture
+def shifts(tmp_path):
+    return ShiftCache(tmp_path / 'orders' / 'coregistration_shifts.sqlite')
+
+
+@pytest.fixture
+def reference(tmp_path):
+    path = tmp_path / 'reference.tif'
+    path.write_bytes(b'reference')
+    return path
+
+
+def test_hit_returns_stored_shift(shifts, reference):
+    key = ShiftCache.get_key('S2A', '20190803', 'R108', [reference], params={'ws': [256, 256]})
+    shifts.put(key, 'S2A', '20190803', 'R108', COREG_INFO, 87.5)
+
+    assert shifts.get(ShiftCache.get_key('S2A', '20190803', 'R108', [reference], params={'ws': [256, 256]})) == \
+        (COREG_INFO, 87.5)
+
+
+def test_miss_on_other_acquisition_or_settings(shifts, reference):
+    shifts.put(ShiftCache.get_key('S2A', '20190803', 'R108', [reference], params={'ws': [256, 256]}),
+               'S2A', '20190803', 'R108', COREG_INFO, 87.5)
+
+    assert shifts.get(ShiftCache.get_key('S2A', '20190803', 'R008', [reference], params={'ws': [256, 256]})) is None
+    assert shifts.get(ShiftCache.get_key('S2A', '20190806', 'R108', [reference], params={'ws': [256, 256]})) is None
+    assert shifts.get(ShiftCache.get_key('S2A', '20190803', 'R108', [reference], params={'ws': [512, 512]})) is None
+
+
+def test_miss_on_new_reference(shifts, reference):
+    shifts.put(ShiftCache.get_key('S2A', '20190803', 'R108', [reference]), 'S2A', '20190803', 'R108', COREG_INFO, None)
+    reference.write_bytes(b'new reference')
+
+    assert shifts.get(ShiftCache.get_key('S2A', '20190803', 'R108', [reference])) is None
@@ -0,0 +1,60 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'app'))
+np = pytest.importorskip('numpy')
+rasterio = pytest.importorskip('rasterio')
+from rasterio.transform import from_origin  # noqa: E402
+from src.bandmath import get_value_storage  # noqa: E402
+from src.spectralindices import calculate_indices, get_index_bands  # noqa: E402
+
+# Surface reflectances scaled by 10000, as in the Sentinel-2 L2A products
+BANDS = {
+    'B03': np.array([[500, 800], [1000, 0]], dtype='uint16'),
+    'B04': np.array([[1000, 2000], [3000, 0]], dtype='uint16'),
+    'B08': np.array([[3000, 2000], [1000, 0]], dtype='uint16'),
+}
+
+
+@pytest.fixture
+def band_paths(tmp_path):
+    band_paths = {}
+    for band, values in BANDS.items():
+        band_paths[band] = tmp_path / f'{band}.tif'
+        with rasterio.open(str(band_paths[band]), 'w', driver='GTiff', width=2, height=2, count=1, dtype='uint16',
+                           crs='EPSG:32632', transform=from_origin(500000, 6200000, 10, 10)) as dst:
+            dst.write(values, 1)
+    return band_paths
+
+
+def read(path):
+    with rasterio.open(str(path)) as src:
+        return src.read(1), src.scales[0], src.nodata
+
+
+def test_get_index_bands():
+    assert get_index_bands(['NDVI', 'NDMI', 'GNDVI']) == {'10m': ['B03', 'B04', 'B08'], '20m': ['B11', 'B8A']}
+    with pytest.raises(ValueError):
+        get_index_bands(['XYZ'])
+
+
+def test_ndvi_and_gndvi(band_paths, tmp_path):
+    index_paths = {'NDVI': tmp_path / 'NDVI.tif', 'GNDVI': tmp_path / 'GNDVI.tif'}
+    calculate_indices(band_paths, index_paths, num_threads=1)
+
+    ndvi, _, _ = read(index_paths['NDVI'])
+    gndvi, _, _ = read(index_paths['GNDVI'])
+    np.testing.assert_allclose(ndvi[~np.isnan(ndvi)], [0.5, 0, -0.5])
+    np.testing.assert_allclose(gndvi[~np.isnan(gndvi)], [0.71, 0.43, 0])
+    assert np.isnan(ndvi[1, 1]) and np.isnan(gndvi[1, 1])  # 0 / 0
+
+
+def test_ndvi_int16_storage(band_paths, tmp_path):
+    index_paths = {'NDVI': tmp_path / 'NDVI.tif'}
+    calculate_indices(band_paths, index_paths, num_threads=1, storage=get_value_storage('int16', precision=0.01))
+
+    ndvi, scale, nodata = read(index_paths['NDVI'])
+    assert ndvi.dtype == np.int16 and scale == 0.01
+    np.testing.assert_array_equal(ndvi, [[50, 0], [-50, nodata]])